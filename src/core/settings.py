@@ -23,6 +23,9 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 TEMPLATE_DIR = BASE_DIR.joinpath("templates")
 STATIC_DIR = BASE_DIR.joinpath("static")
 MEDIA_DIR = BASE_DIR.joinpath("media")
+# Working files of the DICOM services, kept out of MEDIA_ROOT since
+# everything there is served without authentication
+VAR_DIR = BASE_DIR.joinpath("var")
 
 # Django Configuration
 ON_PRODUCTION = os.getenv("ON_PRODUCTION") == "True"
@@ -51,6 +54,109 @@ EMAIL_USE_TLS = os.getenv("EMAIL_USE_TLS") == "True"
 EMAIL_USE_SSL = os.getenv("EMAIL_USE_SSL") == "True"
 DEFAULT_FROM_EMAIL = os.getenv("DEFAULT_FROM_EMAIL")
 
+# DICOM receiver configuration
+DICOM_AE_TITLE = os.getenv("DICOM_AE_TITLE", "localhost")
+DICOM_PORT = int(os.getenv("DICOM_PORT", "5555"))
+DICOM_RECEIVER_PROCESSES = int(os.getenv("DICOM_RECEIVER_PROCESSES", "1"))
+# C-MOVE destinations as "AET=host:port,AET2=host:port"
+DICOM_MOVE_DESTINATIONS = os.getenv("DICOM_MOVE_DESTINATIONS", "")
+DICOM_ASSOCIATION_IDLE_TIMEOUT = int(os.getenv("DICOM_ASSOCIATION_IDLE_TIMEOUT", "60"))
+# Admission control, per receiver process (0 disables a limit): open
+# associations, in total and per calling AE title, and bytes of received
+# instances not yet saved. C-STORE is refused with Out of Resources while
+# the ingest queue is filled past DICOM_INGEST_HIGH_WATER (a fraction).
+DICOM_MAX_ASSOCIATIONS = int(os.getenv("DICOM_MAX_ASSOCIATIONS", "10"))
+DICOM_MAX_ASSOCIATIONS_PER_AE = int(os.getenv("DICOM_MAX_ASSOCIATIONS_PER_AE", "0"))
+DICOM_MAX_INFLIGHT_BYTES = int(os.getenv("DICOM_MAX_INFLIGHT_BYTES", "0"))
+DICOM_INGEST_HIGH_WATER = float(os.getenv("DICOM_INGEST_HIGH_WATER", "0.8"))
+DICOM_STORE_MODE = os.getenv("DICOM_STORE_MODE", "passthrough")
+# Compressed transfer syntaxes accepted besides Explicit/Implicit VR Little
+# Endian, stored exactly as received. Default: JPEG-LS Lossless and Near
+# Lossless, JPEG 2000 Lossless and lossy, RLE Lossless, Deflated Explicit VR
+# Little Endian, JPEG Baseline and JPEG Lossless SV1. JPEG-LS and JPEG
+# Lossless are decoded with pylibjpeg-libjpeg and pyjpegls
+DICOM_TRANSFER_SYNTAXES = os.getenv(
+    "DICOM_TRANSFER_SYNTAXES",
+    "1.2.840.10008.1.2.4.80,1.2.840.10008.1.2.4.81,1.2.840.10008.1.2.4.90,"
+    "1.2.840.10008.1.2.4.91,1.2.840.10008.1.2.5,1.2.840.10008.1.2.1.99,"
+    "1.2.840.10008.1.2.4.50,1.2.840.10008.1.2.4.70",
+).split(",")
+# Instances re-sent with different content: "keep" the stored file,
+# "replace" it or store a new "version" next to it
+DICOM_DUPLICATE_POLICY = os.getenv("DICOM_DUPLICATE_POLICY", "replace")
+# Where stored instances live: "filesystem" (MEDIA_ROOT) or an "s3" bucket,
+# read through a local cache of DICOM_S3_CACHE_SIZE bytes
+DICOM_STORAGE_BACKEND = os.getenv("DICOM_STORAGE_BACKEND", "filesystem")
+# "sharded" (hash prefix/study/series) or "patient" (one directory per patient)
+DICOM_STORAGE_LAYOUT = os.getenv("DICOM_STORAGE_LAYOUT", "sharded")
+DICOM_S3_BUCKET = os.getenv("DICOM_S3_BUCKET", "")
+DICOM_S3_PREFIX = os.getenv("DICOM_S3_PREFIX", "")
+DICOM_S3_ENDPOINT_URL = os.getenv("DICOM_S3_ENDPOINT_URL", "")
+DICOM_S3_REGION = os.getenv("DICOM_S3_REGION", "")
+DICOM_S3_ACCESS_KEY_ID = os.getenv("DICOM_S3_ACCESS_KEY_ID", "")
+DICOM_S3_SECRET_ACCESS_KEY = os.getenv("DICOM_S3_SECRET_ACCESS_KEY", "")
+DICOM_S3_CACHE_DIR = os.getenv("DICOM_S3_CACHE_DIR", VAR_DIR.joinpath("dicom_s3_cache"))
+DICOM_S3_CACHE_SIZE = int(os.getenv("DICOM_S3_CACHE_SIZE", str(2 * 1024**3)))
+# Instances of up to DICOM_PACK_MAX_SIZE bytes are appended to segment files
+# of DICOM_SEGMENT_SIZE bytes instead of kept as files of their own (0: off)
+DICOM_PACK_MAX_SIZE = int(os.getenv("DICOM_PACK_MAX_SIZE", "0"))
+DICOM_SEGMENT_SIZE = int(os.getenv("DICOM_SEGMENT_SIZE", str(1024**3)))
+DICOM_PACK_CACHE_DIR = os.getenv(
+    "DICOM_PACK_CACHE_DIR", VAR_DIR.joinpath("dicom_pack_cache")
+)
+DICOM_PACK_CACHE_SIZE = int(os.getenv("DICOM_PACK_CACHE_SIZE", str(256 * 1024**2)))
+DICOM_SPOOL_DIR = os.getenv("DICOM_SPOOL_DIR", VAR_DIR.joinpath("dicom_spool"))
+DICOM_INGEST_QUEUE_SIZE = int(os.getenv("DICOM_INGEST_QUEUE_SIZE", "1000"))
+DICOM_INGEST_QUEUE_TIMEOUT = float(os.getenv("DICOM_INGEST_QUEUE_TIMEOUT", "5"))
+DICOM_INGEST_WORKERS = int(os.getenv("DICOM_INGEST_WORKERS", "4"))
+DICOM_INGEST_BATCH_SIZE = int(os.getenv("DICOM_INGEST_BATCH_SIZE", "200"))
+DICOM_INGEST_FLUSH_INTERVAL = float(os.getenv("DICOM_INGEST_FLUSH_INTERVAL", "0.05"))
+DICOM_INGEST_ACK_ON_COMMIT = os.getenv("DICOM_INGEST_ACK_ON_COMMIT", "True") == "True"
+# Journal received instances and acknowledge them once the journal is synced,
+# the ingest workers then store them. Replayed after a crash.
+DICOM_INGEST_JOURNAL = os.getenv("DICOM_INGEST_JOURNAL") == "True"
+DICOM_JOURNAL_DIR = os.getenv("DICOM_JOURNAL_DIR", VAR_DIR.joinpath("dicom_journal"))
+DICOM_JOURNAL_FILE_SIZE = int(os.getenv("DICOM_JOURNAL_FILE_SIZE", str(256 * 1024**2)))
+DICOM_JOURNAL_CHECKPOINT_INTERVAL = float(
+    os.getenv("DICOM_JOURNAL_CHECKPOINT_INTERVAL", "10")
+)
+DICOM_INGEST_COMMIT_TIMEOUT = float(os.getenv("DICOM_INGEST_COMMIT_TIMEOUT", "30"))
+# Instances that fail to be indexed are kept here and retried with
+# exponential backoff, then parked (see the dead_letters command)
+DICOM_DEAD_LETTER_DIR = os.getenv(
+    "DICOM_DEAD_LETTER_DIR", VAR_DIR.joinpath("dicom_dead_letter")
+)
+DICOM_DEAD_LETTER_MAX_ATTEMPTS = int(os.getenv("DICOM_DEAD_LETTER_MAX_ATTEMPTS", "10"))
+DICOM_DEAD_LETTER_RETRY_INTERVAL = float(
+    os.getenv("DICOM_DEAD_LETTER_RETRY_INTERVAL", "30")
+)
+DICOM_DEAD_LETTER_BACKOFF = float(os.getenv("DICOM_DEAD_LETTER_BACKOFF", "30"))
+DICOM_DEAD_LETTER_MAX_BACKOFF = float(
+    os.getenv("DICOM_DEAD_LETTER_MAX_BACKOFF", "3600")
+)
+# At-rest compression of uncompressed instances on ingest, "deflate" or
+# "rle"; empty keeps them as received (see the compact_instances command)
+DICOM_INGEST_COMPRESSION = os.getenv("DICOM_INGEST_COMPRESSION", "")
+DICOM_INGEST_STATS_INTERVAL = int(os.getenv("DICOM_INGEST_STATS_INTERVAL", "60"))
+DICOM_THUMBNAIL_WORKERS = int(os.getenv("DICOM_THUMBNAIL_WORKERS", "2"))
+DICOM_THUMBNAIL_SIZE = int(os.getenv("DICOM_THUMBNAIL_SIZE", "128"))
+DICOM_PREVIEW_SIZE = int(os.getenv("DICOM_PREVIEW_SIZE", "512"))
+DICOM_VOLUME_CACHE_DIR = os.getenv(
+    "DICOM_VOLUME_CACHE_DIR", VAR_DIR.joinpath("dicom_volumes")
+)
+DICOM_VOLUME_CACHE_SIZE = int(os.getenv("DICOM_VOLUME_CACHE_SIZE", "8589934592"))
+DICOM_ROI_WORKERS = int(os.getenv("DICOM_ROI_WORKERS", "4"))
+
+# DICOMweb configuration
+DICOMWEB_QIDO_LIMIT = int(os.getenv("DICOMWEB_QIDO_LIMIT", "100"))
+DICOMWEB_QIDO_MAX_LIMIT = int(os.getenv("DICOMWEB_QIDO_MAX_LIMIT", "1000"))
+DICOMWEB_CHUNK_SIZE = int(os.getenv("DICOMWEB_CHUNK_SIZE", "65536"))
+DICOMWEB_RENDER_CACHE_DIR = os.getenv(
+    "DICOMWEB_RENDER_CACHE_DIR", VAR_DIR.joinpath("dicom_render_cache")
+)
+DICOMWEB_RENDER_CACHE_SIZE = int(os.getenv("DICOMWEB_RENDER_CACHE_SIZE", "1073741824"))
+DICOMWEB_RENDER_JPEG_QUALITY = int(os.getenv("DICOMWEB_RENDER_JPEG_QUALITY", "90"))
+
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/4.0/howto/deployment/checklist/
 
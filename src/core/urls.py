@@ -50,6 +50,7 @@ app_urlpatterns = [
     path("admin/", admin.site.urls),
     path("auth/", include("user.urls")),
     path("auth/", include("dj_rest_auth.urls")),
+    path("dicomweb/", include("dicom.urls")),
     # path("auth/registration/", include("dj_rest_auth.registration.urls")),
 ]
 
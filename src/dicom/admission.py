@@ -0,0 +1,119 @@
+import threading
+
+# A-ASSOCIATE-RJ: rejected-transient, service provider (presentation
+# related), local-limit-exceeded. The requestor may try again later.
+REJECT_LOCAL_LIMIT = (0x02, 0x03, 0x02)
+
+# C-STORE Refused: Out of Resources. 0xA700 is a full ingest queue (see
+# ingest.commit_status), these are the admission limits in front of it.
+STATUS_HIGH_WATER = 0xA701
+STATUS_INFLIGHT_BYTES = 0xA702
+
+
+class AdmissionControl:
+    """
+    Limits what a receiver process takes on, refusing new work while it
+    is saturated instead of queueing without bound
+
+    Associations are rejected as a transient local limit once there are
+    `max_associations` open, or `max_associations_per_ae` from the same
+    calling AE title. C-STORE requests are refused with an Out of
+    Resources status while the ingest queue is filled past `high_water`
+    (a fraction of its size), or when the instance would take the bytes
+    in flight (queued or being persisted) over `max_inflight_bytes`. 0
+    disables a limit.
+
+    Limits are checked when a request arrives, so concurrent C-STOREs
+    can overshoot `max_inflight_bytes` by an instance each. Every
+    decision is counted in `stats()`.
+    """
+
+    def __init__(
+        self,
+        ingest_queue,
+        max_associations=0,
+        max_associations_per_ae=0,
+        max_inflight_bytes=0,
+        high_water=0,
+    ):
+        self.ingest_queue = ingest_queue
+        self.max_associations = max_associations
+        self.max_associations_per_ae = max_associations_per_ae
+        self.max_inflight_bytes = max_inflight_bytes
+        self.high_water = high_water
+
+        self._lock = threading.Lock()
+        # {association: calling AE title} of the admitted associations
+        self._associations = {}
+        self._counters = {
+            "associations_accepted": 0,
+            "associations_rejected": 0,
+            "associations_rejected_per_ae": 0,
+            "stores_refused_high_water": 0,
+            "stores_refused_inflight_bytes": 0,
+        }
+
+    def handle_requested(self, event):
+        """
+        Handle EVT_REQUESTED: admit the association, or reject it before
+        it is negotiated.
+        """
+        assoc = event.assoc
+        calling_ae = assoc.requestor.primitive.calling_ae_title.strip()
+        with self._lock:
+            active = len(self._associations)
+            per_ae = sum(1 for ae in self._associations.values() if ae == calling_ae)
+            if self.max_associations and active >= self.max_associations:
+                counter = "associations_rejected"
+                reason = "associations"
+            elif (
+                self.max_associations_per_ae and per_ae >= self.max_associations_per_ae
+            ):
+                counter = "associations_rejected_per_ae"
+                reason = f"associations from {calling_ae}"
+            else:
+                self._associations[assoc] = calling_ae
+                self._counters["associations_accepted"] += 1
+                return
+            self._counters[counter] += 1
+
+        print(
+            f" Rejecting association from {calling_ae}: too many {reason}"
+            f" ({active} open)"
+        )
+        assoc.acse.send_reject(*REJECT_LOCAL_LIMIT)
+        assoc.kill()
+
+    def handle_closed(self, event):
+        """Handle EVT_CONN_CLOSE: the association no longer counts."""
+        with self._lock:
+            self._associations.pop(event.assoc, None)
+
+    def store_status(self, size):
+        """
+        Return the Out of Resources status to refuse a received instance
+        of `size` bytes with, or None to accept it.
+        """
+        if self.high_water and self.ingest_queue.depth() >= self.high_water:
+            print(" Ingest queue past its high-water mark, refusing DICOM file")
+            self._count("stores_refused_high_water")
+            return STATUS_HIGH_WATER
+        # An instance larger than the limit is still taken on its own
+        inflight = self.ingest_queue.inflight_bytes()
+        if (
+            self.max_inflight_bytes
+            and inflight
+            and inflight + size > self.max_inflight_bytes
+        ):
+            print(" Too many bytes in flight, refusing DICOM file")
+            self._count("stores_refused_inflight_bytes")
+            return STATUS_INFLIGHT_BYTES
+        return None
+
+    def stats(self):
+        with self._lock:
+            return {**self._counters, "associations_active": len(self._associations)}
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
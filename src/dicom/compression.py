@@ -0,0 +1,95 @@
+import contextlib
+import os
+import uuid
+from io import BytesIO
+
+from pydicom import dcmread
+from pydicom.uid import (
+    DeflatedExplicitVRLittleEndian,
+    ExplicitVRLittleEndian,
+    ImplicitVRLittleEndian,
+    RLELossless,
+)
+
+# At-rest compression methods, both lossless and encoded by pydicom itself
+METHODS = {"deflate": DeflatedExplicitVRLittleEndian, "rle": RLELossless}
+
+UNCOMPRESSED = (ExplicitVRLittleEndian, ImplicitVRLittleEndian)
+
+
+def decoded_frames(transfer_syntax_uid, stored_transfer_syntax_uid):
+    """
+    Whether the frames of an instance are served from its decoded dataset
+    rather than read at file offsets: compacted and deflated files.
+    """
+    return (
+        bool(stored_transfer_syntax_uid)
+        or transfer_syntax_uid == DeflatedExplicitVRLittleEndian
+    )
+
+
+def _encode_as(dataset, method):
+    if method == "rle" and "PixelData" in dataset:
+        try:
+            dataset.compress(RLELossless, generate_instance_uid=False)
+            return
+        except (ValueError, RuntimeError) as e:
+            # e.g. a bit depth RLE can't encode, deflate the dataset instead
+            print(f" RLE compression failed, deflating instead: {e}")
+    dataset.file_meta.TransferSyntaxUID = DeflatedExplicitVRLittleEndian
+
+
+def compress_file(path, method):
+    """
+    Re-encode an uncompressed stored file in place with `method`.
+
+    Returns the Instance fields describing the stored file, or None when
+    compression wouldn't make it smaller and the file was left as is.
+    """
+    if method not in METHODS:
+        raise ValueError(f"Unknown compression method '{method}'")
+    dataset = dcmread(path)
+    if dataset.file_meta.TransferSyntaxUID not in UNCOMPRESSED:
+        raise ValueError(f"{path} is already compressed")
+
+    original_size = os.path.getsize(path)
+    _encode_as(dataset, method)
+    part_path = f"{path}.{uuid.uuid4().hex}.part"
+    try:
+        dataset.save_as(part_path, enforce_file_format=True)
+        stored_size = os.path.getsize(part_path)
+        if stored_size >= original_size:
+            os.remove(part_path)
+            return None
+        os.replace(part_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(part_path)
+        raise
+
+    return {
+        "stored_transfer_syntax_uid": str(dataset.file_meta.TransferSyntaxUID),
+        "original_size": original_size,
+        "stored_size": stored_size,
+        "compression_ratio": round(original_size / stored_size, 3),
+    }
+
+
+def restore(path, transfer_syntax_uid):
+    """
+    Read a stored file back as the dataset that was received, in
+    `transfer_syntax_uid`, undoing any at-rest compression.
+    """
+    dataset = dcmread(path)
+    if dataset.file_meta.TransferSyntaxUID == RLELossless != transfer_syntax_uid:
+        dataset.decompress(as_rgb=False, generate_instance_uid=False)
+    # Deflated datasets are inflated by dcmread, only the label is left
+    dataset.file_meta.TransferSyntaxUID = transfer_syntax_uid
+    return dataset
+
+
+def encode(dataset):
+    """Return a dataset encoded as a DICOM file, in its own transfer syntax."""
+    buffer = BytesIO()
+    dataset.save_as(buffer, enforce_file_format=True)
+    return buffer.getvalue()
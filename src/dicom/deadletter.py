@@ -0,0 +1,258 @@
+import contextlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+
+from django.db import DatabaseError, close_old_connections, connection
+
+from dicom import indexing, storage
+from dicom.models import Instance
+
+
+class DeadLetterQueue:
+    """
+    Instances that failed to be persisted, kept on disk with the reason
+    they failed until a retry gets them stored
+
+    Entries live in `directory`, outside the database since a database
+    outage is the usual cause, as `<id>.dcm` with the instance's data and
+    `<id>.json` with its storage name, index attributes, failure reason
+    and attempts. Retries back off exponentially from `backoff` up to
+    `max_backoff` seconds. After `max_attempts` failures an entry is
+    parked and only replayed on request.
+    """
+
+    def __init__(self, directory, max_attempts, backoff, max_backoff):
+        self.directory = str(directory)
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add(self, item, reason):
+        """
+        Keep a failed IngestItem, or count another failed attempt of one
+        being retried. Returns False when its data couldn't be kept.
+        """
+        if item.dead_letter is not None:
+            meta = self.load(item.dead_letter)
+            if meta is None:
+                return False
+            meta["attempts"] += 1
+            meta["reason"] = reason
+            meta["failed_at"] = time.time()
+            meta["next_attempt_at"] = time.time() + self.delay(meta["attempts"])
+            self._write_meta(item.dead_letter, meta)
+            return True
+
+        entry_id = uuid.uuid4().hex
+        os.makedirs(self.directory, exist_ok=True)
+        data_path = self._path(entry_id, "dcm")
+        try:
+            try:
+                _link_or_copy(storage.absolute_path(item.image_path), data_path)
+            except OSError:
+                if item.record is None:
+                    raise
+                # Failed before it was materialized
+                item.record.copy_to(data_path)
+        except OSError as e:
+            print(f" Unable to keep failed {item.image_path}: {e}")
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(data_path)
+            return False
+
+        now = time.time()
+        self._write_meta(
+            entry_id,
+            {
+                "name": item.image_path,
+                "attributes": indexing.dump_attributes(item.attributes),
+                "reason": reason,
+                "attempts": 1,
+                "created_at": now,
+                "failed_at": now,
+                "next_attempt_at": now + self.delay(1),
+            },
+        )
+        return True
+
+    def delay(self, attempts):
+        return min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+
+    def entries(self):
+        """Return [(id, meta), ...] of every entry, oldest failure first."""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        entries = []
+        for name in names:
+            if name.endswith(".json"):
+                entry_id = name[: -len(".json")]
+                meta = self.load(entry_id)
+                if meta is not None:
+                    entries.append((entry_id, meta))
+        return sorted(entries, key=lambda entry: entry[1]["failed_at"])
+
+    def due(self, now=None):
+        """Return the ids of the entries whose next retry is due."""
+        now = time.time() if now is None else now
+        return [
+            entry_id
+            for entry_id, meta in self.entries()
+            if meta["attempts"] < self.max_attempts and meta["next_attempt_at"] <= now
+        ]
+
+    def load(self, entry_id):
+        try:
+            with open(self._path(entry_id, "json")) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def remove(self, entry_id):
+        for extension in ("json", "dcm"):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self._path(entry_id, extension))
+
+    def stale(self, meta):
+        """
+        Whether an entry's instance was stored since it failed, or already
+        is with the same content, so its data mustn't be put back.
+        """
+        instance = meta["attributes"]["instance"]
+        row = (
+            Instance.objects.filter(sop_instance_uid=instance["sop_instance_uid"])
+            .values_list("content_hash", "updated_at")
+            .first()
+        )
+        if row is None:
+            return False
+        content_hash, updated_at = row
+        if content_hash and content_hash == instance.get("content_hash"):
+            return True
+        return updated_at.timestamp() > meta.get("created_at", meta["failed_at"])
+
+    def redrive(self, ingest_queue, entry_ids):
+        """
+        Put entries back into storage and onto `ingest_queue`. Each stays
+        until its batch is committed, the ingest queue removing it then.
+        Entries superseded by a later copy of their instance are dropped
+        instead of overwriting it.
+
+        Returns the IngestItems queued.
+        """
+        from dicom.ingest import IngestItem
+
+        items = []
+        for entry_id in entry_ids:
+            meta = self.load(entry_id)
+            if meta is None:
+                continue
+            try:
+                stale = self.stale(meta)
+            except DatabaseError as e:
+                print(f" Index unavailable, retry postponed: {e}")
+                break
+            if stale:
+                print(f" Dropping dead-lettered {meta['name']}, stored again since")
+                self.remove(entry_id)
+                continue
+            # Not picked up again while in flight
+            meta["next_attempt_at"] = time.time() + self.delay(meta["attempts"])
+            self._write_meta(entry_id, meta)
+
+            part_path = self._path(f"{entry_id}.{uuid.uuid4().hex}", "part")
+            try:
+                _link_or_copy(self._path(entry_id, "dcm"), part_path)
+                storage.move_into_place(part_path, meta["name"])
+            except OSError as e:
+                print(f" Unable to restore dead-lettered {meta['name']}: {e}")
+                continue
+            finally:
+                # Left behind when the stored file is a link to the same data
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(part_path)
+
+            item = IngestItem(
+                meta["name"],
+                indexing.load_attributes(meta["attributes"]),
+                dead_letter=entry_id,
+            )
+            if not ingest_queue.put(item):
+                print(" Ingest queue full, retry postponed")
+                break
+            items.append(item)
+        return items
+
+    def start(self, ingest_queue, interval):
+        """Retry due entries every `interval` seconds on a background thread."""
+        self._thread = threading.Thread(
+            target=self._retry,
+            args=(ingest_queue, interval),
+            name="DeadLetterRetry",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _retry(self, ingest_queue, interval):
+        try:
+            while not self._stop.wait(interval):
+                # A connection the database dropped is reopened next pass
+                close_old_connections()
+                try:
+                    due = self.due()
+                    if due:
+                        print(f" Retrying {len(due)} dead-lettered instances ...")
+                        self.redrive(ingest_queue, due)
+                except Exception as e:
+                    print(f" Error retrying dead-lettered instances: {e}")
+                finally:
+                    close_old_connections()
+        finally:
+            connection.close()
+
+    def _path(self, entry_id, extension):
+        return os.path.join(self.directory, f"{entry_id}.{extension}")
+
+    def _write_meta(self, entry_id, meta):
+        path = self._path(entry_id, "json")
+        part_path = f"{path}.{uuid.uuid4().hex}.part"
+        with open(part_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(part_path, path)
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+_dead_letters = None
+
+
+def dead_letters():
+    """Return this process's DeadLetterQueue."""
+    from django.conf import settings
+
+    global _dead_letters
+    if _dead_letters is None:
+        _dead_letters = DeadLetterQueue(
+            settings.DICOM_DEAD_LETTER_DIR,
+            settings.DICOM_DEAD_LETTER_MAX_ATTEMPTS,
+            settings.DICOM_DEAD_LETTER_BACKOFF,
+            settings.DICOM_DEAD_LETTER_MAX_BACKOFF,
+        )
+    return _dead_letters
@@ -0,0 +1,79 @@
+import hashlib
+
+from django.conf import settings
+from django.db import DatabaseError
+
+from dicom import storage
+from dicom.models import Instance
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def new_hash():
+    """Return a streaming BLAKE2b hash object for instance content."""
+    return hashlib.blake2b(digest_size=32)
+
+
+def hash_bytes(data):
+    content_hash = new_hash()
+    content_hash.update(data)
+    return content_hash.hexdigest()
+
+
+def hash_file(path):
+    """Hash a file's content, reading it in HASH_CHUNK_SIZE chunks."""
+    content_hash = new_hash()
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+
+def storage_target(dataset, content_hash):
+    """
+    Decide where a received instance is stored, looking its
+    SOPInstanceUID up in the index.
+
+    Returns the storage name, or None when nothing needs writing: the same
+    content is already stored, or DICOM_DUPLICATE_POLICY is "keep".
+    While the index is unavailable the instance is stored without the
+    lookup, to be indexed once it is back. Raises storage.InvalidUID for
+    UIDs that can't name a file.
+    """
+    patient_id = dataset.get("PatientID", "UnknownID")
+    study_instance_uid = dataset.get("StudyInstanceUID", "")
+    series_instance_uid = dataset.get("SeriesInstanceUID", "")
+    sop_instance_uid = dataset.get("SOPInstanceUID", "UnknownSOP").strip()
+    uids = (patient_id, study_instance_uid, series_instance_uid, sop_instance_uid)
+    policy = settings.DICOM_DUPLICATE_POLICY
+    try:
+        stored_hash = (
+            Instance.objects.filter(sop_instance_uid=sop_instance_uid)
+            .values_list("content_hash", flat=True)
+            .first()
+        )
+    except DatabaseError as e:
+        print(f" Unable to look {sop_instance_uid} up, storing it anyway: {e}")
+        if policy == "version":
+            # Never overwrites a stored version
+            return storage.storage_name(*uids, content_hash[:16])
+        name = storage.storage_name(*uids)
+        if policy == "keep" and storage.backend().exists(name):
+            return None
+        return name
+
+    if not stored_hash:
+        # New, or indexed before content hashes were recorded
+        return storage.storage_name(*uids)
+
+    if stored_hash == content_hash:
+        print(f" Duplicate of stored {sop_instance_uid}, nothing to write")
+        return None
+
+    print(f" {sop_instance_uid} re-sent with different content ({policy})")
+    if policy == "keep":
+        return None
+    if policy == "version":
+        # The stored file stays where it is, as the previous version
+        return storage.storage_name(*uids, content_hash[:16])
+    return storage.storage_name(*uids)
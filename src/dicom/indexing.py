@@ -0,0 +1,244 @@
+from collections import Counter
+from datetime import date, datetime
+
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+from dicom.models import Image_Upload, Instance, InstanceVersion, Patient, Series, Study
+
+# Instance fields describing the stored file, replaced when it is re-sent
+FILE_FIELDS = [
+    "transfer_syntax_uid",
+    "stored_transfer_syntax_uid",
+    "original_size",
+    "stored_size",
+    "compression_ratio",
+    "content_hash",
+]
+
+
+# Index attributes holding dates, kept as ISO strings in JSON
+DATE_FIELDS = [
+    ("patient", "birth_date"),
+    ("study", "study_date"),
+    ("series", "series_date"),
+]
+
+
+def _text(dataset, keyword, default=""):
+    value = dataset.get(keyword)
+    return default if value is None or value == "" else str(value).strip()
+
+
+def _int(dataset, keyword):
+    try:
+        return int(dataset.get(keyword))
+    except (TypeError, ValueError):
+        return None
+
+
+def _date(dataset, keyword):
+    try:
+        return datetime.strptime(_text(dataset, keyword), "%Y%m%d").date()
+    except ValueError:
+        return None
+
+
+def index_attributes(dataset):
+    """
+    Extract the Patient/Study/Series/Instance index values of a dataset
+    into plain Python values, so queued items don't keep the dataset alive.
+    """
+    file_meta = getattr(dataset, "file_meta", {})
+    return {
+        "patient": {
+            "patient_id": _text(dataset, "PatientID", "UnknownID"),
+            "patient_name": _text(dataset, "PatientName"),
+            "birth_date": _date(dataset, "PatientBirthDate"),
+            "sex": _text(dataset, "PatientSex"),
+        },
+        "study": {
+            "study_instance_uid": _text(dataset, "StudyInstanceUID"),
+            "study_date": _date(dataset, "StudyDate"),
+            "study_time": _text(dataset, "StudyTime"),
+            "accession_number": _text(dataset, "AccessionNumber"),
+            "study_id": _text(dataset, "StudyID"),
+            "study_description": _text(dataset, "StudyDescription"),
+            "referring_physician_name": _text(dataset, "ReferringPhysicianName"),
+        },
+        "series": {
+            "series_instance_uid": _text(dataset, "SeriesInstanceUID"),
+            "modality": _text(dataset, "Modality"),
+            "series_number": _int(dataset, "SeriesNumber"),
+            "series_date": _date(dataset, "SeriesDate"),
+            "series_description": _text(dataset, "SeriesDescription"),
+            "body_part_examined": _text(dataset, "BodyPartExamined"),
+        },
+        "instance": {
+            "sop_instance_uid": _text(dataset, "SOPInstanceUID"),
+            "sop_class_uid": _text(dataset, "SOPClassUID"),
+            "transfer_syntax_uid": _text(file_meta, "TransferSyntaxUID"),
+            "stored_transfer_syntax_uid": "",
+            "original_size": None,
+            "stored_size": None,
+            "compression_ratio": None,
+            "content_hash": "",
+            "instance_number": _int(dataset, "InstanceNumber"),
+            "rows": _int(dataset, "Rows"),
+            "columns": _int(dataset, "Columns"),
+            "number_of_frames": _int(dataset, "NumberOfFrames"),
+        },
+    }
+
+
+def dump_attributes(attributes):
+    """Return a JSON-serializable copy of index attributes."""
+    dumped = {level: dict(fields) for level, fields in attributes.items()}
+    for level, field in DATE_FIELDS:
+        if dumped[level][field] is not None:
+            dumped[level][field] = dumped[level][field].isoformat()
+    return dumped
+
+
+def load_attributes(dumped):
+    """Inverse of `dump_attributes()`."""
+    attributes = {level: dict(fields) for level, fields in dumped.items()}
+    for level, field in DATE_FIELDS:
+        if attributes[level][field] is not None:
+            attributes[level][field] = date.fromisoformat(attributes[level][field])
+    return attributes
+
+
+def _get_or_create(model, uid_field, rows):
+    """
+    Make sure a row exists for every UID in `rows` ({uid: field values}).
+
+    Returns ({uid: pk}, {pks created by this call}). Primary keys are
+    generated client side, so rows a concurrent writer got in first are
+    told apart from ours without a per-row round trip.
+    """
+    pks = dict(
+        model.objects.filter(**{f"{uid_field}__in": rows}).values_list(uid_field, "pk")
+    )
+    new = [model(**fields) for uid, fields in rows.items() if uid not in pks]
+    if not new:
+        return pks, set()
+
+    model.objects.bulk_create(new, ignore_conflicts=True)
+    created = set(
+        model.objects.filter(pk__in=[obj.pk for obj in new]).values_list(
+            "pk", flat=True
+        )
+    )
+    pks.update(
+        model.objects.filter(
+            **{f"{uid_field}__in": [getattr(obj, uid_field) for obj in new]}
+        ).values_list(uid_field, "pk")
+    )
+    return pks, created
+
+
+def _increment(model, field, counts):
+    for pk, amount in counts.items():
+        model.objects.filter(pk=pk).update(**{field: F(field) + amount})
+
+
+def index_instances(entries):
+    """
+    Add a batch of stored instances to the Patient/Study/Series/Instance
+    index and bump the denormalized counts by what was actually inserted.
+
+    `entries` is a list of (attributes, Image_Upload) pairs, attributes as
+    returned by `index_attributes()`. Must run inside a transaction.
+    """
+    patients, studies, series, instances = {}, {}, {}, {}
+    for attributes, upload in entries:
+        patient = attributes["patient"]
+        study = attributes["study"]
+        serie = attributes["series"]
+        instance = attributes["instance"]
+        patients.setdefault(patient["patient_id"], patient)
+        studies.setdefault(study["study_instance_uid"], (patient["patient_id"], study))
+        series.setdefault(
+            serie["series_instance_uid"], (study["study_instance_uid"], serie)
+        )
+        instances[instance["sop_instance_uid"]] = (
+            serie["series_instance_uid"],
+            instance,
+            upload,
+        )
+
+    patient_pks, _ = _get_or_create(Patient, "patient_id", patients)
+    study_pks, new_studies = _get_or_create(
+        Study,
+        "study_instance_uid",
+        {
+            uid: {**fields, "patient_id": patient_pks[parent]}
+            for uid, (parent, fields) in studies.items()
+        },
+    )
+    series_pks, new_series = _get_or_create(
+        Series,
+        "series_instance_uid",
+        {
+            uid: {**fields, "study_id": study_pks[parent]}
+            for uid, (parent, fields) in series.items()
+        },
+    )
+    instance_pks, new_instances = _get_or_create(
+        Instance,
+        "sop_instance_uid",
+        {
+            uid: {**fields, "series_id": series_pks[parent], "image": upload}
+            for uid, (parent, fields, upload) in instances.items()
+        },
+    )
+
+    # Re-sent instances keep their index row but point at the newest file
+    resent = {pk: uid for uid, pk in instance_pks.items() if pk not in new_instances}
+    previous = Instance.objects.filter(pk__in=resent).values_list(
+        "pk", "image_id", "image__image", "content_hash"
+    )
+    versions, superseded = [], []
+    for pk, image_id, name, content_hash in previous:
+        upload = instances[resent[pk]][2]
+        if image_id is None or image_id == upload.pk:
+            continue
+        if settings.DICOM_DUPLICATE_POLICY == "version":
+            versions.append(
+                InstanceVersion(
+                    instance_id=pk, image_id=image_id, content_hash=content_hash
+                )
+            )
+        elif name != upload.image.name:
+            # django-cleanup removes the file along with the upload, so only
+            # uploads of files nothing points at any more can go
+            superseded.append(image_id)
+    for pk, uid in resent.items():
+        _, instance, upload = instances[uid]
+        Instance.objects.filter(pk=pk).update(
+            image=upload,
+            # update() skips auto_now, and the dead-letter queue goes by it
+            updated_at=timezone.now(),
+            **{field: instance[field] for field in FILE_FIELDS},
+        )
+    InstanceVersion.objects.bulk_create(versions)
+    Image_Upload.objects.filter(pk__in=superseded).delete()
+
+    study_of_series = {series_pks[uid]: study_pks[s[0]] for uid, s in series.items()}
+    patient_of_study = {study_pks[uid]: patient_pks[s[0]] for uid, s in studies.items()}
+    series_of_instance = {
+        instance_pks[uid]: series_pks[i[0]] for uid, i in instances.items()
+    }
+
+    instances_per_series = Counter(series_of_instance[pk] for pk in new_instances)
+    instances_per_study = Counter()
+    for pk, amount in instances_per_series.items():
+        instances_per_study[study_of_series[pk]] += amount
+    _increment(Series, "instance_count", instances_per_series)
+    _increment(Study, "instance_count", instances_per_study)
+    _increment(Study, "series_count", Counter(study_of_series[pk] for pk in new_series))
+    _increment(
+        Patient, "study_count", Counter(patient_of_study[pk] for pk in new_studies)
+    )
@@ -0,0 +1,478 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from django.conf import settings
+from django.db import OperationalError, close_old_connections, connection, transaction
+from pydicom.errors import InvalidDicomError
+
+from dicom import compression, deadletter, indexing, pixeldata, segments, storage
+from dicom.models import FrameOffsetTable, Image_Upload, PackedInstance
+
+
+def frame_offset_table(image_path, attributes):
+    """
+    Return the FrameOffsetTable fields of a stored file, or None when it
+    has no (readable) pixel data or its frames are served decoded.
+    """
+    instance = attributes["instance"]
+    if compression.decoded_frames(
+        instance["transfer_syntax_uid"], instance["stored_transfer_syntax_uid"]
+    ):
+        return None
+    try:
+        offset, length, frames = pixeldata.frame_table(
+            storage.absolute_path(image_path)
+        )
+    except pixeldata.NoPixelData:
+        return None
+    except (OSError, ValueError, InvalidDicomError) as e:
+        print(f" No frame offsets for {image_path}: {e}")
+        return None
+    return {"pixel_data_offset": offset, "pixel_data_length": length, "frames": frames}
+
+
+def compress(image_path, attributes, method):
+    """
+    Compress an uncompressed stored file at rest, recording the result in
+    its index attributes. Files that fail to compress are kept as received.
+    """
+    instance = attributes["instance"]
+    if instance["transfer_syntax_uid"] not in compression.UNCOMPRESSED:
+        return
+    try:
+        fields = compression.compress_file(storage.absolute_path(image_path), method)
+    except (OSError, ValueError, RuntimeError, InvalidDicomError) as e:
+        print(f" Unable to compress {image_path}: {e}")
+        return
+    if fields is not None:
+        storage.updated(image_path)
+        instance.update(fields)
+
+
+class IngestItem:
+    """
+    A received instance waiting to be persisted, with its index attributes
+
+    `committed` resolves once the batch holding this item has been
+    committed, or carries the exception that made the batch fail. Items
+    with a journal `record` are only written to storage when persisted.
+
+    `dead_letter` is the dead-letter entry an item is retried from, and
+    `dead_lettered` is set once a failed item was kept there for retry.
+    `size` is the instance's size in bytes, counted as in flight until
+    its batch is done.
+    """
+
+    def __init__(self, image_path, attributes, record=None, dead_letter=None, size=0):
+        self.image_path = image_path
+        self.attributes = attributes
+        self.record = record
+        self.dead_letter = dead_letter
+        self.size = size
+        self.dead_lettered = False
+        self.enqueued_at = time.monotonic()
+        self.committed = Future()
+
+
+class IngestQueue:
+    """
+    Bounded in-process queue between the C-STORE handler and a pool of
+    persistence workers.
+
+    The association thread only pays for a `put()`; database writes happen
+    on the worker threads so a slow database no longer delays the C-STORE
+    response. Each worker groups queued items into batches of up to
+    `batch_size`, waiting at most `flush_interval` seconds after the first
+    item, and writes every batch, uploads and index rows, in a single
+    `bulk_create` transaction.
+
+    `on_persisted`, when given, is called with every committed batch on
+    the worker thread, for stages that follow persistence. `compression`
+    ("deflate" or "rle") compresses uncompressed files before they are
+    indexed. Files of up to DICOM_PACK_MAX_SIZE bytes are then appended to
+    a segment file, and removed once the batch is committed.
+
+    With a `journal`, the workers are its materializer: journaled items
+    are copied from the journal to storage, and completed in the journal
+    once their batch is committed.
+
+    Items of a failed batch are retried one by one, so one bad instance
+    doesn't fail the others, unless the database is unavailable. Those
+    that still fail are kept in `dead_letters` for retry, when given.
+    """
+
+    def __init__(
+        self,
+        maxsize=1000,
+        workers=4,
+        put_timeout=5.0,
+        batch_size=200,
+        flush_interval=0.05,
+        on_persisted=None,
+        compression=None,
+        journal=None,
+        dead_letters=None,
+    ):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.maxsize = maxsize
+        self.workers = workers
+        self.put_timeout = put_timeout
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.on_persisted = on_persisted
+        self.compression = compression
+        self.journal = journal
+        self.dead_letters = dead_letters
+
+        self._threads = []
+        self._lock = threading.Lock()
+        self._started_at = None
+        self._busy = [0.0] * workers
+        self._counters = {
+            "enqueued": 0,
+            "rejected": 0,
+            "persisted": 0,
+            "failed": 0,
+            "dead_lettered": 0,
+            "batches": 0,
+        }
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._inflight_bytes = 0
+
+    def start(self):
+        self._started_at = time.monotonic()
+        for index in range(self.workers):
+            thread = threading.Thread(
+                target=self._worker,
+                args=(index,),
+                name=f"IngestWorker-{index}",
+                daemon=True,
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        """Let the workers drain the queue, then stop them."""
+        for _ in self._threads:
+            self.queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def put(self, item, block=False):
+        """
+        Queue an item for persistence, waiting for room as long as it takes
+        when `block` is set.
+
+        Returns False if the queue stayed full for `put_timeout` seconds.
+        """
+        try:
+            self.queue.put(item, timeout=None if block else self.put_timeout)
+        except queue.Full:
+            self._count("rejected")
+            return False
+        with self._lock:
+            self._counters["enqueued"] += 1
+            self._inflight_bytes += item.size
+        return True
+
+    def depth(self):
+        """Return the fraction of the queue in use."""
+        return self.queue.qsize() / self.maxsize
+
+    def inflight_bytes(self):
+        """Return the size of the queued items and of those being persisted."""
+        with self._lock:
+            return self._inflight_bytes
+
+    def persist(self, items):
+        # Done outside the transaction, nothing here touches the database
+        for item in items:
+            if item.record is not None:
+                self.journal.materialize(item.record, item.image_path)
+        if self.compression:
+            for item in items:
+                compress(item.image_path, item.attributes, self.compression)
+        tables = {
+            item.image_path: frame_offset_table(item.image_path, item.attributes)
+            for item in items
+        }
+        paths, packed = {}, {}
+        if segments.enabled():
+            paths = {name: storage.backend().path(name) for name in tables}
+            packed = segments.pack(paths)
+        # Files replaced in place keep their upload row. Looked up before the
+        # transaction so it starts with a write (SQLite can't upgrade a read)
+        uploads = {
+            name: Image_Upload(pk=pk, image=name)
+            for name, pk in Image_Upload.objects.filter(image__in=tables).values_list(
+                "image", "pk"
+            )
+        }
+        with transaction.atomic():
+            reused = [upload.pk for upload in uploads.values()]
+            FrameOffsetTable.objects.filter(image__in=reused).delete()
+            PackedInstance.objects.filter(image__in=reused).delete()
+            new = {
+                name: Image_Upload(image=name) for name in tables if name not in uploads
+            }
+            Image_Upload.objects.bulk_create(new.values())
+            uploads.update(new)
+
+            indexing.index_instances(
+                [(item.attributes, uploads[item.image_path]) for item in items]
+            )
+            FrameOffsetTable.objects.bulk_create(
+                [
+                    FrameOffsetTable(image=uploads[name], **table)
+                    for name, table in tables.items()
+                    if table is not None
+                ]
+            )
+            PackedInstance.objects.bulk_create(
+                [
+                    PackedInstance(
+                        image=uploads[name],
+                        segment=segment,
+                        offset=offset,
+                        length=length,
+                    )
+                    for name, (segment, offset, length, _) in packed.items()
+                ]
+            )
+        segments.remove_packed(paths, packed)
+
+    def stats(self):
+        uptime = time.monotonic() - self._started_at if self._started_at else 0.0
+        with self._lock:
+            counters = dict(self._counters)
+            dequeued = counters["persisted"] + counters["failed"]
+            wait_avg = self._wait_total / dequeued if dequeued else 0.0
+            batch_avg = dequeued / counters["batches"] if counters["batches"] else 0.0
+            busy = list(self._busy)
+            inflight_bytes = self._inflight_bytes
+        if self.journal is not None:
+            counters.update(self.journal.stats())
+        return {
+            **counters,
+            "batch_avg": round(batch_avg, 1),
+            "inflight_bytes": inflight_bytes,
+            "queue_depth": self.queue.qsize(),
+            "queue_size": self.maxsize,
+            "wait_avg_ms": round(wait_avg * 1000, 2),
+            "wait_max_ms": round(self._wait_max * 1000, 2),
+            "worker_utilisation": [
+                round(seconds / uptime, 3) if uptime else 0.0 for seconds in busy
+            ],
+        }
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+    def _next_batch(self):
+        """
+        Block for the first item, then keep collecting until the batch is
+        full or the flush deadline passes.
+
+        Returns the batch and whether the stop sentinel was seen.
+        """
+        item = self.queue.get()
+        if item is None:
+            return [], True
+        batch = [item]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _worker(self, index):
+        try:
+            stopping = False
+            while not stopping:
+                batch, stopping = self._next_batch()
+                if not batch:
+                    continue
+                started = time.monotonic()
+                close_old_connections()
+                try:
+                    self.persist(batch)
+                except Exception as e:
+                    print(f" Error saving {len(batch)} DICOM files: {e}")
+                    if len(batch) > 1 and not isinstance(e, OperationalError):
+                        persisted = self._persist_each(batch)
+                    else:
+                        persisted = []
+                        self._failed(batch, e)
+                else:
+                    persisted = batch
+                if persisted:
+                    self._committed(persisted)
+                with self._lock:
+                    self._counters["batches"] += 1
+                    self._inflight_bytes -= sum(item.size for item in batch)
+                    self._busy[index] += time.monotonic() - started
+                    for item in batch:
+                        waited = started - item.enqueued_at
+                        self._wait_total += waited
+                        self._wait_max = max(self._wait_max, waited)
+        finally:
+            connection.close()
+
+    def _persist_each(self, batch):
+        """Persist the items of a failed batch one by one."""
+        persisted = []
+        for item in batch:
+            close_old_connections()
+            try:
+                self.persist([item])
+            except Exception as e:
+                print(f" Error saving DICOM file {item.image_path}: {e}")
+                self._failed([item], e)
+            else:
+                persisted.append(item)
+        return persisted
+
+    def _committed(self, items):
+        self._count("persisted", len(items))
+        for item in items:
+            if item.record is not None:
+                self.journal.complete(item.record)
+            if item.dead_letter is not None:
+                self.dead_letters.remove(item.dead_letter)
+            item.committed.set_result(True)
+        if self.on_persisted is not None:
+            try:
+                self.on_persisted(items)
+            except Exception as e:
+                print(f" Error in post-persist stage: {e}")
+
+    def _failed(self, items, error):
+        """
+        Keep failed items in the dead-letter queue before their failure is
+        reported, so their senders can be told they will be stored.
+        """
+        self._count("failed", len(items))
+        for item in items:
+            if self.dead_letters is not None:
+                kept = self.dead_letters.add(item, f"{type(error).__name__}: {error}")
+                if kept and item.dead_letter is None:
+                    item.dead_lettered = True
+                    self._count("dead_lettered")
+                    if item.record is not None:
+                        # Replayed from the dead-letter queue instead
+                        self.journal.complete(item.record)
+            item.committed.set_exception(error)
+
+
+def enqueue(ingest_queue, image_path, dataset, content_hash="", size=0):
+    """
+    Queue a stored instance of `size` bytes for indexing.
+
+    Returns the IngestItem, or None when the queue stayed full.
+    """
+    attributes = indexing.index_attributes(dataset)
+    attributes["instance"]["content_hash"] = content_hash
+    item = IngestItem(image_path, attributes, size=size)
+    if not ingest_queue.put(item):
+        print(f" Ingest queue full, rejecting DICOM file: {image_path}")
+        return None
+    return item
+
+
+def journal_status(
+    ingest_queue, image_path, dataset, content_hash, data=None, path=None
+):
+    """
+    Append a received instance, `data` or the file at `path`, to the
+    ingest queue's journal and queue it for materialization.
+
+    Returns the DICOM status: success once the journal record is durable,
+    the instance is then stored even if the process dies before that.
+    """
+    attributes = indexing.index_attributes(dataset)
+    attributes["instance"]["content_hash"] = content_hash
+    try:
+        record = ingest_queue.journal.append(
+            {"name": image_path, "attributes": attributes}, data, path
+        )
+    except OSError as e:
+        print(f" Error journaling DICOM file: {e}")
+        return 0x0112
+
+    item = IngestItem(image_path, attributes, record, size=record.length)
+    if not ingest_queue.put(item):
+        print(f" Ingest queue full, rejecting DICOM file: {image_path}")
+        # Refused, so it mustn't be stored on replay either
+        ingest_queue.journal.complete(record)
+        return 0xA700
+    return 0x0000
+
+
+def replay(ingest_queue, records):
+    """Queue the journal records left over by the previous run."""
+    for record in records:
+        item = IngestItem(
+            record.meta["name"], record.meta["attributes"], record, size=record.length
+        )
+        ingest_queue.put(item, block=True)
+
+
+def commit_status(item):
+    """
+    Return the DICOM status of a queued item, waiting for its batch to be
+    committed when DICOM_INGEST_ACK_ON_COMMIT is set.
+    """
+    if item is None:
+        # Refused: Out of Resources
+        return 0xA700
+    if not settings.DICOM_INGEST_ACK_ON_COMMIT:
+        return 0x0000
+
+    try:
+        item.committed.result(timeout=settings.DICOM_INGEST_COMMIT_TIMEOUT)
+        print(f"Saved DICOM file: {item.image_path}")
+        return 0x0000
+    except Exception as e:
+        if item.dead_lettered:
+            print(f" DICOM file kept for retry: {item.image_path} ({e})")
+            return 0x0000
+        print(f" Error saving DICOM file: {e}")
+        return 0x0112
+
+
+_shared_queue = None
+_shared_queue_lock = threading.Lock()
+
+
+def shared_queue():
+    """
+    Return this process's IngestQueue for instances received outside the
+    DICOM receiver (e.g. STOW-RS), starting it on first use.
+    """
+    global _shared_queue
+    with _shared_queue_lock:
+        if _shared_queue is None:
+            _shared_queue = IngestQueue(
+                maxsize=settings.DICOM_INGEST_QUEUE_SIZE,
+                workers=settings.DICOM_INGEST_WORKERS,
+                put_timeout=settings.DICOM_INGEST_QUEUE_TIMEOUT,
+                batch_size=settings.DICOM_INGEST_BATCH_SIZE,
+                flush_interval=settings.DICOM_INGEST_FLUSH_INTERVAL,
+                compression=settings.DICOM_INGEST_COMPRESSION,
+                dead_letters=deadletter.dead_letters(),
+            )
+            _shared_queue.start()
+        return _shared_queue
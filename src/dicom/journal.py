@@ -0,0 +1,378 @@
+import contextlib
+import fcntl
+import json
+import os
+import struct
+import threading
+import uuid
+import zlib
+
+from dicom import indexing, storage
+
+# magic, CRC-32 of meta and data, meta length, data length
+RECORD_HEADER = struct.Struct("<4sIIQ")
+RECORD_MAGIC = b"RLJ1"
+COPY_CHUNK_SIZE = 1024 * 1024
+CHECKPOINT_FILE = "checkpoint"
+
+
+class JournalRecord:
+    """
+    A received instance as appended to the journal: `lsn` is its position
+    in the journal, the data is `length` bytes at `offset` in `path`.
+    """
+
+    def __init__(self, lsn, path, offset, length, meta):
+        self.lsn = lsn
+        self.path = path
+        self.offset = offset
+        self.length = length
+        self.meta = meta
+
+    def copy_to(self, path):
+        """Write the record's data to a new file at `path`."""
+        with open(self.path, "rb") as src, open(path, "wb") as dst:
+            src.seek(self.offset)
+            remaining = self.length
+            while remaining > 0:
+                chunk = src.read(min(COPY_CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise OSError(f"{self.path} is shorter than expected")
+                dst.write(chunk)
+                remaining -= len(chunk)
+
+
+def _file_name(lsn):
+    return f"{lsn:020d}.journal"
+
+
+def _pwrite(fd, data, offset):
+    view, written = memoryview(data), 0
+    while written < len(view):
+        written += os.pwrite(fd, view[written:], offset + written)
+
+
+def _fsync_paths(paths):
+    """fsync files, then the directories holding their names."""
+    directories = set()
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            # Since moved elsewhere (e.g. packed), which synced it
+            continue
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        directories.add(os.path.dirname(path))
+    for directory in directories:
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def _encode_meta(meta):
+    meta = {**meta, "attributes": indexing.dump_attributes(meta["attributes"])}
+    return json.dumps(meta).encode()
+
+
+def _decode_meta(data):
+    meta = json.loads(data)
+    meta["attributes"] = indexing.load_attributes(meta["attributes"])
+    return meta
+
+
+class Journal:
+    """
+    Write-ahead journal of received instances
+
+    Each instance is appended, data and index attributes, to the current
+    journal file and `append()` returns once it is durable. Appenders that
+    arrive while a sync is running are covered together by the next one,
+    so concurrent associations share fsyncs instead of each paying for a
+    file create.
+
+    Records are replayed from the checkpoint on startup. The checkpoint
+    is the lowest record not yet `complete()`, moved forward every
+    `checkpoint_interval` seconds once the files materialized from
+    completed records were synced to disk. Journal files wholly before it
+    are removed.
+    """
+
+    def __init__(self, directory, file_size, checkpoint_interval):
+        self.directory = str(directory)
+        self.file_size = file_size
+        self.checkpoint_interval = checkpoint_interval
+
+        self._lock = threading.Lock()
+        self._sync = threading.Condition()
+        self._syncing = False
+        self._synced = 0
+        self._fd = None
+        self._retired = []
+        self._start = 0
+        self._written = 0
+        self._pending = set()
+        # lsn -> path of materialized records not synced yet
+        self._materialized = {}
+        self._checkpoint = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._dir_fd = None
+
+    def open(self):
+        """
+        Lock the journal directory, recover it and start a new journal
+        file. Returns the records to replay, oldest first.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        self._dir_fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            fcntl.flock(self._dir_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise RuntimeError(f"Journal {self.directory} is in use")
+
+        for name in os.listdir(self.directory):
+            if name.endswith(".part"):
+                # Left over by an interrupted materialization
+                os.remove(os.path.join(self.directory, name))
+
+        self._checkpoint = self._read_checkpoint()
+        records = []
+        end = self._checkpoint
+        for lsn in self._files():
+            end = max(end, lsn)
+            file_records, file_end = self._scan(lsn)
+            records.extend(r for r in file_records if r.lsn >= self._checkpoint)
+            end = max(end, file_end)
+
+        self._start = self._written = self._synced = end
+        self._pending = {record.lsn for record in records}
+        self._rotate()
+        self._remove_before(self._checkpoint)
+        return records
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._checkpointer, name="JournalCheckpoint", daemon=True
+        )
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.checkpoint()
+        with self._lock:
+            for fd in self._retired + [self._fd]:
+                os.fsync(fd)
+                os.close(fd)
+            self._retired, self._fd = [], None
+        os.close(self._dir_fd)
+
+    def append(self, meta, data=None, path=None):
+        """
+        Append a record holding `data`, or the content of the file at
+        `path`, and return its JournalRecord once it is durable.
+        """
+        meta_bytes = _encode_meta(meta)
+        with self._lock:
+            if self._written - self._start >= self.file_size:
+                self._rotate()
+            lsn = self._written
+            offset = lsn - self._start
+            position = offset + RECORD_HEADER.size
+            crc = zlib.crc32(meta_bytes)
+            _pwrite(self._fd, meta_bytes, position)
+            position += len(meta_bytes)
+            data_offset = position
+            if path is None:
+                crc = zlib.crc32(data, crc)
+                _pwrite(self._fd, data, position)
+                position += len(data)
+            else:
+                with open(path, "rb") as f:
+                    while chunk := f.read(COPY_CHUNK_SIZE):
+                        crc = zlib.crc32(chunk, crc)
+                        _pwrite(self._fd, chunk, position)
+                        position += len(chunk)
+            length = position - data_offset
+            # The header goes last, a record without one is never replayed
+            _pwrite(
+                self._fd,
+                RECORD_HEADER.pack(RECORD_MAGIC, crc, len(meta_bytes), length),
+                offset,
+            )
+            self._written = self._start + position
+            self._pending.add(lsn)
+            record = JournalRecord(
+                lsn, self._path(self._start), data_offset, length, meta
+            )
+            end = self._written
+
+        self._wait_durable(end)
+        return record
+
+    def complete(self, record):
+        """The record's instance is stored and indexed, it needn't be replayed."""
+        with self._lock:
+            self._pending.discard(record.lsn)
+
+    def materialize(self, record, name):
+        """Copy a record's data to its storage location."""
+        os.makedirs(self.directory, exist_ok=True)
+        part_path = os.path.join(self.directory, f"{uuid.uuid4().hex}.part")
+        try:
+            record.copy_to(part_path)
+            path = storage.move_into_place(part_path, name)
+            with self._lock:
+                self._materialized[record.lsn] = path
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(part_path)
+
+    def checkpoint(self):
+        """
+        Move the checkpoint up to the oldest pending record and remove the
+        journal files before it.
+        """
+        with self._lock:
+            checkpoint = min(self._pending, default=self._written)
+            synced = [lsn for lsn in self._materialized if lsn < checkpoint]
+            paths = [self._materialized[lsn] for lsn in synced]
+        if checkpoint <= self._checkpoint:
+            return
+        # Completed records were written out without fsync, flush them first
+        _fsync_paths(paths)
+        part_path = os.path.join(self.directory, f"{CHECKPOINT_FILE}.part")
+        with open(part_path, "w") as f:
+            f.write(str(checkpoint))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(part_path, os.path.join(self.directory, CHECKPOINT_FILE))
+        os.fsync(self._dir_fd)
+        with self._lock:
+            for lsn in synced:
+                del self._materialized[lsn]
+        self._checkpoint = checkpoint
+        self._remove_before(checkpoint)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "journal_pending": len(self._pending),
+                "journal_bytes": self._written - self._checkpoint,
+            }
+
+    def _path(self, lsn):
+        return os.path.join(self.directory, _file_name(lsn))
+
+    def _files(self):
+        return sorted(
+            int(name.split(".")[0])
+            for name in os.listdir(self.directory)
+            if name.endswith(".journal")
+        )
+
+    def _remove_before(self, checkpoint):
+        """Remove the journal files that end at or before `checkpoint`."""
+        files = self._files()
+        for lsn, next_lsn in zip(files, files[1:]):
+            if next_lsn <= checkpoint:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(self._path(lsn))
+
+    def _read_checkpoint(self):
+        try:
+            with open(os.path.join(self.directory, CHECKPOINT_FILE)) as f:
+                return int(f.read())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _scan(self, start):
+        """
+        Read the complete records of the journal file starting at `start`,
+        cutting off a torn record at its end. Returns (records, end lsn).
+        """
+        path = self._path(start)
+        records = []
+        offset = 0
+        with open(path, "rb+") as f:
+            size = os.fstat(f.fileno()).st_size
+            while offset + RECORD_HEADER.size <= size:
+                f.seek(offset)
+                magic, crc, meta_length, length = RECORD_HEADER.unpack(
+                    f.read(RECORD_HEADER.size)
+                )
+                end = offset + RECORD_HEADER.size + meta_length + length
+                if magic != RECORD_MAGIC or end > size:
+                    break
+                meta_bytes = f.read(meta_length)
+                check = zlib.crc32(meta_bytes)
+                remaining = length
+                while remaining > 0:
+                    chunk = f.read(min(COPY_CHUNK_SIZE, remaining))
+                    check = zlib.crc32(chunk, check)
+                    remaining -= len(chunk)
+                if check != crc:
+                    break
+                records.append(
+                    JournalRecord(
+                        start + offset,
+                        path,
+                        offset + RECORD_HEADER.size + meta_length,
+                        length,
+                        _decode_meta(meta_bytes),
+                    )
+                )
+                offset = end
+            if offset < size:
+                print(f" Truncating torn journal record at {path}:{offset}")
+                f.truncate(offset)
+        return records, start + offset
+
+    def _rotate(self):
+        """Start a new journal file at the current end of the journal."""
+        if self._fd is not None:
+            self._retired.append(self._fd)
+        self._start = self._written
+        self._fd = os.open(
+            self._path(self._start), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644
+        )
+        os.fsync(self._dir_fd)
+
+    def _wait_durable(self, end):
+        with self._sync:
+            while self._synced < end:
+                if self._syncing:
+                    self._sync.wait()
+                    continue
+                # Lead a sync covering everything written so far
+                self._syncing = True
+                self._sync.release()
+                target = None
+                try:
+                    with self._lock:
+                        fds, self._retired = self._retired + [self._fd], []
+                        written = self._written
+                    for fd in fds:
+                        os.fsync(fd)
+                    for fd in fds[:-1]:
+                        os.close(fd)
+                    target = written
+                finally:
+                    self._sync.acquire()
+                    self._syncing = False
+                    if target is not None:
+                        self._synced = max(self._synced, target)
+                    self._sync.notify_all()
+
+    def _checkpointer(self):
+        while not self._stop.wait(self.checkpoint_interval):
+            try:
+                self.checkpoint()
+            except OSError as e:
+                print(f" Unable to checkpoint journal: {e}")
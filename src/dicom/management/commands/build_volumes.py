@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dicom.volumes import volume_cache
+
+
+class Command(BaseCommand):
+    help = "Assemble series into cached memory-mapped volumes"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "series", nargs="+", help="SeriesInstanceUIDs of the series to build"
+        )
+
+    def handle(self, *args, **kwargs):
+        cache = volume_cache()
+        for series_instance_uid in kwargs["series"]:
+            started = time.monotonic()
+            try:
+                volume = cache.get(series_instance_uid)
+            except (LookupError, ValueError, OSError) as e:
+                raise CommandError(f"{series_instance_uid}: {e}")
+            print(
+                f"Volume {series_instance_uid}: {volume.array.shape}"
+                f" {volume.array.dtype} in {time.monotonic() - started:.2f}s"
+            )
@@ -0,0 +1,93 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from pydicom.errors import InvalidDicomError
+
+from dicom import compression, storage
+from dicom.models import FrameOffsetTable, Instance
+
+# Number of instance rows fetched from the database per round trip
+COMPACT_CHUNK_SIZE = 500
+
+
+class Command(BaseCommand):
+    help = "Compress stored uncompressed instances at rest (Deflate or RLE Lossless)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--method",
+            choices=sorted(compression.METHODS),
+            default=settings.DICOM_INGEST_COMPRESSION or "deflate",
+            help="Compression method, RLE falls back to Deflate without pixel data",
+        )
+        parser.add_argument(
+            "--modality", help="Only compress instances of series of this modality"
+        )
+        parser.add_argument(
+            "--limit", type=int, help="Maximum number of instances to compress"
+        )
+
+    def batches(self, rows, limit=None):
+        """
+        Yield rows in primary key order, a batch per query, so rows are
+        never updated under an open cursor.
+        """
+        last_pk = None
+        while limit is None or limit > 0:
+            batch = rows if last_pk is None else rows.filter(pk__gt=last_pk)
+            size = (
+                COMPACT_CHUNK_SIZE if limit is None else min(limit, COMPACT_CHUNK_SIZE)
+            )
+            batch = list(batch[:size])
+            if not batch:
+                return
+            yield from batch
+            last_pk = batch[-1][0]
+            if limit is not None:
+                limit -= len(batch)
+
+    def handle(self, *args, **kwargs):
+        queryset = Instance.objects.filter(
+            image__isnull=False,
+            # Packed files can't be rewritten in place
+            image__packed_instance__isnull=True,
+            stored_transfer_syntax_uid="",
+            transfer_syntax_uid__in=compression.UNCOMPRESSED,
+        ).order_by("pk")
+        if kwargs["modality"]:
+            queryset = queryset.filter(series__modality=kwargs["modality"])
+        rows = queryset.values_list("pk", "image_id", "image__image")
+
+        started = time.monotonic()
+        compressed = skipped = failed = 0
+        original_total = stored_total = 0
+        for pk, image_id, name in self.batches(rows, kwargs["limit"]):
+            try:
+                fields = compression.compress_file(
+                    storage.absolute_path(name), kwargs["method"]
+                )
+            except (OSError, ValueError, RuntimeError, InvalidDicomError) as e:
+                print(f" Unable to compress {name}: {e}")
+                failed += 1
+                continue
+            if fields is None:
+                skipped += 1
+                continue
+            storage.updated(name)
+
+            with transaction.atomic():
+                Instance.objects.filter(pk=pk).update(**fields)
+                # Offsets into the uncompressed file no longer hold
+                FrameOffsetTable.objects.filter(image_id=image_id).delete()
+            compressed += 1
+            original_total += fields["original_size"]
+            stored_total += fields["stored_size"]
+
+        ratio = original_total / stored_total if stored_total else 0.0
+        print(
+            f"Compressed {compressed} instances ({skipped} not smaller, {failed}"
+            f" failed) from {original_total} to {stored_total} bytes, ratio"
+            f" {ratio:.2f}, in {time.monotonic() - started:.1f}s"
+        )
@@ -0,0 +1,115 @@
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Sum
+
+from dicom import segments
+from dicom.models import PackedInstance
+
+# Rows of the last files appended to a segment are committed after it was
+# closed, so recently written segments are left alone
+SETTLE_SECONDS = 300
+
+
+class Command(BaseCommand):
+    help = (
+        "Rewrite segment files whose packed instances were mostly deleted or"
+        " replaced, reclaiming their space"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--min-dead",
+            type=float,
+            default=0.3,
+            help="Only rewrite segments with at least this fraction of dead bytes",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only report the segments that would be rewritten",
+        )
+
+    def compact(self, writer, segment, fd):
+        """
+        Copy the live files of a locked segment to `writer`, repoint their
+        rows and remove the segment. Returns the number of files moved.
+        """
+        rows = list(
+            PackedInstance.objects.filter(segment=segment)
+            .order_by("offset")
+            .values_list("pk", "offset", "length")
+        )
+        moves = []
+        for pk, offset, length in rows:
+            data = os.pread(fd, length, offset)
+            if len(data) != length:
+                raise OSError(f"{segment} is shorter than its index")
+            moves.append((pk, offset, *writer.append(data)))
+        writer.sync()
+
+        with transaction.atomic():
+            for pk, offset, new_segment, new_offset in moves:
+                # Rows replaced in the meantime are left alone, their copy is
+                # just dead space in the new segment
+                PackedInstance.objects.filter(
+                    pk=pk, segment=segment, offset=offset
+                ).update(segment=new_segment, offset=new_offset)
+        os.remove(segments.segment_path(segment))
+        return len(moves)
+
+    def handle(self, *args, **kwargs):
+        started = time.monotonic()
+        directory = segments.segment_path(segments.SEGMENT_DIR)
+        try:
+            names = sorted(
+                name for name in os.listdir(directory) if name.endswith(".seg")
+            )
+        except FileNotFoundError:
+            names = []
+        live = dict(
+            PackedInstance.objects.values_list("segment")
+            .annotate(Sum("length"))
+            .order_by()
+        )
+
+        writer = segments.SegmentWriter(settings.DICOM_SEGMENT_SIZE)
+        compacted = moved = busy = 0
+        reclaimed = 0
+        try:
+            for name in names:
+                segment = os.path.join(segments.SEGMENT_DIR, name)
+                path = segments.segment_path(segment)
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    stat = os.fstat(fd)
+                    size = stat.st_size
+                    dead = size - (live.get(segment) or 0)
+                    if size and dead / size < kwargs["min_dead"]:
+                        continue
+                    if time.time() - stat.st_mtime < SETTLE_SECONDS:
+                        busy += 1
+                        continue
+                    if not segments.lock(fd, blocking=False):
+                        # Still being appended to
+                        busy += 1
+                        continue
+                    if kwargs["dry_run"]:
+                        print(f" {segment}: {dead} of {size} bytes dead")
+                    else:
+                        moved += self.compact(writer, segment, fd)
+                    compacted += 1
+                    reclaimed += dead
+                finally:
+                    os.close(fd)
+        finally:
+            writer.close()
+
+        print(
+            f"{'Would rewrite' if kwargs['dry_run'] else 'Rewrote'} {compacted}"
+            f" segments ({busy} in use), moving {moved} files and reclaiming"
+            f" {reclaimed} bytes, in {time.monotonic() - started:.1f}s"
+        )
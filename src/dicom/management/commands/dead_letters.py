@@ -0,0 +1,86 @@
+import time
+from concurrent.futures import wait
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from dicom import deadletter, ingest
+
+
+class Command(BaseCommand):
+    help = (
+        "List, replay or purge the instances kept in the dead-letter queue"
+        " after failing to be indexed"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("action", choices=["list", "replay", "purge"])
+        parser.add_argument(
+            "ids", nargs="*", help="Entries to act on, all of them by default"
+        )
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Also replay entries parked after DICOM_DEAD_LETTER_MAX_ATTEMPTS",
+        )
+
+    def selected(self, dead_letters, ids, parked):
+        """Return the entries given by id, or all of them, parked or not."""
+        entries = dead_letters.entries()
+        if ids:
+            return [entry for entry in entries if entry[0] in ids]
+        if parked:
+            return entries
+        return [
+            entry
+            for entry in entries
+            if entry[1]["attempts"] < dead_letters.max_attempts
+        ]
+
+    def list(self, dead_letters, entries):
+        now = time.time()
+        for entry_id, meta in entries:
+            if meta["attempts"] >= dead_letters.max_attempts:
+                retry = "parked"
+            else:
+                retry = f"retry in {max(meta['next_attempt_at'] - now, 0):.0f}s"
+            print(
+                f"{entry_id} {meta['name']}\n"
+                f"  {meta['attempts']} attempts, last"
+                f" {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(meta['failed_at']))},"
+                f" {retry}: {meta['reason']}"
+            )
+        print(f"{len(entries)} dead-lettered instances")
+
+    def replay(self, dead_letters, entries):
+        """Re-drive the entries through the ingest queue, waiting for them."""
+        ingest_queue = ingest.shared_queue()
+        ids = [entry_id for entry_id, _ in entries]
+        replayed = failed = 0
+        try:
+            for start in range(0, len(ids), settings.DICOM_INGEST_QUEUE_SIZE):
+                chunk = ids[start : start + settings.DICOM_INGEST_QUEUE_SIZE]
+                items = dead_letters.redrive(ingest_queue, chunk)
+                wait([item.committed for item in items])
+                for item in items:
+                    if item.committed.exception() is None:
+                        replayed += 1
+                    else:
+                        failed += 1
+        finally:
+            ingest_queue.stop()
+        print(f"Replayed {replayed} dead-lettered instances, {failed} failed again")
+
+    def handle(self, *args, **kwargs):
+        dead_letters = deadletter.dead_letters()
+        # Parked entries are only replayed when asked for
+        parked = kwargs["all"] or kwargs["action"] != "replay"
+        entries = self.selected(dead_letters, kwargs["ids"], parked)
+        if kwargs["action"] == "list":
+            self.list(dead_letters, entries)
+        elif kwargs["action"] == "replay":
+            self.replay(dead_letters, entries)
+        else:
+            for entry_id, _ in entries:
+                dead_letters.remove(entry_id)
+            print(f"Purged {len(entries)} dead-lettered instances")
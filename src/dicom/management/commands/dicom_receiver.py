@@ -0,0 +1,484 @@
+import contextlib
+import multiprocessing
+import os
+import queue
+import signal
+import socket
+import tempfile
+import threading
+import time
+from io import BytesIO
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from pydicom.uid import ExplicitVRLittleEndian, ImplicitVRLittleEndian
+from pynetdicom import _config, evt
+from pynetdicom.sop_class import (
+    ComputedRadiographyImageStorage,
+    CTImageStorage,
+    MRImageStorage,
+    PatientRootQueryRetrieveInformationModelFind,
+    PatientRootQueryRetrieveInformationModelGet,
+    PatientRootQueryRetrieveInformationModelMove,
+    SecondaryCaptureImageStorage,
+    StudyRootQueryRetrieveInformationModelFind,
+    StudyRootQueryRetrieveInformationModelGet,
+    StudyRootQueryRetrieveInformationModelMove,
+    Verification,
+)
+from pynetdicom.transport import ThreadedAssociationServer
+
+from dicom import deadletter, dedup, ingest, query, retrieve, storage
+from dicom.admission import AdmissionControl
+from dicom.ingest import IngestQueue
+from dicom.journal import Journal
+from dicom.retrieve import PooledAE
+from dicom.thumbnails import ThumbnailStage
+
+STORAGE_SOP_CLASSES = [
+    CTImageStorage,
+    MRImageStorage,
+    ComputedRadiographyImageStorage,
+    SecondaryCaptureImageStorage,
+]
+
+# C-STORE Error: Data Set does not match SOP Class, for instances whose
+# UIDs can't be stored under
+INVALID_DATASET = 0xA900
+
+
+def handle_store(event, ingest_queue, admission):
+    """Handle EVT_C_STORE events and queue received DICOM files for saving."""
+    mode = settings.DICOM_STORE_MODE
+    if mode == "spool":
+        # pynetdicom has already streamed the P-DATA to a spool file
+        spool_path = event.dataset_path
+        size = os.path.getsize(spool_path)
+    elif mode == "decoded":
+        dataset = event.dataset
+        dataset.file_meta = event.file_meta
+        # Encoded up front so the content hash covers the file as written
+        buffer = BytesIO()
+        dataset.save_as(buffer, enforce_file_format=True)
+        encoded = buffer.getvalue()
+        size = len(encoded)
+    else:
+        # Passthrough: keep the bytes as received
+        encoded = event.encoded_dataset()
+        size = len(encoded)
+
+    refused = admission.store_status(size)
+    if refused is not None:
+        if mode == "spool":
+            with contextlib.suppress(OSError):
+                os.remove(spool_path)
+        return refused
+
+    if mode == "spool":
+        with open(spool_path, "rb") as f:
+            dataset = storage.read_index_tags(f)
+        content_hash = dedup.hash_file(spool_path)
+    elif mode == "decoded":
+        content_hash = dedup.hash_bytes(encoded)
+    else:
+        # Only the index tags are parsed
+        dataset = storage.read_index_tags(BytesIO(encoded))
+        content_hash = dedup.hash_bytes(encoded)
+
+    patient_id = dataset.get("PatientID", "UnknownID")
+
+    print(f"Received DICOM for PatientID: {patient_id}")
+
+    try:
+        dicom_filepath = dedup.storage_target(dataset, content_hash)
+    except storage.InvalidUID as e:
+        print(f" Refusing DICOM file: {e}")
+        if mode == "spool":
+            with contextlib.suppress(OSError):
+                os.remove(spool_path)
+        return INVALID_DATASET
+    if dicom_filepath is None:
+        # Already stored: acknowledged without a write
+        if mode == "spool":
+            with contextlib.suppress(OSError):
+                os.remove(spool_path)
+        return 0x0000
+
+    if ingest_queue.journal is not None:
+        # Stored by the ingest workers, from the journal
+        if mode != "spool":
+            return ingest.journal_status(
+                ingest_queue, dicom_filepath, dataset, content_hash, data=encoded
+            )
+        try:
+            return ingest.journal_status(
+                ingest_queue, dicom_filepath, dataset, content_hash, path=spool_path
+            )
+        finally:
+            with contextlib.suppress(OSError):
+                os.remove(spool_path)
+
+    try:
+        if mode == "spool":
+            storage.move_into_place(spool_path, dicom_filepath)
+        else:
+            storage.write_encoded(dicom_filepath, encoded)
+    except OSError as e:
+        print(f" Error writing DICOM file: {e}")
+        if mode == "spool":
+            with contextlib.suppress(OSError):
+                os.remove(spool_path)
+        return 0x0112
+
+    return ingest.commit_status(
+        ingest.enqueue(ingest_queue, dicom_filepath, dataset, content_hash, size)
+    )
+
+
+def close_connection(event):
+    """Close the association thread's database connection once it ends."""
+    connection.close()
+
+
+def receiver_stats(ingest_queue, admission):
+    return {**ingest_queue.stats(), **admission.stats()}
+
+
+def report_stats(ingest_queue, admission, interval, stop_event, stats_queue=None):
+    while not stop_event.wait(interval):
+        if stats_queue is None:
+            print(f" Ingest stats: {receiver_stats(ingest_queue, admission)}")
+        else:
+            stats_queue.put((os.getpid(), receiver_stats(ingest_queue, admission)))
+
+
+def aggregate_stats(per_process):
+    """Combine the latest ingest stats reported by each receiver process."""
+    stats = list(per_process.values())
+    totals = {
+        name: sum(s[name] for s in stats)
+        for name in (
+            "enqueued",
+            "rejected",
+            "persisted",
+            "failed",
+            "dead_lettered",
+            "batches",
+            "queue_depth",
+            "queue_size",
+            "inflight_bytes",
+            "associations_active",
+            "associations_accepted",
+            "associations_rejected",
+            "associations_rejected_per_ae",
+            "stores_refused_high_water",
+            "stores_refused_inflight_bytes",
+        )
+    }
+    utilisation = [u for s in stats for u in s["worker_utilisation"]]
+    totals["processes"] = len(stats)
+    totals["wait_max_ms"] = max((s["wait_max_ms"] for s in stats), default=0.0)
+    totals["worker_utilisation_avg"] = (
+        round(sum(utilisation) / len(utilisation), 3) if utilisation else 0.0
+    )
+    return totals
+
+
+def raise_keyboard_interrupt(signum, frame):
+    # Only the first SIGTERM starts a shutdown, the drain must not be cut short
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    raise KeyboardInterrupt
+
+
+class ReusePortAssociationServer(ThreadedAssociationServer):
+    """
+    Association server that lets sibling receiver processes listen on the
+    same port, the kernel spreads incoming associations between them.
+    """
+
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+
+class Command(BaseCommand):
+    help = "Start a DICOM server to receive and store incoming DICOM files"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=settings.DICOM_RECEIVER_PROCESSES,
+            help="Number of receiver processes sharing the port",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=settings.DICOM_INGEST_WORKERS,
+            help="Number of persistence workers draining the ingest queue",
+        )
+        parser.add_argument(
+            "--queue-size",
+            type=int,
+            default=settings.DICOM_INGEST_QUEUE_SIZE,
+            help="Maximum number of received instances waiting to be saved",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=settings.DICOM_INGEST_BATCH_SIZE,
+            help="Maximum number of instances written per bulk insert",
+        )
+        parser.add_argument(
+            "--thumbnail-workers",
+            type=int,
+            default=settings.DICOM_THUMBNAIL_WORKERS,
+            help="Number of processes building thumbnails and previews, 0 to disable",
+        )
+        parser.add_argument(
+            "--stats-interval",
+            type=int,
+            default=settings.DICOM_INGEST_STATS_INTERVAL,
+            help="Seconds between ingest stats reports, 0 to disable",
+        )
+
+    def handle(self, *args, **kwargs):
+        if kwargs["processes"] > 1:
+            self.supervise(kwargs)
+        else:
+            self.serve(kwargs)
+
+    def make_ae(self):
+        ae = PooledAE()
+        ae.ae_title = settings.DICOM_AE_TITLE
+        # Counted and enforced by AdmissionControl, pynetdicom's own limit (10
+        # by default) is kept in line with it
+        ae.maximum_associations = settings.DICOM_MAX_ASSOCIATIONS or 2**31
+
+        # All contexts
+
+        ae.add_supported_context(Verification)
+        uncompressed = [ExplicitVRLittleEndian, ImplicitVRLittleEndian]
+        compressed = [uid.strip() for uid in settings.DICOM_TRANSFER_SYNTAXES]
+        compressed = [uid for uid in compressed if uid and uid not in uncompressed]
+        for sop_class in STORAGE_SOP_CLASSES:
+            # Roles let C-GET SCUs receive their instances on this association
+            ae.add_supported_context(
+                sop_class,
+                uncompressed + compressed,
+                scu_role=True,
+                scp_role=True,
+            )
+            # Outbound C-STORE sub-operations of C-MOVE. Instances are sent
+            # as stored, so each compressed syntax gets its own context for
+            # the destination to accept or reject separately.
+            ae.add_requested_context(sop_class, uncompressed)
+            for transfer_syntax in compressed:
+                ae.add_requested_context(sop_class, transfer_syntax)
+
+        # Query/Retrieve, answered from the database index
+        ae.add_supported_context(PatientRootQueryRetrieveInformationModelFind)
+        ae.add_supported_context(StudyRootQueryRetrieveInformationModelFind)
+        ae.add_supported_context(PatientRootQueryRetrieveInformationModelGet)
+        ae.add_supported_context(StudyRootQueryRetrieveInformationModelGet)
+        ae.add_supported_context(PatientRootQueryRetrieveInformationModelMove)
+        ae.add_supported_context(StudyRootQueryRetrieveInformationModelMove)
+        return ae
+
+    def serve(self, options, stats_queue=None, slot=0):
+        """
+        Run one receiver with its own ingest pipeline.
+
+        With a `stats_queue` this is a child of `supervise()`: it shares the
+        port with its siblings and sends its stats to the supervisor. A
+        restarted child keeps its `slot`, and with it its journal.
+        """
+        ae = self.make_ae()
+
+        if settings.DICOM_STORE_MODE == "spool":
+            # Stream each C-STORE dataset to a spool file instead of memory.
+            # pynetdicom creates the file with tempfile, so point that at the
+            # spool directory to keep it on the storage volume and make the
+            # final rename atomic.
+            os.makedirs(settings.DICOM_SPOOL_DIR, exist_ok=True)
+            tempfile.tempdir = str(settings.DICOM_SPOOL_DIR)
+            _config.STORE_RECV_CHUNKED_DATASET = True
+
+        thumbnails = None
+        if options["thumbnail_workers"] > 0:
+            thumbnails = ThumbnailStage(options["thumbnail_workers"])
+
+        journal, records = None, []
+        if settings.DICOM_INGEST_JOURNAL:
+            journal = Journal(
+                os.path.join(settings.DICOM_JOURNAL_DIR, str(slot)),
+                settings.DICOM_JOURNAL_FILE_SIZE,
+                settings.DICOM_JOURNAL_CHECKPOINT_INTERVAL,
+            )
+            records = journal.open()
+            journal.start()
+
+        ingest_queue = IngestQueue(
+            maxsize=options["queue_size"],
+            workers=options["workers"],
+            put_timeout=settings.DICOM_INGEST_QUEUE_TIMEOUT,
+            batch_size=options["batch_size"],
+            flush_interval=settings.DICOM_INGEST_FLUSH_INTERVAL,
+            on_persisted=thumbnails,
+            compression=settings.DICOM_INGEST_COMPRESSION,
+            journal=journal,
+            dead_letters=deadletter.dead_letters(),
+        )
+        ingest_queue.start()
+        if records:
+            print(f" Replaying {len(records)} journaled instances ...")
+            ingest.replay(ingest_queue, records)
+        if slot == 0:
+            # One retry scheduler for the dead letters of all the processes
+            ingest_queue.dead_letters.start(
+                ingest_queue, settings.DICOM_DEAD_LETTER_RETRY_INTERVAL
+            )
+
+        admission = AdmissionControl(
+            ingest_queue,
+            max_associations=settings.DICOM_MAX_ASSOCIATIONS,
+            max_associations_per_ae=settings.DICOM_MAX_ASSOCIATIONS_PER_AE,
+            max_inflight_bytes=settings.DICOM_MAX_INFLIGHT_BYTES,
+            high_water=settings.DICOM_INGEST_HIGH_WATER,
+        )
+
+        stop_event = threading.Event()
+        if options["stats_interval"] > 0:
+            threading.Thread(
+                target=report_stats,
+                args=(
+                    ingest_queue,
+                    admission,
+                    options["stats_interval"],
+                    stop_event,
+                    stats_queue,
+                ),
+                daemon=True,
+            ).start()
+
+        handlers = [
+            (evt.EVT_REQUESTED, admission.handle_requested),
+            (evt.EVT_CONN_CLOSE, admission.handle_closed),
+            (evt.EVT_C_STORE, handle_store, [ingest_queue, admission]),
+            (evt.EVT_C_FIND, query.handle_find),
+            (evt.EVT_C_GET, retrieve.handle_get),
+            (evt.EVT_C_MOVE, retrieve.handle_move),
+            (evt.EVT_RELEASED, close_connection),
+            (evt.EVT_ABORTED, close_connection),
+        ]
+
+        address = ("0.0.0.0", settings.DICOM_PORT)
+        try:
+            if stats_queue is None:
+                print(f" Starting DICOM server on 0.0.0.0:{address[1]} ...")
+                ae.start_server(address, block=True, evt_handlers=handlers)
+            else:
+                server = ae.make_server(
+                    address,
+                    evt_handlers=handlers,
+                    server_class=ReusePortAssociationServer,
+                )
+                try:
+                    server.serve_forever()
+                except KeyboardInterrupt:
+                    pass
+                finally:
+                    server.server_close()
+        finally:
+            ae.shutdown()
+            stop_event.set()
+            ingest_queue.dead_letters.stop()
+            print(f" Draining ingest queue of process {os.getpid()} ...")
+            ingest_queue.stop()
+            if journal is not None:
+                journal.close()
+            if thumbnails is not None:
+                thumbnails.shutdown()
+            if stats_queue is None:
+                print(f" Ingest stats: {receiver_stats(ingest_queue, admission)}")
+            else:
+                stats_queue.put((os.getpid(), receiver_stats(ingest_queue, admission)))
+
+    def serve_child(self, options, stats_queue, slot):
+        # The supervisor owns Ctrl+C and stops children with SIGTERM
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, raise_keyboard_interrupt)
+        self.serve(options, stats_queue, slot)
+
+    def spawn(self, context, options, stats_queue, slot):
+        # Children must open their own database connections
+        connections.close_all()
+        process = context.Process(
+            target=self.serve_child,
+            args=(options, stats_queue, slot),
+            name="DicomReceiver",
+        )
+        process.start()
+        return process
+
+    def supervise(self, options):
+        """
+        Run `--processes` receivers on the same port and restart any that
+        die, printing per-process and aggregated ingest stats.
+        """
+        if not hasattr(socket, "SO_REUSEPORT"):
+            raise CommandError("--processes needs SO_REUSEPORT support")
+
+        # Children inherit the configured Django state, so fork rather than spawn
+        context = multiprocessing.get_context("fork")
+        stats_queue = context.Queue()
+        processes = [
+            self.spawn(context, options, stats_queue, slot)
+            for slot in range(options["processes"])
+        ]
+        print(
+            f" Starting {len(processes)} DICOM receiver processes"
+            f" on 0.0.0.0:{settings.DICOM_PORT} ..."
+        )
+
+        latest = {}
+        interval = options["stats_interval"]
+        next_report = time.monotonic() + interval
+        try:
+            while True:
+                with contextlib.suppress(queue.Empty):
+                    pid, stats = stats_queue.get(timeout=1)
+                    latest[pid] = stats
+
+                for index, process in enumerate(processes):
+                    if process.is_alive():
+                        continue
+                    print(
+                        f" Receiver process {process.pid} exited with code"
+                        f" {process.exitcode}, restarting ..."
+                    )
+                    latest.pop(process.pid, None)
+                    processes[index] = self.spawn(context, options, stats_queue, index)
+
+                if interval > 0 and time.monotonic() >= next_report:
+                    next_report += interval
+                    for pid, stats in sorted(latest.items()):
+                        print(f" Ingest stats [{pid}]: {stats}")
+                    if latest:
+                        print(f" Aggregated ingest stats: {aggregate_stats(latest)}")
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.join()
+            while True:
+                try:
+                    pid, stats = stats_queue.get(timeout=1)
+                except queue.Empty:
+                    break
+                latest[pid] = stats
+            if latest:
+                print(f" Aggregated ingest stats: {aggregate_stats(latest)}")
@@ -0,0 +1,89 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from dicom import segments, storage
+from dicom.models import Image_Upload, PackedInstance
+
+# Number of upload rows fetched from the database per round trip
+PACK_CHUNK_SIZE = 500
+
+
+class Command(BaseCommand):
+    help = (
+        "Append stored files of up to DICOM_PACK_MAX_SIZE bytes to segment"
+        " files, removing the files of their own"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--limit", type=int, help="Maximum number of files to consider"
+        )
+
+    def batches(self, rows, limit=None):
+        """
+        Yield batches of rows in primary key order, a query per batch, so
+        rows are never updated under an open cursor.
+        """
+        last_pk = None
+        while limit is None or limit > 0:
+            batch = rows if last_pk is None else rows.filter(pk__gt=last_pk)
+            size = PACK_CHUNK_SIZE if limit is None else min(limit, PACK_CHUNK_SIZE)
+            batch = list(batch[:size])
+            if not batch:
+                return
+            yield batch
+            last_pk = batch[-1][0]
+            if limit is not None:
+                limit -= len(batch)
+
+    def handle(self, *args, **kwargs):
+        if not segments.enabled():
+            raise CommandError(
+                "Packing needs DICOM_PACK_MAX_SIZE and the filesystem storage backend"
+            )
+        rows = (
+            Image_Upload.objects.filter(packed_instance__isnull=True)
+            .order_by("pk")
+            .values_list("pk", "image")
+        )
+
+        started = time.monotonic()
+        packed_total = bytes_total = 0
+        for batch in self.batches(rows, kwargs["limit"]):
+            uploads = dict((name, pk) for pk, name in batch)
+            paths = {name: storage.backend().path(name) for name in uploads}
+            packed = segments.pack(paths)
+            # Uploads deleted in the meantime are skipped
+            existing = set(
+                Image_Upload.objects.filter(
+                    pk__in=[uploads[name] for name in packed]
+                ).values_list("pk", flat=True)
+            )
+            packed = {
+                name: entry
+                for name, entry in packed.items()
+                if uploads[name] in existing
+            }
+            PackedInstance.objects.bulk_create(
+                [
+                    PackedInstance(
+                        image_id=uploads[name],
+                        segment=segment,
+                        offset=offset,
+                        length=length,
+                    )
+                    for name, (segment, offset, length, _) in packed.items()
+                ]
+            )
+            segments.remove_packed(paths, packed)
+            packed_total += len(packed)
+            bytes_total += sum(entry[2] for entry in packed.values())
+
+        segments.writer().close()
+        print(
+            f"Packed {packed_total} files ({bytes_total} bytes) of up to"
+            f" {settings.DICOM_PACK_MAX_SIZE} bytes in"
+            f" {time.monotonic() - started:.1f}s"
+        )
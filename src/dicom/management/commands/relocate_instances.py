@@ -0,0 +1,150 @@
+import contextlib
+import os
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from dicom import storage, thumbnails
+from dicom.models import Image_Upload, Instance, InstanceVersion, PackedInstance
+
+# Number of rows fetched from the database per round trip
+RELOCATE_CHUNK_SIZE = 500
+
+
+class Command(BaseCommand):
+    help = (
+        "Move stored instances to the names of the current DICOM_STORAGE_LAYOUT,"
+        " while the archive stays online"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only report the files that would be moved",
+        )
+        parser.add_argument(
+            "--limit", type=int, help="Maximum number of files to relocate"
+        )
+
+    def batches(self, rows):
+        """
+        Yield batches of rows in primary key order, a query per batch, so
+        rows are never updated under an open cursor.
+        """
+        last_pk = None
+        while True:
+            batch = rows if last_pk is None else rows.filter(pk__gt=last_pk)
+            batch = list(batch[:RELOCATE_CHUNK_SIZE])
+            if not batch:
+                return
+            yield batch
+            last_pk = batch[-1][0]
+
+    def moves(self, batch):
+        """Return the (upload pk, name, target name, series UID) to move."""
+        moves = []
+        for _, image_id, name, patient_id, study, series, sop in batch:
+            # Only the directory changes, versions keep their file name
+            try:
+                folder = os.path.dirname(
+                    storage.storage_name(patient_id, study, series, sop)
+                )
+            except storage.InvalidUID as e:
+                print(f" {name} left in place: {e}")
+                continue
+            target = os.path.join(folder, os.path.basename(name))
+            if target != name:
+                moves.append((image_id, name, target, series))
+        return moves
+
+    def relocate(self, moves):
+        """
+        Copy every file to its new name, repoint the uploads in a single
+        transaction, then remove the old names.
+
+        Readers resolve names through the index, so until the transaction
+        commits they keep reading the old file, and after it the new one.
+        """
+        packed = set(
+            PackedInstance.objects.filter(
+                image__in=[move[0] for move in moves]
+            ).values_list("image_id", flat=True)
+        )
+        moved = []
+        for image_id, name, target, series in moves:
+            if image_id in packed:
+                # Only its name changes, the bytes stay in their segment
+                moved.append((image_id, name, target, series))
+                continue
+            try:
+                storage.backend().copy(name, target)
+            except FileExistsError:
+                if Image_Upload.objects.filter(image=target).exists():
+                    print(f" {target} already belongs to another upload, skipped")
+                    continue
+            except OSError as e:
+                print(f" Unable to copy {name}: {e}")
+                continue
+            moved.append((image_id, name, target, series))
+
+        with transaction.atomic():
+            for image_id, _, target, _ in moved:
+                # update() skips django-cleanup, which would delete the file
+                Image_Upload.objects.filter(pk=image_id).update(image=target)
+
+        for _, name, target, series in moved:
+            storage.backend().delete(name)
+            # Derived images follow when built, otherwise they are rebuilt
+            # on first request
+            self.move_local(
+                thumbnails.thumbnail_name(name), thumbnails.thumbnail_name(target)
+            )
+            self.move_local(
+                thumbnails.preview_name(name, series),
+                thumbnails.preview_name(target, series),
+            )
+        return len(moved)
+
+    def move_local(self, name, target):
+        """Move a derived file, kept on local disk by every backend."""
+        root = storage.backend().root
+        with contextlib.suppress(FileNotFoundError):
+            os.renames(os.path.join(root, name), os.path.join(root, target))
+
+    def handle(self, *args, **kwargs):
+        started = time.monotonic()
+        limit = kwargs["limit"]
+        relocated = 0
+        for model, prefix in ((Instance, ""), (InstanceVersion, "instance__")):
+            rows = (
+                model.objects.filter(image__isnull=False)
+                .order_by("pk")
+                .values_list(
+                    "pk",
+                    "image_id",
+                    "image__image",
+                    f"{prefix}series__study__patient__patient_id",
+                    f"{prefix}series__study__study_instance_uid",
+                    f"{prefix}series__series_instance_uid",
+                    f"{prefix}sop_instance_uid",
+                )
+            )
+            for batch in self.batches(rows):
+                if limit is not None and relocated >= limit:
+                    break
+                moves = self.moves(batch)
+                if limit is not None:
+                    moves = moves[: limit - relocated]
+                if kwargs["dry_run"]:
+                    for _, name, target, _ in moves:
+                        print(f" {name} -> {target}")
+                    relocated += len(moves)
+                else:
+                    relocated += self.relocate(moves)
+
+        print(
+            f"{'Would relocate' if kwargs['dry_run'] else 'Relocated'} {relocated}"
+            f" files in {time.monotonic() - started:.1f}s"
+        )
@@ -0,0 +1,40 @@
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dicom import roi, serializers
+
+
+class Command(BaseCommand):
+    help = (
+        "Compute ROI statistics over stored series. Reads a JSON list of"
+        ' {"series_instance_uid": ..., "rois": [...]} and prints the results'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "requests", help="JSON file with the series and their ROIs, - for stdin"
+        )
+
+    def handle(self, *args, **kwargs):
+        try:
+            if kwargs["requests"] == "-":
+                data = json.load(sys.stdin)
+            else:
+                with open(kwargs["requests"]) as f:
+                    data = json.load(f)
+        except (OSError, ValueError) as e:
+            raise CommandError(f"Unable to read ROI requests: {e}")
+
+        serializer = serializers.SeriesRoiSerializer(data=data, many=True)
+        if not serializer.is_valid():
+            raise CommandError(json.dumps(serializer.errors))
+
+        results = roi.batch_stats(
+            [
+                (item["series_instance_uid"], item["rois"])
+                for item in serializer.validated_data
+            ]
+        )
+        print(json.dumps(results, indent=2))
@@ -0,0 +1,176 @@
+# Generated by Django 5.0.4 on 2026-10-18 17:26
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("dicom", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Patient",
+            fields=[
+                (
+                    "id",
+                    models.UUIDField(
+                        default=uuid.uuid4,
+                        editable=False,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                ("status", models.BooleanField(default=True)),
+                ("patient_id", models.CharField(max_length=64, unique=True)),
+                (
+                    "patient_name",
+                    models.CharField(blank=True, db_index=True, max_length=324),
+                ),
+                ("birth_date", models.DateField(blank=True, null=True)),
+                ("sex", models.CharField(blank=True, max_length=16)),
+                ("study_count", models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                "abstract": False,
+            },
+        ),
+        migrations.CreateModel(
+            name="Series",
+            fields=[
+                (
+                    "id",
+                    models.UUIDField(
+                        default=uuid.uuid4,
+                        editable=False,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                ("status", models.BooleanField(default=True)),
+                ("series_instance_uid", models.CharField(max_length=64, unique=True)),
+                (
+                    "modality",
+                    models.CharField(blank=True, db_index=True, max_length=16),
+                ),
+                ("series_number", models.IntegerField(blank=True, null=True)),
+                ("series_date", models.DateField(blank=True, null=True)),
+                ("series_description", models.CharField(blank=True, max_length=64)),
+                ("body_part_examined", models.CharField(blank=True, max_length=16)),
+                ("instance_count", models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                "verbose_name_plural": "series",
+            },
+        ),
+        migrations.CreateModel(
+            name="Instance",
+            fields=[
+                (
+                    "id",
+                    models.UUIDField(
+                        default=uuid.uuid4,
+                        editable=False,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                ("status", models.BooleanField(default=True)),
+                ("sop_instance_uid", models.CharField(max_length=64, unique=True)),
+                ("sop_class_uid", models.CharField(db_index=True, max_length=64)),
+                ("transfer_syntax_uid", models.CharField(blank=True, max_length=64)),
+                ("instance_number", models.IntegerField(blank=True, null=True)),
+                ("rows", models.PositiveIntegerField(blank=True, null=True)),
+                ("columns", models.PositiveIntegerField(blank=True, null=True)),
+                (
+                    "number_of_frames",
+                    models.PositiveIntegerField(blank=True, null=True),
+                ),
+                (
+                    "image",
+                    models.OneToOneField(
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="instance",
+                        to="dicom.image_upload",
+                    ),
+                ),
+                (
+                    "series",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="instances",
+                        to="dicom.series",
+                    ),
+                ),
+            ],
+            options={
+                "abstract": False,
+            },
+        ),
+        migrations.CreateModel(
+            name="Study",
+            fields=[
+                (
+                    "id",
+                    models.UUIDField(
+                        default=uuid.uuid4,
+                        editable=False,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                ("status", models.BooleanField(default=True)),
+                ("study_instance_uid", models.CharField(max_length=64, unique=True)),
+                ("study_date", models.DateField(blank=True, db_index=True, null=True)),
+                ("study_time", models.CharField(blank=True, max_length=16)),
+                (
+                    "accession_number",
+                    models.CharField(blank=True, db_index=True, max_length=16),
+                ),
+                ("study_id", models.CharField(blank=True, max_length=16)),
+                ("study_description", models.CharField(blank=True, max_length=64)),
+                (
+                    "referring_physician_name",
+                    models.CharField(blank=True, max_length=324),
+                ),
+                ("series_count", models.PositiveIntegerField(default=0)),
+                ("instance_count", models.PositiveIntegerField(default=0)),
+                (
+                    "patient",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="studies",
+                        to="dicom.patient",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name_plural": "studies",
+            },
+        ),
+        migrations.AddField(
+            model_name="series",
+            name="study",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="series",
+                to="dicom.study",
+            ),
+        ),
+    ]
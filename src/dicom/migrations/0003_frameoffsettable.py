@@ -0,0 +1,47 @@
+# Generated by Django 5.0.4 on 2026-10-18 17:40
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("dicom", "0002_patient_series_instance_study_series_study"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="FrameOffsetTable",
+            fields=[
+                (
+                    "id",
+                    models.UUIDField(
+                        default=uuid.uuid4,
+                        editable=False,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                ("status", models.BooleanField(default=True)),
+                ("pixel_data_offset", models.BigIntegerField()),
+                ("pixel_data_length", models.BigIntegerField(blank=True, null=True)),
+                ("frames", models.JSONField()),
+                (
+                    "image",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="frame_offset_table",
+                        to="dicom.image_upload",
+                    ),
+                ),
+            ],
+            options={
+                "abstract": False,
+            },
+        ),
+    ]
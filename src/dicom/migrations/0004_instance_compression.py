@@ -0,0 +1,33 @@
+# Generated by Django 5.0.4 on 2026-10-18 17:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("dicom", "0003_frameoffsettable"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="instance",
+            name="compression_ratio",
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="instance",
+            name="original_size",
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="instance",
+            name="stored_size",
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="instance",
+            name="stored_transfer_syntax_uid",
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
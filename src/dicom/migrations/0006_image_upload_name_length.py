@@ -0,0 +1,18 @@
+# Generated by Django 5.0.4 on 2026-10-18 18:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("dicom", "0005_instance_content_hash"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="image_upload",
+            name="image",
+            field=models.ImageField(max_length=255, upload_to="dicom_images/"),
+        ),
+    ]
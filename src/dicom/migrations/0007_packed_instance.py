@@ -0,0 +1,54 @@
+# Generated by Django 5.0.4 on 2026-10-18 18:05
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("dicom", "0006_image_upload_name_length"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="image_upload",
+            name="image",
+            field=models.ImageField(
+                db_index=True, max_length=255, upload_to="dicom_images/"
+            ),
+        ),
+        migrations.CreateModel(
+            name="PackedInstance",
+            fields=[
+                (
+                    "id",
+                    models.UUIDField(
+                        default=uuid.uuid4,
+                        editable=False,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                ("status", models.BooleanField(default=True)),
+                ("segment", models.CharField(db_index=True, max_length=255)),
+                ("offset", models.BigIntegerField()),
+                ("length", models.BigIntegerField()),
+                (
+                    "image",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="packed_instance",
+                        to="dicom.image_upload",
+                    ),
+                ),
+            ],
+            options={
+                "abstract": False,
+            },
+        ),
+    ]
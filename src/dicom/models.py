@@ -1,11 +1,177 @@
 from django.db import models
 
-from src.core.models import BaseModel
+from core.models import BaseModel
 
 
 # Create your models here.
 class Image_Upload(BaseModel):
-    image = models.ImageField(upload_to="dicom_images/")
+    # Sharded storage names run up to ~240 characters
+    image = models.ImageField(upload_to="dicom_images/", max_length=255, db_index=True)
 
     def __str__(self):
-        return f"Dicom Image {self.id} uploaded at {self.uploaded_at}"
+        return f"Dicom Image {self.id} uploaded at {self.created_at}"
+
+
+class Patient(BaseModel):
+    """
+    Patient level of the DICOM index, filled in by the receiver
+    """
+
+    patient_id = models.CharField(max_length=64, unique=True)
+    patient_name = models.CharField(max_length=324, blank=True, db_index=True)
+    birth_date = models.DateField(null=True, blank=True)
+    sex = models.CharField(max_length=16, blank=True)
+    study_count = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"Patient {self.patient_id}"
+
+
+class Study(BaseModel):
+    """
+    Study level of the DICOM index
+    """
+
+    patient = models.ForeignKey(
+        Patient,
+        on_delete=models.CASCADE,
+        related_name="studies",
+    )
+    study_instance_uid = models.CharField(max_length=64, unique=True)
+    study_date = models.DateField(null=True, blank=True, db_index=True)
+    study_time = models.CharField(max_length=16, blank=True)
+    accession_number = models.CharField(max_length=16, blank=True, db_index=True)
+    study_id = models.CharField(max_length=16, blank=True)
+    study_description = models.CharField(max_length=64, blank=True)
+    referring_physician_name = models.CharField(max_length=324, blank=True)
+    series_count = models.PositiveIntegerField(default=0)
+    instance_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name_plural = "studies"
+
+    def __str__(self):
+        return f"Study {self.study_instance_uid}"
+
+
+class Series(BaseModel):
+    """
+    Series level of the DICOM index
+    """
+
+    study = models.ForeignKey(
+        Study,
+        on_delete=models.CASCADE,
+        related_name="series",
+    )
+    series_instance_uid = models.CharField(max_length=64, unique=True)
+    modality = models.CharField(max_length=16, blank=True, db_index=True)
+    series_number = models.IntegerField(null=True, blank=True)
+    series_date = models.DateField(null=True, blank=True)
+    series_description = models.CharField(max_length=64, blank=True)
+    body_part_examined = models.CharField(max_length=16, blank=True)
+    instance_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name_plural = "series"
+
+    def __str__(self):
+        return f"Series {self.series_instance_uid}"
+
+
+class Instance(BaseModel):
+    """
+    Instance level of the DICOM index, pointing at the stored file
+    """
+
+    series = models.ForeignKey(
+        Series,
+        on_delete=models.CASCADE,
+        related_name="instances",
+    )
+    image = models.OneToOneField(
+        Image_Upload,
+        on_delete=models.SET_NULL,
+        null=True,
+        related_name="instance",
+    )
+    sop_instance_uid = models.CharField(max_length=64, unique=True)
+    sop_class_uid = models.CharField(max_length=64, db_index=True)
+    transfer_syntax_uid = models.CharField(max_length=64, blank=True)
+    # Set once the stored file was compressed at rest, it then differs from
+    # the transfer syntax the instance was received in
+    stored_transfer_syntax_uid = models.CharField(max_length=64, blank=True)
+    original_size = models.BigIntegerField(null=True, blank=True)
+    stored_size = models.BigIntegerField(null=True, blank=True)
+    compression_ratio = models.FloatField(null=True, blank=True)
+    # BLAKE2b of the file as received, to recognize re-sent instances
+    content_hash = models.CharField(max_length=64, blank=True)
+    instance_number = models.IntegerField(null=True, blank=True)
+    rows = models.PositiveIntegerField(null=True, blank=True)
+    columns = models.PositiveIntegerField(null=True, blank=True)
+    number_of_frames = models.PositiveIntegerField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Instance {self.sop_instance_uid}"
+
+
+class InstanceVersion(BaseModel):
+    """
+    A previous file of an instance that was re-sent with different content
+    while DICOM_DUPLICATE_POLICY is "version"
+    """
+
+    instance = models.ForeignKey(
+        Instance,
+        on_delete=models.CASCADE,
+        related_name="versions",
+    )
+    image = models.OneToOneField(
+        Image_Upload,
+        on_delete=models.CASCADE,
+        related_name="instance_version",
+    )
+    content_hash = models.CharField(max_length=64, blank=True)
+
+    def __str__(self):
+        return f"Version {self.content_hash[:16]} of {self.instance_id}"
+
+
+class FrameOffsetTable(BaseModel):
+    """
+    Byte offsets of the pixel data and of every frame of a stored file,
+    recorded at ingest so frames can be read without parsing the file
+    """
+
+    image = models.OneToOneField(
+        Image_Upload,
+        on_delete=models.CASCADE,
+        related_name="frame_offset_table",
+    )
+    pixel_data_offset = models.BigIntegerField()
+    # Null for encapsulated pixel data
+    pixel_data_length = models.BigIntegerField(null=True, blank=True)
+    # [[[offset, length], ...], ...], the fragments of each frame
+    frames = models.JSONField()
+
+    def __str__(self):
+        return f"Frame offsets of {self.image_id}"
+
+
+class PackedInstance(BaseModel):
+    """
+    Where a small stored file was appended into a segment file, instead of
+    being kept as a file of its own
+    """
+
+    image = models.OneToOneField(
+        Image_Upload,
+        on_delete=models.CASCADE,
+        related_name="packed_instance",
+    )
+    segment = models.CharField(max_length=255, db_index=True)
+    offset = models.BigIntegerField()
+    length = models.BigIntegerField()
+
+    def __str__(self):
+        return f"{self.image_id} at {self.segment}:{self.offset}"
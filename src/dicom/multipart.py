@@ -0,0 +1,70 @@
+class MultipartReader:
+    """
+    Incremental multipart/related parser over a file-like request body
+
+    Iterating yields (headers, chunks) for each part, `headers` with
+    lowercased names and `chunks` an iterator over the part's body that
+    must be consumed before the next part is requested. Only
+    `chunk_size` bytes plus a boundary's worth are held at any time.
+    """
+
+    def __init__(self, stream, boundary, chunk_size=65536, max_header_size=16384):
+        if isinstance(boundary, str):
+            boundary = boundary.encode("ascii")
+        self.stream = stream
+        self.delimiter = b"\r\n--" + boundary
+        self.chunk_size = chunk_size
+        self.max_header_size = max_header_size
+        # Lets the first boundary, which has no leading CRLF, match too
+        self.buffer = b"\r\n"
+
+    def _fill(self):
+        chunk = self.stream.read(self.chunk_size)
+        if not chunk:
+            return False
+        self.buffer += chunk
+        return True
+
+    def _until_delimiter(self):
+        """Yield the bytes up to the next delimiter and consume it."""
+        keep = len(self.delimiter) - 1
+        while True:
+            index = self.buffer.find(self.delimiter)
+            if index >= 0:
+                if index:
+                    yield self.buffer[:index]
+                self.buffer = self.buffer[index + len(self.delimiter) :]
+                return
+            if len(self.buffer) > keep:
+                yield self.buffer[:-keep]
+                self.buffer = self.buffer[-keep:]
+            if not self._fill():
+                raise ValueError("Multipart body ended before its closing boundary")
+
+    def _headers(self):
+        while b"\r\n\r\n" not in self.buffer:
+            if len(self.buffer) > self.max_header_size:
+                raise ValueError("Multipart part headers are too large")
+            if not self._fill():
+                raise ValueError("Multipart body ended in part headers")
+        # The delimiter line's CRLF, then headers up to the blank line
+        head, self.buffer = self.buffer.split(b"\r\n\r\n", 1)
+        head = head.split(b"\r\n", 1)[1] if b"\r\n" in head else b""
+        headers = {}
+        for line in head.decode("latin-1").split("\r\n"):
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+        return headers
+
+    def __iter__(self):
+        # Discard the preamble
+        for _ in self._until_delimiter():
+            pass
+        while True:
+            while len(self.buffer) < 2:
+                if not self._fill():
+                    raise ValueError("Multipart body ended after a boundary")
+            if self.buffer.startswith(b"--"):
+                return
+            yield self._headers(), self._until_delimiter()
@@ -0,0 +1,133 @@
+from struct import unpack
+
+from pydicom import dcmread
+from pydicom.uid import DeflatedExplicitVRLittleEndian, ImplicitVRLittleEndian
+
+PIXEL_DATA_TAG = b"\xe0\x7f\x10\x00"
+ITEM_TAG = (0xFFFE, 0xE000)
+SEQUENCE_DELIMITER_TAG = (0xFFFE, 0xE0DD)
+UNDEFINED_LENGTH = 0xFFFFFFFF
+
+
+class NoPixelData(ValueError):
+    pass
+
+
+class UnknownFrameLayout(ValueError):
+    """The frames can't be told apart without decoding the Pixel Data"""
+
+
+def locate_pixel_data(path):
+    """
+    Find the Pixel Data value of a stored little endian file without
+    reading it.
+
+    Returns (dataset, offset, length), the dataset holding everything
+    before the pixel data and `length` None for encapsulated pixel data.
+    """
+    with open(path, "rb") as f:
+        dataset = dcmread(f, stop_before_pixels=True)
+        if dataset.file_meta.TransferSyntaxUID == DeflatedExplicitVRLittleEndian:
+            # File offsets don't map onto the inflated dataset
+            raise ValueError(f"Pixel Data of deflated {path} can't be located")
+        start = f.tell()
+        header = f.read(12)
+    if header[:4] != PIXEL_DATA_TAG:
+        raise NoPixelData(f"No Pixel Data in {path}")
+
+    if dataset.file_meta.TransferSyntaxUID == ImplicitVRLittleEndian:
+        (length,) = unpack("<I", header[4:8])
+        offset = start + 8
+    else:
+        (length,) = unpack("<I", header[8:12])
+        offset = start + 12
+    return dataset, offset, None if length == UNDEFINED_LENGTH else length
+
+
+def _items(f, offset):
+    """Return [(offset, length), ...] of the items of encapsulated pixel data"""
+    f.seek(offset)
+    items = []
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            raise ValueError("Truncated encapsulated Pixel Data")
+        group, element, length = unpack("<HHI", header)
+        if (group, element) == SEQUENCE_DELIMITER_TAG:
+            return items
+        if (group, element) != ITEM_TAG:
+            raise ValueError(f"Unexpected tag ({group:04X},{element:04X})")
+        items.append((f.tell(), length))
+        f.seek(length, 1)
+
+
+def frame_table(path):
+    """
+    Scan a stored instance for its frames, seeking over pixel data.
+
+    Returns (pixel data offset, pixel data length, frames) where `frames`
+    lists [(offset, length), ...] per frame (an encapsulated frame may
+    span several fragments) and the length is None when encapsulated.
+    """
+    dataset, offset, length = locate_pixel_data(path)
+    return offset, length, _frame_ranges(path, dataset, offset, length)
+
+
+def frame_ranges(path):
+    """Return the byte ranges of every frame of a stored instance."""
+    return frame_table(path)[2]
+
+
+def native_frame_length(dataset):
+    """
+    Return the byte length of each native frame of a dataset. 1-bit frames
+    aren't byte aligned, so only a single one can be located.
+    """
+    frames = int(dataset.get("NumberOfFrames") or 1)
+    bits = (
+        dataset.Rows
+        * dataset.Columns
+        * dataset.get("SamplesPerPixel", 1)
+        * dataset.BitsAllocated
+    )
+    if bits % 8 and frames > 1:
+        raise ValueError(f"{dataset.BitsAllocated}-bit frames aren't byte aligned")
+    return (bits + 7) // 8
+
+
+def _frame_ranges(path, dataset, offset, length):
+    frames = int(dataset.get("NumberOfFrames") or 1)
+
+    if length is not None:
+        # The value may end with a padding byte, frames are sized by attribute
+        frame_length = native_frame_length(dataset)
+        if frame_length * frames > length:
+            raise ValueError("Pixel Data is shorter than its frames")
+        return [
+            [(offset + index * frame_length, frame_length)] for index in range(frames)
+        ]
+
+    with open(path, "rb") as f:
+        (bot_offset, bot_length), *fragments = _items(f, offset)
+        f.seek(bot_offset)
+        offsets = list(unpack(f"<{bot_length // 4}I", f.read(bot_length)))
+
+    if frames == 1:
+        return [fragments]
+    if not offsets and "ExtendedOffsetTable" in dataset:
+        table = dataset.ExtendedOffsetTable
+        offsets = list(unpack(f"<{len(table) // 8}Q", table))
+    if not offsets and len(fragments) == frames:
+        return [[fragment] for fragment in fragments]
+    if len(offsets) != frames:
+        raise UnknownFrameLayout("Unable to tell the fragments of each frame apart")
+
+    # Offset table entries are relative to the first fragment's item tag
+    first = fragments[0][0] - 8
+    ranges = [[] for _ in range(frames)]
+    index = 0
+    for fragment in fragments:
+        while index + 1 < frames and fragment[0] - 8 - first >= offsets[index + 1]:
+            index += 1
+        ranges[index].append(fragment)
+    return ranges
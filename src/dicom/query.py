@@ -0,0 +1,293 @@
+import re
+from datetime import datetime
+from itertools import islice
+
+from django.db import connection
+from django.db.models import Q
+from pydicom.dataset import Dataset
+from pydicom.multival import MultiValue
+from pynetdicom.sop_class import StudyRootQueryRetrieveInformationModelFind
+
+from dicom.models import Instance, Patient, Series, Study
+
+# Number of rows fetched from the database per round trip
+FIND_CHUNK_SIZE = 500
+
+# DICOM keyword -> (model field, kind). The kind decides how a matching key
+# is translated into a lookup and how the value is encoded in responses.
+PATIENT_ATTRIBUTES = {
+    "PatientID": ("patient_id", "text"),
+    "PatientName": ("patient_name", "text"),
+    "PatientBirthDate": ("birth_date", "date"),
+    "PatientSex": ("sex", "text"),
+    "NumberOfPatientRelatedStudies": ("study_count", "count"),
+}
+
+STUDY_ATTRIBUTES = {
+    "StudyInstanceUID": ("study_instance_uid", "text"),
+    "StudyDate": ("study_date", "date"),
+    "StudyTime": ("study_time", "time"),
+    "AccessionNumber": ("accession_number", "text"),
+    "StudyID": ("study_id", "text"),
+    "StudyDescription": ("study_description", "text"),
+    "ReferringPhysicianName": ("referring_physician_name", "text"),
+    "ModalitiesInStudy": ("series__modality", "modalities"),
+    "NumberOfStudyRelatedSeries": ("series_count", "count"),
+    "NumberOfStudyRelatedInstances": ("instance_count", "count"),
+}
+
+SERIES_ATTRIBUTES = {
+    "SeriesInstanceUID": ("series_instance_uid", "text"),
+    "Modality": ("modality", "text"),
+    "SeriesNumber": ("series_number", "int"),
+    "SeriesDate": ("series_date", "date"),
+    "SeriesDescription": ("series_description", "text"),
+    "BodyPartExamined": ("body_part_examined", "text"),
+    "NumberOfSeriesRelatedInstances": ("instance_count", "count"),
+}
+
+INSTANCE_ATTRIBUTES = {
+    "SOPInstanceUID": ("sop_instance_uid", "text"),
+    "SOPClassUID": ("sop_class_uid", "text"),
+    "InstanceNumber": ("instance_number", "int"),
+    "Rows": ("rows", "count"),
+    "Columns": ("columns", "count"),
+    "NumberOfFrames": ("number_of_frames", "count"),
+}
+
+# Query level -> (model, unique key, [(lookup prefix, attributes), ...])
+LEVELS = {
+    "PATIENT": (Patient, "PatientID", [("", PATIENT_ATTRIBUTES)]),
+    "STUDY": (
+        Study,
+        "StudyInstanceUID",
+        [("", STUDY_ATTRIBUTES), ("patient__", PATIENT_ATTRIBUTES)],
+    ),
+    "SERIES": (
+        Series,
+        "SeriesInstanceUID",
+        [
+            ("", SERIES_ATTRIBUTES),
+            ("study__", STUDY_ATTRIBUTES),
+            ("study__patient__", PATIENT_ATTRIBUTES),
+        ],
+    ),
+    "IMAGE": (
+        Instance,
+        "SOPInstanceUID",
+        [
+            ("", INSTANCE_ATTRIBUTES),
+            ("series__", SERIES_ATTRIBUTES),
+            ("series__study__", STUDY_ATTRIBUTES),
+            ("series__study__patient__", PATIENT_ATTRIBUTES),
+        ],
+    ),
+}
+
+
+def level_attributes(level):
+    """Return {keyword: (lookup, kind)} for every attribute known at `level`."""
+    attributes = {}
+    for prefix, group in LEVELS[level][2]:
+        for keyword, (field, kind) in group.items():
+            attributes.setdefault(keyword, (f"{prefix}{field}", kind))
+    return attributes
+
+
+def _wildcard_lookup(lookup, value):
+    if "?" not in value and "*" not in value[:-1]:
+        # A trailing '*' is a prefix match, which can use the column index
+        return Q(**{f"{lookup}__startswith": value[:-1]})
+    pattern = "".join(
+        ".*" if char == "*" else "." if char == "?" else re.escape(char)
+        for char in value
+    )
+    return Q(**{f"{lookup}__regex": f"^{pattern}$"})
+
+
+def _parse_date(value):
+    return datetime.strptime(value.strip(), "%Y%m%d").date()
+
+
+def _pad_time(value, fill):
+    """Pad a (partial) TM value to HHMMSS.FFFFFF with `fill` digits."""
+    value = value.strip().replace(":", "")
+    seconds, _, fraction = value.partition(".")
+    return f"{seconds.ljust(6, fill)}.{fraction.ljust(6, fill)}"
+
+
+def _time_start(value):
+    # Padded with 0s, then the trailing 0s dropped again: stored times are
+    # text of any precision, and a stored "0900" sorts before "090000"
+    return _pad_time(value, "0").rstrip("0").rstrip(".").rstrip("0")
+
+
+def _time_end(value):
+    return _pad_time(value, "9")
+
+
+def _range_lookup(lookup, value, parse, parse_end=None):
+    parse_end = parse_end or parse
+    if "-" not in value:
+        return Q(**{lookup: parse(value)})
+    start, end = value.split("-", 1)
+    if start and end:
+        return Q(**{f"{lookup}__range": (parse(start), parse_end(end))})
+    if start:
+        return Q(**{f"{lookup}__gte": parse(start)})
+    return Q(**{f"{lookup}__lte": parse_end(end)})
+
+
+def match_filter(lookup, kind, value):
+    """
+    Translate one DICOM matching key into a Q object, or None for universal
+    matching. Raises ValueError for values that can't be matched.
+    """
+    if isinstance(value, MultiValue):
+        values = [str(v) for v in value]
+        if kind in ("text", "modalities"):
+            return Q(**{f"{lookup}__in": values})
+        raise ValueError(f"List matching isn't supported for {lookup}")
+
+    value = "" if value is None else str(value)
+    if value in ("", "*") or kind == "count":
+        return None
+    if kind == "modalities":
+        return Q(**{f"{lookup}__in": [value]})
+    if kind == "date":
+        return _range_lookup(lookup, value, _parse_date)
+    if kind == "time":
+        if "-" not in value:
+            return Q(**{lookup: value.replace(":", "")})
+        # Stored times are compared as text, so the bounds are padded to
+        # full precision
+        return _range_lookup(lookup, value, _time_start, _time_end)
+    if kind == "int":
+        return Q(**{lookup: int(value)})
+    if "*" in value or "?" in value:
+        return _wildcard_lookup(lookup, value)
+    return Q(**{lookup: value})
+
+
+def build_queryset(level, identifier):
+    """
+    Return the queryset matching a C-FIND identifier and the response
+    fields as [(keyword, lookup, kind), ...].
+    """
+    model, unique_key, _ = LEVELS[level]
+    attributes = level_attributes(level)
+
+    queryset = model.objects.all()
+    fields = []
+    distinct = False
+    for element in identifier:
+        keyword = element.keyword
+        if keyword not in attributes:
+            continue
+        lookup, kind = attributes[keyword]
+        condition = match_filter(lookup, kind, element.value)
+        if condition is not None:
+            queryset = queryset.filter(condition)
+            distinct = distinct or kind == "modalities"
+        fields.append((keyword, lookup, kind))
+
+    if unique_key not in {keyword for keyword, _, _ in fields}:
+        lookup, kind = attributes[unique_key]
+        fields.append((unique_key, lookup, kind))
+    if distinct:
+        queryset = queryset.distinct()
+    return queryset, fields
+
+
+def _study_pk_lookup(level):
+    prefix = next(
+        prefix for prefix, group in LEVELS[level][2] if group is STUDY_ATTRIBUTES
+    )
+    return f"{prefix}pk"
+
+
+def _modalities(study_lookup, rows):
+    study_ids = {row[study_lookup] for row in rows}
+    modalities = {}
+    for study_id, modality in (
+        Series.objects.filter(study_id__in=study_ids)
+        .values_list("study_id", "modality")
+        .distinct()
+    ):
+        modalities.setdefault(study_id, []).append(modality)
+    return modalities
+
+
+def _encode(kind, value):
+    if value is None:
+        return None
+    if kind == "date":
+        return value.strftime("%Y%m%d")
+    return value
+
+
+def matches(level, queryset, fields, charset=None):
+    """
+    Yield (pk, Dataset) for every row of a `build_queryset()` queryset,
+    fetching rows from the index in chunks instead of materializing them.
+    """
+    values = ["pk"] + [lookup for _, lookup, kind in fields if kind != "modalities"]
+    study_lookup = None
+    if any(kind == "modalities" for _, _, kind in fields):
+        study_lookup = _study_pk_lookup(level)
+        values.append(study_lookup)
+
+    iterator = queryset.values(*values).iterator(chunk_size=FIND_CHUNK_SIZE)
+    while rows := list(islice(iterator, FIND_CHUNK_SIZE)):
+        modalities = _modalities(study_lookup, rows) if study_lookup else {}
+        for row in rows:
+            dataset = Dataset()
+            if charset:
+                dataset.SpecificCharacterSet = charset
+            for keyword, lookup, kind in fields:
+                if kind == "modalities":
+                    value = modalities.get(row[study_lookup], [])
+                else:
+                    value = _encode(kind, row[lookup])
+                setattr(dataset, keyword, value)
+            yield row["pk"], dataset
+
+
+def find_responses(level, identifier, is_cancelled=lambda: False):
+    """
+    Yield C-FIND (status, identifier) responses for a query as the matches
+    are read from the index.
+    """
+    try:
+        queryset, fields = build_queryset(level, identifier)
+    except ValueError as e:
+        print(f" Unable to process C-FIND query: {e}")
+        yield 0xC000, None
+        return
+
+    charset = identifier.get("SpecificCharacterSet")
+    for _, response in matches(level, queryset, fields, charset):
+        if is_cancelled():
+            yield 0xFE00, None
+            return
+        response.QueryRetrieveLevel = level
+        yield 0xFF00, response
+
+
+def handle_find(event):
+    """Handle EVT_C_FIND events from the Patient and Study Root models."""
+    try:
+        identifier = event.identifier
+        level = identifier.get("QueryRetrieveLevel", "")
+        study_root = (
+            event.request.AffectedSOPClassUID
+            == StudyRootQueryRetrieveInformationModelFind
+        )
+        if level not in LEVELS or (study_root and level == "PATIENT"):
+            # Identifier does not match SOP Class
+            yield 0xA900, None
+            return
+
+        yield from find_responses(level, identifier, lambda: event.is_cancelled)
+    finally:
+        connection.close()
@@ -0,0 +1,79 @@
+import numpy as np
+from PIL import Image
+
+from dicom import rendering
+
+# Plane name -> volume axis, the volume being (slices, rows, columns)
+PLANES = {"axial": 0, "coronal": 1, "sagittal": 2}
+
+PROJECTIONS = {
+    "mip": lambda block, axis: block.max(axis=axis),
+    "minip": lambda block, axis: block.min(axis=axis),
+    "mean": lambda block, axis: block.mean(axis=axis, dtype=np.float32),
+}
+
+
+def slab_voxels(volume, axis, thickness):
+    """Number of voxels along `axis` covering `thickness` mm, at least 1."""
+    if not thickness:
+        return 1
+    return max(int(round(thickness / volume.spacing[axis])), 1)
+
+
+def reformat(volume, axis, index=None, slab=1, projection="mip"):
+    """
+    Cut a plane through `volume` perpendicular to `axis`, or project a slab
+    of `slab` voxels centered on `index` with `projection`.
+
+    Returns the 2-D stored-value image and its (row, column) spacing. Works
+    on a view of the memmap, so only the voxels of the slab are read.
+    """
+    length = volume.array.shape[axis]
+    if index is None:
+        index = length // 2
+    if not 0 <= index < length:
+        raise IndexError(f"Index {index} out of range 0-{length - 1}")
+
+    start = min(max(index - slab // 2, 0), max(length - slab, 0))
+    selection = [slice(None)] * 3
+    selection[axis] = slice(start, start + slab)
+    block = volume.array[tuple(selection)]
+    image = PROJECTIONS[projection](block, axis) if slab > 1 else block.squeeze(axis)
+
+    spacing = [s for position, s in enumerate(volume.spacing) if position != axis]
+    if axis != 0:
+        # Slices are ordered feet to head; show the head at the top
+        image = image[::-1]
+    return image, tuple(spacing)
+
+
+def render_reformat(
+    volume,
+    axis,
+    index=None,
+    slab=1,
+    projection="mip",
+    window=None,
+    viewport=None,
+    image_format="jpeg",
+    quality=None,
+):
+    """
+    Reformat a volume, window it and encode it, resampled so its pixels
+    are square in patient space.
+    """
+    image, (row_spacing, column_spacing) = reformat(
+        volume, axis, index, slab, projection
+    )
+    window = window or volume.header.get("window")
+    display = rendering.linear_voi(
+        volume.modality(image),
+        window,
+        volume.header["photometric_interpretation"] == "MONOCHROME1",
+    )
+
+    picture = Image.fromarray(display)
+    if row_spacing != column_spacing:
+        height = max(int(round(display.shape[0] * row_spacing / column_spacing)), 1)
+        picture = picture.resize((display.shape[1], height), Image.Resampling.BILINEAR)
+    return rendering.encode_image(picture, viewport, image_format, quality)
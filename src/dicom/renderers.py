@@ -0,0 +1,9 @@
+from rest_framework.renderers import JSONRenderer
+
+
+class DicomJSONRenderer(JSONRenderer):
+    """
+    Renders DICOM JSON Model responses (PS3.18 F.2)
+    """
+
+    media_type = "application/dicom+json"
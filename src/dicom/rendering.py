@@ -0,0 +1,255 @@
+import hashlib
+import os
+import threading
+import uuid
+from io import BytesIO
+
+import numpy as np
+from django.conf import settings
+from PIL import Image
+from pydicom import dcmread
+from pydicom.pixels import pixel_array
+from pydicom.uid import DeflatedExplicitVRLittleEndian
+
+from dicom import pixeldata
+
+MEDIA_TYPES = {"jpeg": "image/jpeg", "png": "image/png"}
+
+
+def _first(value):
+    """First value of a possibly multi-valued element"""
+    try:
+        return float(value[0])
+    except TypeError:
+        return float(value)
+
+
+def voi_window(dataset, window=None):
+    """
+    Return the (center, width) to render with: the requested window, else
+    the first window stored in the dataset, else None for min/max.
+    """
+    if window is not None:
+        return window
+    if "WindowCenter" in dataset and "WindowWidth" in dataset:
+        return _first(dataset.WindowCenter), _first(dataset.WindowWidth)
+    return None
+
+
+# Largest stored value range tabulated into a LUT, wider ranges (e.g. 32 bit
+# data) are mapped pixel by pixel
+MAX_LUT_SIZE = 1 << 20
+
+
+def linear_voi(values, window, invert=False):
+    """
+    Apply the linear VOI LUT function (PS3.3 C.11.2.1.2) to modality
+    values, giving uint8 display values. Without a window the full range
+    of `values` is shown.
+    """
+    if window is None:
+        low, high = float(values.min()), float(values.max())
+        center, width = (low + high) / 2, high - low
+    else:
+        center, width = window
+    width = max(width, 2)
+
+    display = np.clip(((values - (center - 0.5)) / (width - 1) + 0.5) * 255, 0, 255)
+    if invert:
+        display = 255 - display
+    return display.astype(np.uint8)
+
+
+def modality_values(dataset, stored):
+    """Apply the Modality LUT (Rescale Slope/Intercept) to stored values."""
+    slope = float(dataset.get("RescaleSlope", 1) or 1)
+    intercept = float(dataset.get("RescaleIntercept", 0) or 0)
+    return stored.astype(np.float32) * slope + intercept
+
+
+def to_display(dataset, frame_pixels, window=None):
+    """Map a frame's stored values to 8 bit display values."""
+    if frame_pixels.ndim == 3:
+        # Colour images are shown as decoded
+        if frame_pixels.dtype != np.uint8:
+            shift = max(int(dataset.get("BitsStored", 8)) - 8, 0)
+            frame_pixels = (frame_pixels >> shift).astype(np.uint8)
+        return frame_pixels
+
+    window = voi_window(dataset, window)
+    invert = dataset.get("PhotometricInterpretation") == "MONOCHROME1"
+    if np.issubdtype(frame_pixels.dtype, np.integer):
+        low, high = int(frame_pixels.min()), int(frame_pixels.max())
+        if high - low < MAX_LUT_SIZE:
+            # Evaluate the pipeline once per stored value, then index
+            stored = np.arange(low, high + 1, dtype=np.int64)
+            lut = linear_voi(modality_values(dataset, stored), window, invert)
+            return lut[frame_pixels.astype(np.int64) - low]
+    return linear_voi(modality_values(dataset, frame_pixels), window, invert)
+
+
+def decode_frame(path, dataset, index):
+    """
+    Decode frame `index` (0-based) of a stored instance, whatever transfer
+    syntax it was stored in. Compressed pixel data is only decompressed
+    here, when pixels are actually needed.
+    """
+    try:
+        if dataset.file_meta.TransferSyntaxUID == DeflatedExplicitVRLittleEndian:
+            # The whole dataset has to be inflated before the pixels are reached
+            pixels = dcmread(path).pixel_array
+            frames = int(dataset.get("NumberOfFrames") or 1)
+            return pixels[index] if frames > 1 else pixels
+        # Otherwise only the requested frame is read and decoded
+        return pixel_array(path, index=index)
+    except AttributeError as e:
+        # pydicom's way of saying there are no pixels to decode
+        raise pixeldata.NoPixelData(str(e))
+
+
+def render_frame(
+    path, frame, window=None, viewport=None, image_format="jpeg", quality=None
+):
+    """
+    Decode one frame (1-based) of a stored instance and encode it as a
+    JPEG or PNG, fitted into `viewport` (width, height) when given.
+    """
+    dataset = dcmread(path, stop_before_pixels=True)
+    frames = int(dataset.get("NumberOfFrames") or 1)
+    if frame < 1 or frame > frames:
+        raise IndexError(f"Frame {frame} out of range 1-{frames}")
+    frame_pixels = decode_frame(path, dataset, frame - 1)
+
+    return encode_image(
+        Image.fromarray(to_display(dataset, frame_pixels, window)),
+        viewport,
+        image_format,
+        quality,
+    )
+
+
+def encode_image(image, viewport=None, image_format="jpeg", quality=None):
+    """Encode a PIL image as JPEG or PNG, fitted into `viewport` if given."""
+    if viewport is not None:
+        image.thumbnail(viewport, Image.Resampling.LANCZOS)
+
+    buffer = BytesIO()
+    if image_format == "jpeg":
+        quality = quality or settings.DICOMWEB_RENDER_JPEG_QUALITY
+        image.save(buffer, "JPEG", quality=quality)
+    else:
+        image.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def write_thumbnail(src, dst, size, quality):
+    """
+    Render the middle frame of `src` into a JPEG at `dst` fitting `size` x
+    `size`. Returns an error message instead of raising, as it runs in a
+    process pool without Django set up.
+    """
+    try:
+        dataset = dcmread(src, stop_before_pixels=True)
+        frame = (int(dataset.get("NumberOfFrames") or 1) + 1) // 2
+        data = render_frame(src, frame, viewport=(size, size), quality=quality)
+        # Packed instances have no directory of their own to sit next to
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        part_path = f"{dst}.{uuid.uuid4().hex}.part"
+        with open(part_path, "wb") as f:
+            f.write(data)
+        os.replace(part_path, dst)
+    except Exception as e:
+        return f"{src}: {e}"
+    return None
+
+
+class RenderCache:
+    """
+    Size-bounded on-disk LRU cache of rendered frames
+
+    Entries are files named after a hash of their key; a hit bumps the
+    file's mtime, and when the cache grows past `max_bytes` the least
+    recently used files are removed until it's back under
+    `low_water` of the limit. The running size is kept per process and
+    recomputed from disk on each eviction, so processes sharing the
+    directory keep each other honest.
+    """
+
+    def __init__(self, directory, max_bytes, low_water=0.9):
+        self.directory = str(directory)
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        self._size = None
+        self._lock = threading.Lock()
+
+    def path(self, key):
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            return None
+        return data
+
+    def put(self, key, data):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        part_path = f"{path}.{uuid.uuid4().hex}.part"
+        with open(part_path, "wb") as f:
+            f.write(data)
+        os.replace(part_path, path)
+
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan_size()
+            self._size += len(data)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(".part"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _scan_size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self):
+        entries = sorted(self._entries())
+        size = sum(entry[1] for entry in entries)
+        target = self.max_bytes * self.low_water
+        for _, entry_size, path in entries:
+            if size <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+        self._size = size
+
+
+_render_cache = None
+
+
+def render_cache():
+    global _render_cache
+    if _render_cache is None:
+        _render_cache = RenderCache(
+            settings.DICOMWEB_RENDER_CACHE_DIR, settings.DICOMWEB_RENDER_CACHE_SIZE
+        )
+    return _render_cache
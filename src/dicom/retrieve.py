@@ -0,0 +1,196 @@
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+from pydicom import dcmread
+from pydicom.dataset import Dataset
+from pydicom.errors import InvalidDicomError
+from pynetdicom import AE
+
+from dicom import compression, query, storage
+
+# Number of instance rows fetched from the database per round trip
+RETRIEVE_CHUNK_SIZE = 500
+
+
+def move_destinations():
+    """
+    Parse DICOM_MOVE_DESTINATIONS ("AET=host:port,AET2=host:port") into
+    {ae_title: (host, port)}.
+    """
+    destinations = {}
+    for entry in settings.DICOM_MOVE_DESTINATIONS.split(","):
+        if not entry.strip():
+            continue
+        ae_title, address = entry.strip().split("=", 1)
+        host, port = address.rsplit(":", 1)
+        destinations[ae_title] = (host, int(port))
+    return destinations
+
+
+class PooledAssociation:
+    """
+    Stand-in for an outbound Association handed to pynetdicom's C-MOVE SCP:
+    `release()` gives the association back to the pool instead of closing it.
+    """
+
+    def __init__(self, pool, key, assoc):
+        self._pool = pool
+        self._key = key
+        self._assoc = assoc
+
+    def release(self):
+        self._pool.put_back(self._key, self._assoc)
+
+    def __getattr__(self, name):
+        return getattr(self._assoc, name)
+
+
+class AssociationPool:
+    """
+    Idle outbound associations per (address, port, AE title), so back to back
+    C-MOVEs to the same destination don't pay for a new association each.
+    """
+
+    def __init__(self, idle_timeout=60):
+        self.idle_timeout = idle_timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key, associate):
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                assoc, released_at = idle.pop()
+                if (
+                    assoc.is_established
+                    and time.monotonic() - released_at < self.idle_timeout
+                ):
+                    return PooledAssociation(self, key, assoc)
+                self._close(assoc)
+
+        assoc = associate()
+        if not assoc.is_established:
+            return assoc
+        return PooledAssociation(self, key, assoc)
+
+    def put_back(self, key, assoc):
+        if not assoc.is_established:
+            return
+        with self._lock:
+            self._idle.setdefault(key, []).append((assoc, time.monotonic()))
+
+    def close_all(self):
+        with self._lock:
+            for idle in self._idle.values():
+                for assoc, _ in idle:
+                    self._close(assoc)
+            self._idle = {}
+
+    def _close(self, assoc):
+        if assoc.is_established:
+            assoc.release()
+
+
+class PooledAE(AE):
+    """
+    Application entity whose outbound associations (the C-STORE
+    sub-operations of C-MOVE) come from an AssociationPool.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.association_pool = AssociationPool(settings.DICOM_ASSOCIATION_IDLE_TIMEOUT)
+
+    def associate(self, addr, port, contexts=None, ae_title="ANY-SCP", **kwargs):
+        if contexts is not None:
+            # Custom contexts can't be matched against pooled associations
+            return super().associate(addr, port, contexts, ae_title, **kwargs)
+        return self.association_pool.acquire(
+            (addr, port, ae_title),
+            lambda: super(PooledAE, self).associate(
+                addr, port, ae_title=ae_title, **kwargs
+            ),
+        )
+
+    def shutdown(self):
+        super().shutdown()
+        self.association_pool.close_all()
+
+
+def matching_instances(identifier):
+    """
+    Return the Instance queryset selected by a C-MOVE/C-GET identifier.
+    """
+    level = identifier.get("QueryRetrieveLevel", "")
+    if level not in query.LEVELS:
+        raise ValueError(f"Unknown Query/Retrieve level '{level}'")
+    unique_key = query.LEVELS[level][1]
+    if not identifier.get(unique_key):
+        raise ValueError(f"{unique_key} is required at the {level} level")
+
+    queryset, _ = query.build_queryset("IMAGE", identifier)
+    return queryset
+
+
+def instance_datasets(queryset, is_cancelled):
+    """
+    Lazily read matching instances from storage, one at a time, as
+    (status, dataset) pairs for the C-GET/C-MOVE SCP. Instances compressed
+    at rest are sent in the transfer syntax they were received in.
+    """
+    rows = queryset.values_list(
+        "sop_instance_uid",
+        "image__image",
+        "transfer_syntax_uid",
+        "stored_transfer_syntax_uid",
+    ).iterator(chunk_size=RETRIEVE_CHUNK_SIZE)
+    for sop_instance_uid, name, transfer_syntax_uid, stored in rows:
+        if is_cancelled():
+            yield 0xFE00, None
+            return
+        try:
+            if stored:
+                dataset = compression.restore(
+                    storage.absolute_path(name), transfer_syntax_uid
+                )
+            else:
+                dataset = dcmread(storage.absolute_path(name))
+        except (OSError, TypeError, ValueError, RuntimeError, InvalidDicomError) as e:
+            print(f" Unable to read stored instance {sop_instance_uid}: {e}")
+            # Sending this fails the sub-operation and lists the instance
+            dataset = Dataset()
+            dataset.SOPInstanceUID = sop_instance_uid
+        yield 0xFF00, dataset
+
+
+def handle_get(event):
+    """Handle EVT_C_GET events, sending instances back over the association."""
+    try:
+        queryset = matching_instances(event.identifier)
+        count = queryset.count()
+        print(f" C-GET: sending {count} instances")
+        yield count
+        yield from instance_datasets(queryset, lambda: event.is_cancelled)
+    finally:
+        connection.close()
+
+
+def handle_move(event):
+    """Handle EVT_C_MOVE events, sending instances to a known destination."""
+    try:
+        destination = move_destinations().get(event.move_destination.strip())
+        if destination is None:
+            print(f" Unknown C-MOVE destination: {event.move_destination}")
+            yield None, None
+            return
+
+        yield destination
+        queryset = matching_instances(event.identifier)
+        count = queryset.count()
+        print(f" C-MOVE: sending {count} instances to {event.move_destination}")
+        yield count
+        yield from instance_datasets(queryset, lambda: event.is_cancelled)
+    finally:
+        connection.close()
@@ -0,0 +1,111 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+import numpy as np
+from django.conf import settings
+
+from dicom import volumes
+
+
+def _clip_box(shape, start, end):
+    return tuple(
+        slice(min(max(low, 0), size), min(max(high, 0), size))
+        for low, high, size in zip(start, end, shape)
+    )
+
+
+def roi_voxels(volume, roi):
+    """
+    Return the stored values inside an ROI, reading only its bounding box
+    from the memmap.
+    """
+    shape = volume.array.shape
+    if roi["type"] == "box":
+        return volume.array[_clip_box(shape, roi["start"], roi["end"])].ravel()
+
+    center = np.asarray(roi["center"], dtype=np.float64)
+    spacing = np.asarray(volume.spacing, dtype=np.float64)
+    reach = roi["radius"] / spacing
+    start = np.floor(center - reach).astype(int)
+    end = np.ceil(center + reach).astype(int) + 1
+    box = _clip_box(shape, start, end)
+    block = volume.array[box]
+
+    # Distance in mm of every voxel of the box, by broadcasting per axis
+    grids = np.ogrid[tuple(slice(s.start, s.stop) for s in box)]
+    distance = sum(((grid - c) * s) ** 2 for grid, c, s in zip(grids, center, spacing))
+    return block[distance <= roi["radius"] ** 2]
+
+
+def roi_stats(volume, roi):
+    """
+    Mean, standard deviation, min and max of an ROI in modality units.
+
+    Reductions run on the stored values; Rescale Slope/Intercept is
+    applied to the four results only, not to every voxel.
+    """
+    voxels = roi_voxels(volume, roi)
+    stats = {"name": roi.get("name", ""), "count": int(voxels.size)}
+    if not voxels.size:
+        return {**stats, "mean": None, "std": None, "min": None, "max": None}
+
+    slope, intercept = volume.slope, volume.intercept
+    low, high = float(voxels.min()), float(voxels.max())
+    if slope < 0:
+        low, high = high, low
+    return {
+        **stats,
+        "mean": float(voxels.mean(dtype=np.float64)) * slope + intercept,
+        "std": float(voxels.std(dtype=np.float64)) * abs(slope),
+        "min": low * slope + intercept,
+        "max": high * slope + intercept,
+    }
+
+
+def series_stats(series_instance_uid, rois):
+    """Compute ROI statistics over a series' cached volume."""
+    try:
+        volume = volumes.volume_cache().get(series_instance_uid)
+    except (LookupError, ValueError, OSError) as e:
+        return {"series_instance_uid": series_instance_uid, "error": str(e)}
+    return {
+        "series_instance_uid": series_instance_uid,
+        "rois": [roi_stats(volume, roi) for roi in rois],
+    }
+
+
+_stats_pool = None
+_stats_pool_lock = threading.Lock()
+
+
+def stats_pool():
+    """
+    Return this process's ROI statistics pool, started on first use.
+
+    Workers are spawned and set Django up themselves, as callers may be
+    multi-threaded web or receiver processes.
+    """
+    global _stats_pool
+    with _stats_pool_lock:
+        if _stats_pool is None:
+            _stats_pool = ProcessPoolExecutor(
+                settings.DICOM_ROI_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=django.setup,
+            )
+        return _stats_pool
+
+
+def batch_stats(requests):
+    """
+    Compute statistics for [(series UID, rois), ...], one series per pool
+    task so volumes are built and reduced in parallel. Results keep the
+    order of `requests`.
+    """
+    if len(requests) == 1:
+        return [series_stats(*requests[0])]
+    pool = stats_pool()
+    futures = [pool.submit(series_stats, uid, rois) for uid, rois in requests]
+    return [future.result() for future in futures]
@@ -0,0 +1,193 @@
+import fcntl
+import os
+import threading
+import time
+import uuid
+
+from django.conf import settings
+
+from dicom.models import PackedInstance
+from dicom.rendering import RenderCache
+
+# Segment files live under MEDIA_ROOT, next to the stored files
+SEGMENT_DIR = "dicom_segments"
+
+
+def enabled():
+    """Whether small instances are packed, which needs local storage."""
+    return (
+        settings.DICOM_PACK_MAX_SIZE > 0
+        and settings.DICOM_STORAGE_BACKEND == "filesystem"
+    )
+
+
+def segment_path(segment):
+    return os.path.join(settings.MEDIA_ROOT, segment)
+
+
+def lock(fd, blocking=True):
+    """
+    Take the exclusive lock a segment is appended or compacted under.
+    Returns False when it is held elsewhere and `blocking` is False.
+    """
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+    except BlockingIOError:
+        return False
+    return True
+
+
+class SegmentWriter:
+    """
+    Appends files to this process's current segment file
+
+    Segments are append-only and only ever written by the writer that
+    created them, which holds an exclusive lock on the segment for as long
+    as it appends to it. A segment is closed once it reaches `max_size`
+    (or its process exits) and is never appended to again, so a segment
+    nobody holds the lock of can be compacted.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.segment = None
+        self._fd = None
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def append(self, data):
+        """Append `data`, returning (segment, offset) of where it went."""
+        with self._lock:
+            if self._fd is None or self._size >= self.max_size:
+                self._open()
+            offset = self._size
+            view, written = memoryview(data), 0
+            while written < len(data):
+                written += os.pwrite(self._fd, view[written:], offset + written)
+            self._size += len(data)
+            return self.segment, offset
+
+    def sync(self):
+        """Make everything appended so far durable."""
+        with self._lock:
+            if self._fd is not None:
+                os.fsync(self._fd)
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _open(self):
+        self._close()
+        os.makedirs(segment_path(SEGMENT_DIR), exist_ok=True)
+        self.segment = os.path.join(
+            SEGMENT_DIR, f"{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:12]}.seg"
+        )
+        path = segment_path(self.segment)
+        # Locked before it shows up under its name, so compaction never
+        # sees it unlocked
+        self._fd = os.open(f"{path}.part", os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        lock(self._fd)
+        os.rename(f"{path}.part", path)
+        self._size = 0
+
+    def _close(self):
+        if self._fd is not None:
+            os.fsync(self._fd)
+            os.close(self._fd)
+            self._fd = None
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = SegmentWriter(settings.DICOM_SEGMENT_SIZE)
+        return _writer
+
+
+def pack(paths):
+    """
+    Append the files at `paths` ({name: path}) that are small enough to
+    be packed to the current segment, syncing it once for all of them.
+
+    Returns {name: (segment, offset, length, stat)}, `stat` identifying the
+    packed file so it is only removed if nothing replaced it since.
+    """
+    packed = {}
+    for name, path in paths.items():
+        try:
+            stat = os.stat(path)
+            if stat.st_size > settings.DICOM_PACK_MAX_SIZE:
+                continue
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError as e:
+            print(f" Unable to pack {name}: {e}")
+            continue
+        segment, offset = writer().append(data)
+        packed[name] = (segment, offset, len(data), stat)
+    if packed:
+        writer().sync()
+    return packed
+
+
+def remove_packed(paths, packed):
+    """Remove the files that were packed, unless they were replaced since."""
+    for name, (_, _, _, stat) in packed.items():
+        path = paths[name]
+        try:
+            current = os.stat(path)
+            if (current.st_ino, current.st_mtime_ns) == (stat.st_ino, stat.st_mtime_ns):
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def locate(name):
+    """Return (segment path, offset, length) of a packed file, or None."""
+    row = (
+        PackedInstance.objects.filter(image__image=name)
+        .values_list("segment", "offset", "length")
+        .first()
+    )
+    if row is None:
+        return None
+    segment, offset, length = row
+    return segment_path(segment), offset, length
+
+
+def read(path, offset, length):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        data = os.pread(fd, length, offset)
+    finally:
+        os.close(fd)
+    if len(data) != length:
+        raise OSError(f"{path} is shorter than expected")
+    return data
+
+
+_extract_cache = None
+
+
+def extract(location):
+    """
+    Return the path of a local copy of a packed file, for readers that
+    need a file of its own (decoding, rendering, C-GET). Copies are kept in
+    a size-bounded cache keyed by location, so they are made once and
+    never go stale.
+    """
+    global _extract_cache
+    if _extract_cache is None:
+        _extract_cache = RenderCache(
+            settings.DICOM_PACK_CACHE_DIR, settings.DICOM_PACK_CACHE_SIZE
+        )
+    path = _extract_cache.path(location)
+    if not os.path.exists(path):
+        _extract_cache.put(location, read(*location))
+    return path
@@ -0,0 +1 @@
+from .roi_serializers import *
@@ -0,0 +1,41 @@
+from rest_framework import serializers
+
+
+class RoiSerializer(serializers.Serializer):
+    """
+    A box (`start`/`end` voxel corners, end exclusive) or a sphere
+    (`center` voxel and `radius` in mm), voxels as [slice, row, column]
+    """
+
+    type = serializers.ChoiceField(choices=["box", "sphere"])
+    name = serializers.CharField(required=False)
+    start = serializers.ListField(
+        child=serializers.IntegerField(min_value=0),
+        min_length=3,
+        max_length=3,
+        required=False,
+    )
+    end = serializers.ListField(
+        child=serializers.IntegerField(min_value=0),
+        min_length=3,
+        max_length=3,
+        required=False,
+    )
+    center = serializers.ListField(
+        child=serializers.FloatField(), min_length=3, max_length=3, required=False
+    )
+    radius = serializers.FloatField(min_value=0, required=False)
+
+    def validate(self, attrs):
+        required = ("start", "end") if attrs["type"] == "box" else ("center", "radius")
+        missing = [name for name in required if name not in attrs]
+        if missing:
+            raise serializers.ValidationError(
+                {name: "This field is required." for name in missing}
+            )
+        return attrs
+
+
+class SeriesRoiSerializer(serializers.Serializer):
+    series_instance_uid = serializers.CharField(max_length=64)
+    rois = RoiSerializer(many=True, allow_empty=False)
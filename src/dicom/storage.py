@@ -0,0 +1,408 @@
+import contextlib
+import errno
+import hashlib
+import os
+import re
+import shutil
+import threading
+import uuid
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from pydicom import dcmread
+
+from dicom import segments
+
+# Stored files live under MEDIA_ROOT so Image_Upload.image resolves to them
+STORAGE_DIR = "dicom_images"
+
+# UIDs come from the network and name stored files, so only well-formed
+# ones are used: dot separated numbers of at most 64 characters
+UID_PATTERN = re.compile(r"^[0-9]+(\.[0-9]+)*$")
+UID_MAX_LENGTH = 64
+
+# The only tags the receiver needs to file and index an instance
+INDEX_TAGS = [
+    "PatientID",
+    "PatientName",
+    "PatientBirthDate",
+    "PatientSex",
+    "StudyInstanceUID",
+    "StudyDate",
+    "StudyTime",
+    "AccessionNumber",
+    "StudyID",
+    "StudyDescription",
+    "ReferringPhysicianName",
+    "SeriesInstanceUID",
+    "Modality",
+    "SeriesNumber",
+    "SeriesDate",
+    "SeriesDescription",
+    "BodyPartExamined",
+    "SOPInstanceUID",
+    "SOPClassUID",
+    "InstanceNumber",
+    "Rows",
+    "Columns",
+    "NumberOfFrames",
+]
+
+
+def _replace_into(src, path):
+    """Rename `src` to `path`, falling back to copy-then-rename across filesystems."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        os.replace(src, path)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        part_path = f"{path}.{uuid.uuid4().hex}.part"
+        shutil.copyfile(src, part_path)
+        os.replace(part_path, path)
+        os.remove(src)
+
+
+class FileSystemStorage:
+    """
+    Stored files under a local root directory
+
+    Every write goes to a `.part` file first and is renamed into place, so
+    readers only ever see complete files.
+    """
+
+    def __init__(self, root):
+        self.root = str(root)
+
+    def local_path(self, name):
+        """Return where a stored file is (or would be) kept on this machine."""
+        return os.path.join(self.root, name)
+
+    def path(self, name):
+        """Return the local path of a stored file."""
+        return self.local_path(name)
+
+    def write(self, name, data):
+        path = self.local_path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        part_path = f"{path}.{uuid.uuid4().hex}.part"
+        with open(part_path, "wb") as f:
+            f.write(data)
+        os.replace(part_path, path)
+        return path
+
+    def move_into_place(self, src, name):
+        path = self.local_path(name)
+        _replace_into(src, path)
+        return path
+
+    def updated(self, name):
+        """The local file of `name` was rewritten in place."""
+
+    def exists(self, name):
+        return os.path.exists(self.path(name))
+
+    def copy(self, name, new_name):
+        """
+        Make `name` also available as `new_name`, a hard link when possible.
+        Raises FileExistsError when `new_name` is already stored.
+        """
+        src, dst = self.path(name), self.path(new_name)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        try:
+            os.link(src, dst)
+            return
+        except FileExistsError:
+            raise
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+        if os.path.exists(dst):
+            raise FileExistsError(dst)
+        part_path = f"{dst}.{uuid.uuid4().hex}.part"
+        shutil.copy2(src, part_path)
+        os.replace(part_path, dst)
+
+    def delete(self, name):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.local_path(name))
+
+
+class S3Storage(FileSystemStorage):
+    """
+    Stored files in an S3-compatible bucket, read through a size-bounded
+    local cache
+
+    The bucket is the system of record. Files are read (decoded, memory
+    mapped, served by offset) from the cache, which is filled on first use
+    and keeps what was just written. When the cache grows past `max_bytes`
+    the least recently used files are removed down to `low_water` of the
+    limit.
+    """
+
+    def __init__(
+        self,
+        bucket,
+        cache_dir,
+        max_bytes,
+        prefix="",
+        low_water=0.9,
+        **client_options,
+    ):
+        try:
+            import boto3
+            from botocore.exceptions import ClientError
+        except ImportError:
+            raise ImproperlyConfigured("The s3 storage backend needs boto3")
+
+        super().__init__(cache_dir)
+        self.bucket = bucket
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        self.client = boto3.client("s3", **client_options)
+        self._client_error = ClientError
+        self._size = None
+        self._lock = threading.Lock()
+
+    def key(self, name):
+        return f"{self.prefix}{name}"
+
+    def path(self, name):
+        """
+        Return the cached local path of a stored file, downloading it when
+        it isn't cached. A missing object gives a path that doesn't exist.
+        """
+        path = self.local_path(name)
+        try:
+            os.utime(path)
+            return path
+        except FileNotFoundError:
+            pass
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        part_path = f"{path}.{uuid.uuid4().hex}.part"
+        try:
+            self.client.download_file(self.bucket, self.key(name), part_path)
+        except self._client_error as e:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(part_path)
+            if self._missing(e):
+                return path
+            raise OSError(f"Unable to fetch {name}: {e}")
+        os.replace(part_path, path)
+        self._cached(os.path.getsize(path))
+        return path
+
+    def write(self, name, data):
+        self.client.put_object(Bucket=self.bucket, Key=self.key(name), Body=data)
+        path = super().write(name, data)
+        self._cached(len(data))
+        return path
+
+    def move_into_place(self, src, name):
+        self.client.upload_file(src, self.bucket, self.key(name))
+        path = super().move_into_place(src, name)
+        self._cached(os.path.getsize(path))
+        return path
+
+    def updated(self, name):
+        self.client.upload_file(self.local_path(name), self.bucket, self.key(name))
+
+    def exists(self, name):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.key(name))
+        except self._client_error as e:
+            if self._missing(e):
+                return False
+            raise
+        return True
+
+    def copy(self, name, new_name):
+        if self.exists(new_name):
+            raise FileExistsError(new_name)
+        self.client.copy_object(
+            Bucket=self.bucket,
+            Key=self.key(new_name),
+            CopySource={"Bucket": self.bucket, "Key": self.key(name)},
+        )
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(name))
+        super().delete(name)
+
+    @staticmethod
+    def _missing(error):
+        """Whether a ClientError means the object doesn't exist."""
+        return error.response.get("Error", {}).get("Code") in ("404", "NoSuchKey")
+
+    def _cached(self, size):
+        with self._lock:
+            if self._size is None:
+                self._size = sum(entry[1] for entry in self._entries())
+            self._size += size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        entries = []
+        for root, _, files in os.walk(self.root):
+            for name in files:
+                if name.endswith(".part"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _evict(self):
+        entries = sorted(self._entries())
+        size = sum(entry[1] for entry in entries)
+        target = self.max_bytes * self.low_water
+        for _, entry_size, path in entries:
+            if size <= target:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            size -= entry_size
+        self._size = size
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def backend():
+    """Return the storage backend selected by DICOM_STORAGE_BACKEND."""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            if settings.DICOM_STORAGE_BACKEND == "s3":
+                options = {
+                    "endpoint_url": settings.DICOM_S3_ENDPOINT_URL or None,
+                    "region_name": settings.DICOM_S3_REGION or None,
+                    "aws_access_key_id": settings.DICOM_S3_ACCESS_KEY_ID or None,
+                    "aws_secret_access_key": settings.DICOM_S3_SECRET_ACCESS_KEY
+                    or None,
+                }
+                _backend = S3Storage(
+                    settings.DICOM_S3_BUCKET,
+                    settings.DICOM_S3_CACHE_DIR,
+                    settings.DICOM_S3_CACHE_SIZE,
+                    prefix=settings.DICOM_S3_PREFIX,
+                    **options,
+                )
+            elif settings.DICOM_STORAGE_BACKEND == "filesystem":
+                _backend = FileSystemStorage(settings.MEDIA_ROOT)
+            else:
+                raise ImproperlyConfigured(
+                    f"Unknown DICOM_STORAGE_BACKEND '{settings.DICOM_STORAGE_BACKEND}'"
+                )
+        return _backend
+
+
+class InvalidUID(ValueError):
+    pass
+
+
+def checked_uid(uid):
+    """Return a UID stripped of its padding, or raise InvalidUID."""
+    uid = str(uid).strip(" \0")
+    if len(uid) > UID_MAX_LENGTH or not UID_PATTERN.fullmatch(uid):
+        raise InvalidUID(f"Invalid UID {uid[:UID_MAX_LENGTH]!r}")
+    return uid
+
+
+def patient_folder(patient_id):
+    """Directory name of a PatientID, anything but [A-Za-z0-9_-] replaced."""
+    return re.sub(r"[^A-Za-z0-9_-]", "_", str(patient_id).strip()) or "UnknownID"
+
+
+def storage_name(
+    patient_id, study_instance_uid, series_instance_uid, sop_instance_uid, version=None
+):
+    """
+    Return the name of an instance's file, of one of its later versions
+    when `version` is given.
+
+    The "sharded" DICOM_STORAGE_LAYOUT fans studies out over two levels of
+    hash-prefixed directories with a directory per series, so no directory
+    grows with the archive. "patient" is the original one directory per
+    PatientID layout.
+
+    Raises InvalidUID unless all three UIDs are well-formed.
+    """
+    study = checked_uid(study_instance_uid)
+    series = checked_uid(series_instance_uid)
+    sop = checked_uid(sop_instance_uid)
+    file_name = sop if version is None else f"{sop}.{version}"
+    if settings.DICOM_STORAGE_LAYOUT == "patient":
+        return os.path.join(STORAGE_DIR, patient_folder(patient_id), f"{file_name}.dcm")
+
+    digest = hashlib.sha1(study.encode()).hexdigest()
+    return os.path.join(
+        STORAGE_DIR, digest[:2], digest[2:4], study, series, f"{file_name}.dcm"
+    )
+
+
+def absolute_path(name):
+    """
+    Return a local path to read a stored file from, a local copy of it
+    when it was packed into a segment.
+    """
+    path = backend().path(name)
+    if os.path.exists(path):
+        return path
+    location = segments.locate(name)
+    return path if location is None else segments.extract(location)
+
+
+def locate(name):
+    """
+    Return (path, offset, length) of the bytes of a stored file, either
+    a file of its own or a region of a segment file.
+    """
+    path = backend().path(name)
+    try:
+        return path, 0, os.path.getsize(path)
+    except FileNotFoundError:
+        location = segments.locate(name)
+        if location is None:
+            raise
+        return location
+
+
+def read_index_tags(fp):
+    """
+    Parse only the indexing tags from an encoded dataset, leaving the rest
+    of it (and the pixel data in particular) undecoded.
+    """
+    return dcmread(fp, specific_tags=INDEX_TAGS, stop_before_pixels=True)
+
+
+def write_encoded(name, data):
+    """
+    Write an encoded dataset, as received, to its storage location
+    """
+    return backend().write(name, data)
+
+
+def move_into_place(src, name):
+    """
+    Atomically move a fully written file (e.g. a spool file) to its storage
+    location.
+    """
+    # tempfile creates spool files readable by their owner only
+    os.chmod(src, 0o644)
+    return backend().move_into_place(src, name)
+
+
+def updated(name):
+    """
+    A stored file was rewritten in place through its local path (e.g.
+    compressed at rest), store the new content.
+    """
+    backend().updated(name)
@@ -1,3 +1,2052 @@
-from django.test import TestCase
+import copy
+import datetime
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
+from botocore.stub import Stubber
+from django.conf import settings
+from django.core.management import call_command
+from django.db import DatabaseError, InterfaceError, close_old_connections, connection
+from django.db.models import F
+from django.test import TestCase, TransactionTestCase, override_settings
+from PIL import Image
+from pydicom import dcmread, examples
+from pydicom.dataset import Dataset
+from pydicom.encaps import encapsulate, generate_frames
+from pydicom.uid import ExplicitVRLittleEndian, JPEGLSLossless, RLELossless
+from pynetdicom import AE, evt
+from pynetdicom.sop_class import (
+    PatientRootQueryRetrieveInformationModelMove,
+    Verification,
+)
+from rest_framework.test import APIClient
+
+from dicom import (
+    compression,
+    deadletter,
+    dedup,
+    indexing,
+    ingest,
+    pixeldata,
+    query,
+    rendering,
+    retrieve,
+    roi,
+    segments,
+    storage,
+    thumbnails,
+    volumes,
+    wado,
+)
+from dicom.admission import AdmissionControl
+from dicom.journal import RECORD_HEADER, RECORD_MAGIC, Journal
+from dicom.management.commands import compact_segments, dicom_receiver
+from dicom.models import (
+    FrameOffsetTable,
+    Image_Upload,
+    Instance,
+    InstanceVersion,
+    PackedInstance,
+    Patient,
+    Series,
+    Study,
+)
+from dicom.multipart import MultipartReader
+from dicom.views import qido_views
+from user.models import User
+
+
+def make_dataset(sop="1.2.3.4.1", series="1.2.3.4", study="1.2.3", **attributes):
+    """Return the CT example dataset with the given UIDs and attributes."""
+    dataset = copy.deepcopy(examples.ct)
+    dataset.StudyInstanceUID = study
+    dataset.SeriesInstanceUID = series
+    dataset.SOPInstanceUID = sop
+    dataset.file_meta.MediaStorageSOPInstanceUID = sop
+    for keyword, value in attributes.items():
+        setattr(dataset, keyword, value)
+    return dataset
+
+
+def encode(dataset):
+    buffer = BytesIO()
+    dataset.save_as(buffer, enforce_file_format=True)
+    return buffer.getvalue()
+
+
+class MediaMixin:
+    """
+    Point MEDIA_ROOT and the DICOM working directories at a temporary
+    directory, with fresh storage and cache singletons.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, True)
+        override = override_settings(
+            MEDIA_ROOT=self.media_root,
+            DICOM_STORAGE_BACKEND="filesystem",
+            DICOM_STORAGE_LAYOUT="sharded",
+            DICOM_PACK_MAX_SIZE=0,
+            DICOM_SPOOL_DIR=f"{self.media_root}/spool",
+            DICOM_JOURNAL_DIR=f"{self.media_root}/journal",
+            DICOM_PACK_CACHE_DIR=f"{self.media_root}/pack_cache",
+            DICOMWEB_RENDER_CACHE_DIR=f"{self.media_root}/render_cache",
+            DICOM_VOLUME_CACHE_DIR=f"{self.media_root}/volumes",
+        )
+        override.enable()
+        self.addCleanup(override.disable)
+        # Module singletons keep the settings they were created with
+        for module, name in [
+            (storage, "_backend"),
+            (rendering, "_render_cache"),
+            (volumes, "_volume_cache"),
+        ]:
+            patcher = mock.patch.object(module, name, None)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def store(self, dataset, content_hash=""):
+        """Write a dataset to storage, returning its name and IngestItem."""
+        name = storage.storage_name(
+            dataset.PatientID,
+            dataset.StudyInstanceUID,
+            dataset.SeriesInstanceUID,
+            dataset.SOPInstanceUID,
+        )
+        data = encode(dataset)
+        storage.write_encoded(name, data)
+        attributes = indexing.index_attributes(dataset)
+        attributes["instance"]["content_hash"] = content_hash
+        return name, ingest.IngestItem(name, attributes, size=len(data))
+
+    def persist(self, *datasets, ingest_queue=None):
+        """Store and index datasets, returning their storage names."""
+        stored = [self.store(dataset) for dataset in datasets]
+        (ingest_queue or ingest.IngestQueue()).persist([item for _, item in stored])
+        return [name for name, _ in stored]
+
+
+class APIMixin:
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.client.force_authenticate(
+            User.objects.create_user(
+                username="tester", email="tester@example.com", password="password"
+            )
+        )
+
+
+class IngestQueueTests(MediaMixin, TransactionTestCase):
+    def test_items_are_committed_in_batches(self):
+        ingest_queue = ingest.IngestQueue(workers=2, batch_size=10)
+        ingest_queue.start()
+        items = [self.store(make_dataset(f"1.2.3.4.{i}"))[1] for i in range(5)]
+        for item in items:
+            self.assertTrue(ingest_queue.put(item))
+        for item in items:
+            self.assertTrue(item.committed.result(timeout=10))
+        ingest_queue.stop()
+
+        self.assertEqual(Instance.objects.count(), 5)
+        stats = ingest_queue.stats()
+        self.assertEqual(stats["persisted"], 5)
+        self.assertEqual(stats["failed"], 0)
+        self.assertEqual(stats["inflight_bytes"], 0)
+
+    def test_failed_batch_carries_the_exception(self):
+        ingest_queue = ingest.IngestQueue(workers=1)
+        ingest_queue.start()
+        _, item = self.store(make_dataset())
+        with mock.patch.object(
+            indexing, "index_instances", side_effect=RuntimeError("broken")
+        ):
+            ingest_queue.put(item)
+            with self.assertRaises(RuntimeError):
+                item.committed.result(timeout=10)
+        ingest_queue.stop()
+        self.assertEqual(ingest_queue.stats()["failed"], 1)
+        self.assertFalse(Instance.objects.exists())
+
+    def test_items_queued_together_share_a_transaction(self):
+        ingest_queue = ingest.IngestQueue(workers=1, batch_size=10)
+        items = [self.store(make_dataset(f"1.2.3.4.{i}"))[1] for i in range(3)]
+        for item in items:
+            ingest_queue.put(item)
+        index_instances = indexing.index_instances
+        transactions = []
+
+        def index(entries):
+            transactions.append((len(entries), connection.in_atomic_block))
+            index_instances(entries)
+
+        with mock.patch.object(indexing, "index_instances", side_effect=index):
+            ingest_queue.start()
+            ingest_queue.stop()
+        self.assertEqual(transactions, [(3, True)])
+        self.assertEqual(ingest_queue.stats()["batches"], 1)
+        self.assertEqual(Instance.objects.count(), 3)
+
+    @override_settings(DICOM_INGEST_ACK_ON_COMMIT=True)
+    def test_commit_status_waits_for_the_commit(self):
+        ingest_queue = ingest.IngestQueue(workers=1)
+        ingest_queue.start()
+        self.addCleanup(ingest_queue.stop)
+        _, item = self.store(make_dataset())
+        release = threading.Event()
+        index_instances = indexing.index_instances
+
+        def held(entries):
+            release.wait(10)
+            index_instances(entries)
+
+        statuses = []
+        with mock.patch.object(indexing, "index_instances", side_effect=held):
+            ingest_queue.put(item)
+            waiter = threading.Thread(
+                target=lambda: statuses.append(ingest.commit_status(item))
+            )
+            waiter.start()
+            waiter.join(0.2)
+            self.assertTrue(waiter.is_alive())
+            self.assertEqual(statuses, [])
+            release.set()
+            waiter.join(10)
+        self.assertEqual(statuses, [0x0000])
+        self.assertTrue(Instance.objects.exists())
+
+    @override_settings(DICOM_INGEST_ACK_ON_COMMIT=True)
+    def test_commit_status_of_a_failed_batch(self):
+        ingest_queue = ingest.IngestQueue(workers=1, batch_size=10)
+        items = [self.store(make_dataset(f"1.2.3.4.{i}"))[1] for i in range(3)]
+        for item in items:
+            ingest_queue.put(item)
+        with mock.patch.object(
+            indexing, "index_instances", side_effect=RuntimeError("broken")
+        ):
+            ingest_queue.start()
+            ingest_queue.stop()
+        self.assertEqual([ingest.commit_status(item) for item in items], [0x0112] * 3)
+        self.assertEqual(ingest_queue.stats()["failed"], 3)
+        self.assertFalse(Instance.objects.exists())
+
+
+class IngestQueueLimitTests(MediaMixin, TestCase):
+    def test_full_queue_rejects(self):
+        ingest_queue = ingest.IngestQueue(maxsize=1, put_timeout=0.01)
+        self.assertTrue(ingest_queue.put(ingest.IngestItem("a", {})))
+        self.assertFalse(ingest_queue.put(ingest.IngestItem("b", {})))
+        self.assertEqual(ingest_queue.stats()["rejected"], 1)
+
+    def test_commit_status(self):
+        self.assertEqual(ingest.commit_status(None), 0xA700)
+        item = ingest.IngestItem("a", {})
+        item.committed.set_exception(RuntimeError("broken"))
+        with override_settings(DICOM_INGEST_ACK_ON_COMMIT=True):
+            self.assertEqual(ingest.commit_status(item), 0x0112)
+        with override_settings(DICOM_INGEST_ACK_ON_COMMIT=False):
+            self.assertEqual(ingest.commit_status(item), 0x0000)
+
+
+class WorkingDirectoryTests(TestCase):
+    def test_working_directories_are_not_served(self):
+        media_root = os.path.realpath(settings.MEDIA_ROOT)
+        for name in (
+            "DICOM_S3_CACHE_DIR",
+            "DICOM_PACK_CACHE_DIR",
+            "DICOM_SPOOL_DIR",
+            "DICOM_JOURNAL_DIR",
+            "DICOM_DEAD_LETTER_DIR",
+            "DICOM_VOLUME_CACHE_DIR",
+            "DICOMWEB_RENDER_CACHE_DIR",
+        ):
+            path = os.path.realpath(getattr(settings, name))
+            self.assertNotEqual(
+                os.path.commonpath([media_root, path]), media_root, name
+            )
+
+
+class StorageTests(MediaMixin, TestCase):
+    def test_read_index_tags_skips_pixel_data(self):
+        dataset = storage.read_index_tags(BytesIO(encode(make_dataset())))
+        self.assertEqual(dataset.SOPInstanceUID, "1.2.3.4.1")
+        self.assertEqual(dataset.StudyInstanceUID, "1.2.3")
+        self.assertNotIn("PixelData", dataset)
+
+    def test_write_encoded_keeps_the_bytes_as_received(self):
+        data = encode(make_dataset())
+        path = storage.write_encoded("dicom_images/a/1.dcm", data)
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), data)
+
+    def test_uids_are_checked(self):
+        self.assertEqual(storage.checked_uid("1.2.840.10008\0"), "1.2.840.10008")
+        for uid in (
+            "",
+            "..",
+            "../1",
+            "/1.2",
+            "1.2/../3",
+            "1..2",
+            "1.2.",
+            "1.2\n",
+            "1" * 65,
+        ):
+            with self.assertRaises(storage.InvalidUID, msg=uid):
+                storage.checked_uid(uid)
+
+    def test_storage_name_refuses_invalid_uids(self):
+        for uids in (
+            ("P", "1.2", "1.2.3", "../../../etc/passwd"),
+            ("P", "..", "1.2.3", "1.2.3.4"),
+            ("P", "1.2", "/abs", "1.2.3.4"),
+        ):
+            for layout in ("sharded", "patient"):
+                with override_settings(DICOM_STORAGE_LAYOUT=layout):
+                    with self.assertRaises(storage.InvalidUID, msg=uids):
+                        storage.storage_name(*uids)
+
+    @override_settings(DICOM_STORAGE_LAYOUT="patient")
+    def test_patient_id_is_sanitized(self):
+        for patient_id, folder in (
+            ("../..", "_____"),
+            ("/etc", "_etc"),
+            ("DOE JOHN", "DOE_JOHN"),
+            ("", "UnknownID"),
+        ):
+            name = storage.storage_name(patient_id, "1.2", "1.2.3", "1.2.3.4")
+            self.assertEqual(
+                name, os.path.join(storage.STORAGE_DIR, folder, "1.2.3.4.dcm")
+            )
+
+    def test_move_into_place(self):
+        src = os.path.join(self.media_root, "spooled")
+        with open(src, "wb") as f:
+            f.write(b"data")
+        path = storage.move_into_place(src, "dicom_images/a/1.dcm")
+        self.assertFalse(os.path.exists(src))
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o644)
+
+
+class S3StorageTests(TestCase):
+    def setUp(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir, ignore_errors=True)
+        self.storage = storage.S3Storage(
+            "bucket",
+            cache_dir,
+            2**20,
+            prefix="dicom/",
+            region_name="us-east-1",
+            aws_access_key_id="key",
+            aws_secret_access_key="secret",
+        )
+        self.stubber = Stubber(self.storage.client)
+        self.stubber.activate()
+        self.addCleanup(self.stubber.deactivate)
+
+    def tearDown(self):
+        self.stubber.assert_no_pending_responses()
+
+    def key(self, name="a/1.dcm"):
+        return {"Bucket": "bucket", "Key": f"dicom/{name}"}
+
+    def test_write(self):
+        self.stubber.add_response("put_object", {}, {**self.key(), "Body": b"data"})
+        path = self.storage.write("a/1.dcm", b"data")
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), b"data")
+
+    def test_get(self):
+        self.stubber.add_response(
+            "head_object", {"ContentLength": 4, "ETag": '"etag"'}, self.key()
+        )
+        self.stubber.add_response(
+            "get_object",
+            {"Body": StreamingBody(BytesIO(b"data"), 4), "ContentLength": 4},
+        )
+        path = self.storage.path("a/1.dcm")
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), b"data")
+        # Cached now
+        self.assertEqual(self.storage.path("a/1.dcm"), path)
+
+    def test_get_missing(self):
+        self.stubber.add_client_error("head_object", "404", http_status_code=404)
+        self.assertFalse(os.path.exists(self.storage.path("a/1.dcm")))
+
+    def test_exists(self):
+        self.stubber.add_response("head_object", {"ContentLength": 4}, self.key())
+        self.assertTrue(self.storage.exists("a/1.dcm"))
+        for code in ("404", "NoSuchKey"):
+            self.stubber.add_client_error("head_object", code, http_status_code=404)
+            self.assertFalse(self.storage.exists("a/1.dcm"))
+
+    def test_exists_raises_other_errors(self):
+        self.stubber.add_client_error("head_object", "403", http_status_code=403)
+        with self.assertRaises(ClientError):
+            self.storage.exists("a/1.dcm")
+
+    def test_delete(self):
+        self.stubber.add_response("put_object", {})
+        path = self.storage.write("a/1.dcm", b"data")
+        self.stubber.add_response("delete_object", {}, self.key())
+        self.storage.delete("a/1.dcm")
+        self.assertFalse(os.path.exists(path))
+
+        # Not cached, so only the object is deleted
+        self.stubber.add_response("delete_object", {}, self.key("a/2.dcm"))
+        self.storage.delete("a/2.dcm")
+
+
+class IndexCountTests(MediaMixin, TestCase):
+    def assertCounts(self, studies, series):
+        self.assertEqual(Patient.objects.get().study_count, len(studies))
+        self.assertEqual(
+            {
+                uid: (series_count, instance_count)
+                for uid, series_count, instance_count in Study.objects.values_list(
+                    "study_instance_uid", "series_count", "instance_count"
+                )
+            },
+            studies,
+        )
+        self.assertEqual(
+            dict(Series.objects.values_list("series_instance_uid", "instance_count")),
+            series,
+        )
+
+    def test_mixed_new_and_resent_batch(self):
+        self.persist(
+            make_dataset("1.2.3.4.1"),
+            make_dataset("1.2.3.4.2"),
+            make_dataset("1.2.3.5.1", series="1.2.3.5"),
+        )
+        self.assertCounts({"1.2.3": (2, 3)}, {"1.2.3.4": 2, "1.2.3.5": 1})
+
+        self.persist(
+            make_dataset("1.2.3.4.1", StudyDescription="re-sent"),
+            make_dataset("1.2.3.4.3"),
+            make_dataset("1.2.3.5.1", series="1.2.3.5"),
+            make_dataset("1.2.9.1.1", series="1.2.9.1", study="1.2.9"),
+        )
+        self.assertCounts(
+            {"1.2.3": (2, 4), "1.2.9": (1, 1)},
+            {"1.2.3.4": 3, "1.2.3.5": 1, "1.2.9.1": 1},
+        )
+        self.assertEqual(Instance.objects.count(), 5)
+
+    def test_rows_inserted_by_another_writer_are_not_counted(self):
+        self.persist(make_dataset("1.2.3.4.1"))
+        bulk_create = Series.objects.bulk_create
+
+        def racing(objs, **kwargs):
+            # Another receiver indexes the same series first, counting it
+            for obj in objs:
+                Series.objects.create(
+                    study_id=obj.study_id,
+                    series_instance_uid=obj.series_instance_uid,
+                )
+                Study.objects.filter(pk=obj.study_id).update(
+                    series_count=F("series_count") + 1
+                )
+            return bulk_create(objs, **kwargs)
+
+        with mock.patch.object(
+            Series.objects, "bulk_create", side_effect=racing
+        ) as raced:
+            self.persist(make_dataset("1.2.3.5.1", series="1.2.3.5"))
+        self.assertEqual(raced.call_count, 1)
+
+        self.assertCounts({"1.2.3": (2, 2)}, {"1.2.3.4": 1, "1.2.3.5": 1})
+        self.assertEqual(
+            Instance.objects.get(sop_instance_uid="1.2.3.5.1").series,
+            Series.objects.get(series_instance_uid="1.2.3.5"),
+        )
+
+
+class MatchFilterTests(TestCase):
+    def setUp(self):
+        patient = Patient.objects.create(patient_id="P1", patient_name="DOE^JOHN")
+        for uid, date, time in [
+            ("1.1", datetime.date(2024, 1, 1), "0830"),
+            ("1.2", datetime.date(2024, 1, 2), "0900"),
+            ("1.3", datetime.date(2024, 1, 3), "120030.5"),
+            ("1.4", datetime.date(2024, 1, 4), "1201"),
+        ]:
+            Study.objects.create(
+                patient=patient,
+                study_instance_uid=uid,
+                study_date=date,
+                study_time=time,
+            )
+
+    def matching(self, keyword, value):
+        lookup, kind = query.STUDY_ATTRIBUTES[keyword]
+        condition = query.match_filter(lookup, kind, value)
+        return sorted(
+            Study.objects.filter(condition).values_list("study_instance_uid", flat=True)
+        )
+
+    def test_universal_matching(self):
+        self.assertIsNone(query.match_filter("study_id", "text", ""))
+        self.assertIsNone(query.match_filter("study_id", "text", "*"))
+
+    def test_wildcard(self):
+        lookup, kind = query.PATIENT_ATTRIBUTES["PatientName"]
+        condition = query.match_filter(lookup, kind, "DOE^J*")
+        self.assertTrue(Patient.objects.filter(condition).exists())
+        condition = query.match_filter(lookup, kind, "DOE^?ANE")
+        self.assertFalse(Patient.objects.filter(condition).exists())
+
+    def test_date_range(self):
+        self.assertEqual(
+            self.matching("StudyDate", "20240102-20240103"), ["1.2", "1.3"]
+        )
+        self.assertEqual(self.matching("StudyDate", "20240103-"), ["1.3", "1.4"])
+        self.assertEqual(self.matching("StudyDate", "-20240101"), ["1.1"])
+
+    def test_time_range_bounds_are_padded(self):
+        self.assertEqual(self.matching("StudyTime", "0900-1200"), ["1.2", "1.3"])
+        self.assertEqual(self.matching("StudyTime", "09-12"), ["1.2", "1.3", "1.4"])
+        self.assertEqual(self.matching("StudyTime", "-0859"), ["1.1"])
+        self.assertEqual(self.matching("StudyTime", "1200-"), ["1.3", "1.4"])
+        self.assertEqual(self.matching("StudyTime", "09:00"), ["1.2"])
+
+
+class RangeTests(TestCase):
+    def test_parse_range(self):
+        self.assertIsNone(wado.parse_range(None, 100))
+        self.assertIsNone(wado.parse_range("bytes=0-1,5-6", 100))
+        self.assertEqual(wado.parse_range("bytes=10-19", 100), (10, 20))
+        self.assertEqual(wado.parse_range("bytes=90-", 100), (90, 100))
+        self.assertEqual(wado.parse_range("bytes=90-200", 100), (90, 100))
+        self.assertEqual(wado.parse_range("bytes=-30", 100), (70, 100))
+
+    def test_unsatisfiable_range(self):
+        with self.assertRaises(ValueError):
+            wado.parse_range("bytes=100-", 100)
+        with self.assertRaises(ValueError):
+            wado.parse_range("bytes=20-10", 100)
+
+    def test_slice_segments(self):
+        segments = [b"abcd", ("file", 100, 10), b"efgh"]
+        self.assertEqual(
+            wado.slice_segments(segments, 2, 16),
+            [b"cd", ("file", 100, 10), b"ef"],
+        )
+        self.assertEqual(wado.slice_segments(segments, 6, 8), [("file", 102, 2)])
+
+    def test_stream_segments_reads_file_regions(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b"0123456789")
+            f.flush()
+            segments = [b"<", (f.name, 2, 5), b">"]
+            body = b"".join(wado.stream_segments(segments, chunk_size=2))
+        self.assertEqual(body, b"<23456>")
+
+
+class RetrieveInstanceTests(APIMixin, MediaMixin, TestCase):
+    url = "/dicomweb/studies/1.2.3/series/1.2.3.4/instances/1.2.3.4.1"
+
+    def setUp(self):
+        super().setUp()
+        self.data = encode(make_dataset())
+        self.persist(make_dataset())
+
+    def get(self, **headers):
+        return self.client.get(self.url, HTTP_ACCEPT="application/dicom", **headers)
+
+    def test_whole_instance(self):
+        resp = self.get()
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(b"".join(resp.streaming_content), self.data)
+
+    def test_range(self):
+        resp = self.get(HTTP_RANGE="bytes=128-131")
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp["Content-Range"], f"bytes 128-131/{len(self.data)}")
+        self.assertEqual(b"".join(resp.streaming_content), b"DICM")
+
+    def test_unsatisfiable_range(self):
+        resp = self.get(HTTP_RANGE=f"bytes={len(self.data)}-")
+        self.assertEqual(resp.status_code, 416)
+        self.assertEqual(resp["Content-Range"], f"bytes */{len(self.data)}")
+
+    def test_unknown_instance(self):
+        resp = self.client.get(self.url + "9", HTTP_ACCEPT="application/dicom")
+        self.assertEqual(resp.status_code, 404)
+
+
+def multipart(parts, boundary="BOUNDARY"):
+    body = b"preamble"
+    for content_type, data in parts:
+        body += (
+            f"\r\n--{boundary}\r\nContent-Type: {content_type}\r\n\r\n".encode() + data
+        )
+    return body + f"\r\n--{boundary}--\r\n".encode()
+
+
+class MultipartReaderTests(TestCase):
+    def read(self, body, chunk_size):
+        reader = MultipartReader(BytesIO(body), "BOUNDARY", chunk_size)
+        return [(headers, b"".join(chunks)) for headers, chunks in reader]
+
+    def test_parts(self):
+        body = multipart([("application/dicom", b"first"), ("text/plain", b"\r\n--")])
+        for chunk_size in (1, 3, 1024):
+            self.assertEqual(
+                self.read(body, chunk_size),
+                [
+                    ({"content-type": "application/dicom"}, b"first"),
+                    ({"content-type": "text/plain"}, b"\r\n--"),
+                ],
+            )
+
+    def test_truncated_body(self):
+        body = multipart([("application/dicom", b"first")])[:-20]
+        with self.assertRaises(ValueError):
+            self.read(body, 4)
+
+
+class StoreInstancesTests(APIMixin, MediaMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.ingest_queue = ingest.IngestQueue(workers=1)
+        self.ingest_queue.start()
+        self.addCleanup(self.ingest_queue.stop)
+        patcher = mock.patch.object(
+            ingest, "shared_queue", return_value=self.ingest_queue
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, parts, url="/dicomweb/studies"):
+        return self.client.generic(
+            "POST",
+            url,
+            multipart(parts),
+            content_type='multipart/related; type="application/dicom";'
+            " boundary=BOUNDARY",
+        )
+
+    def stored_files(self):
+        return [
+            name
+            for _, _, names in os.walk(os.path.join(self.media_root, "dicom_images"))
+            for name in names
+        ]
+
+    def test_store_several_parts(self):
+        resp = self.post(
+            [
+                ("application/dicom", encode(make_dataset(f"1.2.3.4.{i}")))
+                for i in range(3)
+            ]
+        )
+        self.assertEqual(resp.status_code, 200)
+        referenced = resp.json()["00081199"]["Value"]
+        self.assertEqual(len(referenced), 3)
+        self.assertTrue(
+            referenced[0]["00081190"]["Value"][0].endswith(
+                "/dicomweb/studies/1.2.3/series/1.2.3.4/instances/1.2.3.4.0"
+            )
+        )
+        self.assertEqual(Instance.objects.count(), 3)
+
+    def test_failed_part(self):
+        no_series = make_dataset("1.2.3.4.2")
+        del no_series.SeriesInstanceUID
+        resp = self.post(
+            [
+                ("application/dicom", encode(make_dataset("1.2.3.4.1"))),
+                ("application/dicom", encode(no_series)),
+                ("application/dicom", b"not a DICOM file"),
+            ]
+        )
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(len(resp.json()["00081199"]["Value"]), 1)
+        failed = resp.json()["00081198"]["Value"]
+        self.assertEqual(
+            [entry["00081197"]["Value"][0] for entry in failed], [0xC000] * 2
+        )
+        self.assertEqual(
+            list(Instance.objects.values_list("sop_instance_uid", flat=True)),
+            ["1.2.3.4.1"],
+        )
+        self.assertEqual(len(self.stored_files()), 1)
+
+    def test_study_mismatch(self):
+        resp = self.post(
+            [("application/dicom", encode(make_dataset()))], url="/dicomweb/studies/9.9"
+        )
+        self.assertEqual(resp.status_code, 409)
+        self.assertEqual(self.stored_files(), [])
+
+    def test_invalid_uids_are_refused(self):
+        resp = self.post(
+            [
+                ("application/dicom", encode(make_dataset(uid)))
+                for uid in ("../../1", "/tmp/1", "1.2/../3")
+            ]
+        )
+        self.assertEqual(resp.status_code, 409)
+        failed = resp.json()["00081198"]["Value"]
+        self.assertEqual(
+            [entry["00081197"]["Value"][0] for entry in failed], [0xA900] * 3
+        )
+        self.assertEqual(self.stored_files(), [])
+        self.assertFalse(Instance.objects.exists())
+
+
+class RenderedViewTests(APIMixin, MediaMixin, TestCase):
+    url = "/dicomweb/studies/1.2.3/series/1.2.3.4/instances/1.2.3.4.1/rendered"
+
+    def test_rendered(self):
+        self.persist(make_dataset())
+        resp = self.client.get(self.url, {"viewport": "32,32"})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp["Content-Type"], "image/jpeg")
+        self.assertEqual(Image.open(BytesIO(resp.content)).size, (32, 32))
+
+    def test_viewport_must_be_positive(self):
+        self.persist(make_dataset())
+        for viewport in ("0,0", "-10,10", "x,10", "10"):
+            resp = self.client.get(self.url, {"viewport": viewport})
+            self.assertEqual(resp.status_code, 400, viewport)
+
+    def test_missing_frame(self):
+        self.persist(make_dataset())
+        resp = self.client.get(self.url.replace("rendered", "frames/2/rendered"))
+        self.assertEqual(resp.status_code, 404)
+
+    def test_no_pixel_data(self):
+        dataset = make_dataset()
+        del dataset.PixelData
+        self.persist(dataset)
+        resp = self.client.get(self.url)
+        self.assertEqual(resp.status_code, 404)
+
+    def test_reformat_parameters_must_be_positive(self):
+        url = "/dicomweb/studies/1.2.3/series/1.2.3.4/reformat"
+        for params in ({"viewport": "0,0"}, {"slab": "-5"}):
+            resp = self.client.get(url, params)
+            self.assertEqual(resp.status_code, 400, params)
+
+
+class ReformatViewTests(APIMixin, MediaMixin, TestCase):
+    url = "/dicomweb/studies/1.2.3/series/1.2.3.4/reformat"
+
+    def setUp(self):
+        super().setUp()
+        slices = volume_slices([(0, 0, 0), (0, 0, 2), (0, 0, 4)])
+        for dataset in slices:
+            dataset.PixelSpacing = [1, 1]
+            dataset.RescaleSlope, dataset.RescaleIntercept = 1, 0
+        self.persist(*slices)
+
+    def render(self, **params):
+        resp = self.client.get(self.url, params, HTTP_ACCEPT="image/png")
+        self.assertEqual(resp.status_code, 200)
+        return Image.open(BytesIO(resp.content))
+
+    def test_planes(self):
+        # Slices are 2mm apart, so the 3 slices are 6 pixels high
+        for plane, size in (
+            ("axial", (128, 128)),
+            ("coronal", (128, 6)),
+            ("sagittal", (128, 6)),
+        ):
+            self.assertEqual(self.render(plane=plane).size, size, plane)
+
+    def test_projections(self):
+        values = {
+            projection: self.render(
+                slab="6", projection=projection, window="1,4"
+            ).getpixel((0, 0))
+            for projection in ("mip", "mean", "minip")
+        }
+        self.assertGreater(values["mip"], values["mean"])
+        self.assertGreater(values["mean"], values["minip"])
+
+    def test_errors(self):
+        for error, status_code in (
+            (RuntimeError("no decoder"), 406),
+            (NotImplementedError("unsupported"), 406),
+            (FileNotFoundError("gone"), 404),
+            (PermissionError("read-only"), 503),
+        ):
+            with mock.patch.object(volumes.VolumeCache, "get", side_effect=error):
+                resp = self.client.get(self.url)
+            self.assertEqual(resp.status_code, status_code, error)
+
+    def test_unknown_series(self):
+        resp = self.client.get(self.url.replace("1.2.3.4", "9.9.9"))
+        self.assertEqual(resp.status_code, 404)
+
+
+class ThumbnailTests(APIMixin, MediaMixin, TransactionTestCase):
+    def test_write_thumbnail_fits_the_size(self):
+        name, _ = self.store(make_dataset())
+        dst = os.path.join(self.media_root, "thumbs", "1.jpg")
+        self.assertIsNone(
+            rendering.write_thumbnail(storage.absolute_path(name), dst, 64, 80)
+        )
+        self.assertEqual(Image.open(dst).size, (64, 64))
+
+    def test_write_thumbnail_reports_errors(self):
+        dataset = make_dataset()
+        del dataset.PixelData
+        name, _ = self.store(dataset)
+        dst = os.path.join(self.media_root, "1.jpg")
+        self.assertIsNotNone(
+            rendering.write_thumbnail(storage.absolute_path(name), dst, 64, 80)
+        )
+        self.assertFalse(os.path.exists(dst))
+
+    def test_representative_instance(self):
+        names = self.persist(
+            *[make_dataset(f"1.2.3.4.{i}", InstanceNumber=i) for i in range(1, 4)]
+        )
+        self.assertEqual(thumbnails.representative_instance("1.2.3.4"), names[1])
+        self.assertIsNone(thumbnails.representative_instance("9.9"))
+
+    def test_stage_builds_thumbnails_and_preview(self):
+        stage = thumbnails.ThumbnailStage(workers=1)
+        self.addCleanup(stage.shutdown)
+        with override_settings(DICOM_THUMBNAIL_SIZE=32, DICOM_PREVIEW_SIZE=48):
+            ingest_queue = ingest.IngestQueue(on_persisted=stage)
+            ingest_queue.start()
+            _, item = self.store(make_dataset())
+            ingest_queue.put(item)
+            item.committed.result(timeout=10)
+            ingest_queue.stop()
+            stage.shutdown()
+
+        thumbnail = storage.absolute_path(thumbnails.thumbnail_name(item.image_path))
+        preview = storage.absolute_path(
+            thumbnails.preview_name(item.image_path, "1.2.3.4")
+        )
+        self.assertEqual(Image.open(thumbnail).size, (32, 32))
+        self.assertEqual(Image.open(preview).size, (48, 48))
+
+        resp = self.client.get("/dicomweb/studies/1.2.3/series/1.2.3.4/thumbnail")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(Image.open(BytesIO(resp.content)).size, (48, 48))
+
+    def test_view_renders_missing_thumbnails(self):
+        self.persist(make_dataset())
+        with override_settings(DICOM_THUMBNAIL_SIZE=16):
+            resp = self.client.get(
+                "/dicomweb/studies/1.2.3/series/1.2.3.4/instances/1.2.3.4.1/thumbnail"
+            )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(Image.open(BytesIO(resp.content)).size, (16, 16))
+
+
+def multiframe_dataset(frames, encapsulated=False, fragments_per_frame=1):
+    """A dataset whose frames are the given (equal sized, for native) bytes."""
+    dataset = make_dataset(NumberOfFrames=len(frames))
+    if encapsulated:
+        dataset.file_meta.TransferSyntaxUID = RLELossless
+        dataset.PixelData = encapsulate(
+            frames, fragments_per_frame=fragments_per_frame, has_bot=True
+        )
+        dataset["PixelData"].VR = "OB"
+        dataset["PixelData"].is_undefined_length = True
+    else:
+        # 16-bit single row frames
+        dataset.Rows, dataset.Columns = 1, len(frames[0]) // 2
+        dataset.PixelData = b"".join(frames)
+    return dataset
+
+
+class FrameTableTests(APIMixin, MediaMixin, TestCase):
+    def frames(self, path, ranges):
+        with open(path, "rb") as f:
+            data = f.read()
+        return [
+            b"".join(data[offset : offset + length] for offset, length in frame)
+            for frame in ranges
+        ]
+
+    def test_native_frames(self):
+        frames = [bytes([i]) * 32 for i in range(3)]
+        name, _ = self.store(multiframe_dataset(frames))
+        path = storage.absolute_path(name)
+        offset, length, ranges = pixeldata.frame_table(path)
+        self.assertEqual(length, 96)
+        self.assertEqual(ranges[0][0][0], offset)
+        self.assertEqual(self.frames(path, ranges), frames)
+
+    def test_encapsulated_frames(self):
+        frames = [b"first frame!", b"second frame", b"third frame!"]
+        for fragments_per_frame in (1, 2):
+            name, _ = self.store(multiframe_dataset(frames, True, fragments_per_frame))
+            path = storage.absolute_path(name)
+            offset, length, ranges = pixeldata.frame_table(path)
+            self.assertIsNone(length)
+            self.assertEqual(
+                [len(frame) for frame in ranges], [fragments_per_frame] * 3
+            )
+            self.assertEqual(self.frames(path, ranges), frames)
+
+    def test_odd_length_native_frames(self):
+        frames = [bytes([i]) * 3 for i in range(5)]
+        dataset = multiframe_dataset(frames)
+        dataset.Columns, dataset.BitsAllocated, dataset.BitsStored = 3, 8, 8
+        dataset.HighBit = 7
+        name, _ = self.store(dataset)
+        path = storage.absolute_path(name)
+        offset, length, ranges = pixeldata.frame_table(path)
+        self.assertEqual(length, 16)
+        self.assertEqual(self.frames(path, ranges), frames)
+
+    def test_1_bit_frames(self):
+        dataset = multiframe_dataset([b"\xff" * 2, b"\x00" * 2])
+        dataset.Columns, dataset.BitsAllocated, dataset.BitsStored = 15, 1, 1
+        dataset.HighBit = 0
+        name, _ = self.store(dataset)
+        with self.assertRaises(ValueError):
+            pixeldata.frame_table(storage.absolute_path(name))
+
+        dataset = make_dataset(Rows=1, Columns=12, BitsAllocated=1, BitsStored=1)
+        dataset.HighBit = 0
+        dataset.PixelData = b"\xff\x0f"
+        name, _ = self.store(dataset)
+        offset, length, ranges = pixeldata.frame_table(storage.absolute_path(name))
+        self.assertEqual(ranges, [[(offset, 2)]])
+
+    def test_extended_offset_table(self):
+        frames = [b"first frame!", b"second frame", b"third frame!"]
+        dataset = multiframe_dataset(frames, True, 2)
+        dataset.PixelData = encapsulate(frames, fragments_per_frame=2, has_bot=False)
+        # Two 6 byte fragments with their item tags per frame
+        dataset.ExtendedOffsetTable = struct.pack("<3Q", 0, 28, 56)
+        name, _ = self.store(dataset)
+        path = storage.absolute_path(name)
+        _, _, ranges = pixeldata.frame_table(path)
+        self.assertEqual(self.frames(path, ranges), frames)
+
+    def test_fragmented_frames_without_offsets_are_decoded(self):
+        dataset = make_dataset()
+        pixels = dataset.pixel_array.copy()
+        dataset.NumberOfFrames = 2
+        dataset.PixelData = pixels.tobytes() * 2
+        dataset.compress(JPEGLSLossless, generate_instance_uid=False)
+        frames = list(generate_frames(dataset.PixelData, number_of_frames=2))
+        dataset.PixelData = encapsulate(frames, fragments_per_frame=3, has_bot=False)
+        (name,) = self.persist(dataset)
+        path = storage.absolute_path(name)
+        with self.assertRaises(pixeldata.UnknownFrameLayout):
+            pixeldata.frame_table(path)
+
+        resp = self.client.get(
+            "/dicomweb/studies/1.2.3/series/1.2.3.4/instances/1.2.3.4.1/frames/2"
+        )
+        self.assertEqual(resp.status_code, 200)
+        body = b"".join(resp.streaming_content)
+        self.assertIn(f"transfer-syntax={ExplicitVRLittleEndian}".encode(), body)
+        self.assertIn(pixels.tobytes(), body)
+
+    def test_no_pixel_data(self):
+        dataset = make_dataset()
+        del dataset.PixelData
+        name, _ = self.store(dataset)
+        with self.assertRaises(pixeldata.NoPixelData):
+            pixeldata.frame_table(storage.absolute_path(name))
+
+    def test_frames_are_served_from_the_recorded_table(self):
+        frames = [b"first frame!", b"second frame", b"third frame!"]
+        self.persist(multiframe_dataset(frames, True))
+        self.assertEqual(FrameOffsetTable.objects.get().frames[2][0][1], 12)
+
+        resp = self.client.get(
+            "/dicomweb/studies/1.2.3/series/1.2.3.4/instances/1.2.3.4.1/frames/3,1"
+        )
+        self.assertEqual(resp.status_code, 200)
+        body = b"".join(resp.streaming_content)
+        self.assertIn(b"third frame!", body)
+        self.assertLess(body.index(b"third frame!"), body.index(b"first frame!"))
+
+
+class DecoderTests(MediaMixin, TestCase):
+    def test_jpeg_ls_is_decoded(self):
+        dataset = make_dataset()
+        pixels = dataset.pixel_array.copy()
+        dataset.compress(JPEGLSLossless, generate_instance_uid=False)
+        name, _ = self.store(dataset)
+        path = storage.absolute_path(name)
+        header = dcmread(path, stop_before_pixels=True)
+        self.assertTrue((rendering.decode_frame(path, header, 0) == pixels).all())
+
+
+class CompressionTests(APIMixin, MediaMixin, TestCase):
+    def test_round_trip(self):
+        dataset = make_dataset()
+        for method in compression.METHODS:
+            name, _ = self.store(dataset)
+            path = storage.absolute_path(name)
+            fields = compression.compress_file(path, method)
+            self.assertEqual(
+                fields["stored_transfer_syntax_uid"], compression.METHODS[method]
+            )
+            self.assertEqual(fields["stored_size"], os.path.getsize(path))
+            self.assertGreater(fields["compression_ratio"], 1)
+
+            restored = compression.restore(path, dataset.file_meta.TransferSyntaxUID)
+            self.assertEqual(
+                restored.file_meta.TransferSyntaxUID,
+                dataset.file_meta.TransferSyntaxUID,
+            )
+            self.assertEqual(restored.PixelData, dataset.PixelData)
+
+    def test_compressed_files_are_refused(self):
+        name, _ = self.store(make_dataset())
+        path = storage.absolute_path(name)
+        compression.compress_file(path, "rle")
+        with self.assertRaises(ValueError):
+            compression.compress_file(path, "deflate")
+        with self.assertRaises(ValueError):
+            compression.compress_file(path, "zip")
+
+    def test_compressed_instances_are_served_as_received(self):
+        dataset = make_dataset()
+        self.persist(dataset, ingest_queue=ingest.IngestQueue(compression="rle"))
+        instance = Instance.objects.get()
+        self.assertEqual(instance.stored_transfer_syntax_uid, RLELossless)
+
+        url = "/dicomweb/studies/1.2.3/series/1.2.3.4/instances/1.2.3.4.1"
+        resp = self.client.get(url, HTTP_ACCEPT="application/dicom")
+        retrieved = dcmread(BytesIO(b"".join(resp.streaming_content)))
+        self.assertEqual(
+            retrieved.file_meta.TransferSyntaxUID, dataset.file_meta.TransferSyntaxUID
+        )
+        self.assertEqual(retrieved.PixelData, dataset.PixelData)
+
+        resp = self.client.get(url + "/frames/1")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(dataset.PixelData, b"".join(resp.streaming_content))
+
+
+class DuplicatePolicyTests(MediaMixin, TestCase):
+    def receive(self, dataset):
+        """Store and index a dataset as the receiver does, by content hash."""
+        data = encode(dataset)
+        content_hash = dedup.hash_bytes(data)
+        name = dedup.storage_target(dataset, content_hash)
+        if name is None:
+            return None
+        storage.write_encoded(name, data)
+        attributes = indexing.index_attributes(dataset)
+        attributes["instance"]["content_hash"] = content_hash
+        ingest.IngestQueue().persist([ingest.IngestItem(name, attributes)])
+        return name
+
+    def read(self, name):
+        with open(storage.absolute_path(name), "rb") as f:
+            return dcmread(f)
+
+    def test_identical_content_is_not_written_again(self):
+        for index, policy in enumerate(("keep", "replace", "version")):
+            with self.subTest(policy), override_settings(DICOM_DUPLICATE_POLICY=policy):
+                dataset = make_dataset(f"1.2.3.4.{index}")
+                self.assertIsNotNone(self.receive(dataset))
+                self.assertIsNone(self.receive(dataset))
+        self.assertEqual(Instance.objects.count(), 3)
+        self.assertFalse(InstanceVersion.objects.exists())
+
+    @override_settings(DICOM_DUPLICATE_POLICY="keep")
+    def test_keep(self):
+        name = self.receive(make_dataset(StudyDescription="first"))
+        self.assertIsNone(self.receive(make_dataset(StudyDescription="second")))
+        instance = Instance.objects.get()
+        self.assertEqual(instance.image.image.name, name)
+        self.assertEqual(self.read(name).StudyDescription, "first")
+        self.assertFalse(InstanceVersion.objects.exists())
+
+    @override_settings(DICOM_DUPLICATE_POLICY="replace")
+    def test_replace(self):
+        first = self.receive(make_dataset(StudyDescription="first"))
+        second = self.receive(make_dataset(StudyDescription="second"))
+        self.assertEqual(first, second)
+        instance = Instance.objects.get()
+        self.assertEqual(instance.image.image.name, second)
+        self.assertEqual(
+            instance.content_hash,
+            dedup.hash_bytes(encode(make_dataset(StudyDescription="second"))),
+        )
+        self.assertEqual(self.read(second).StudyDescription, "second")
+        self.assertEqual(Image_Upload.objects.count(), 1)
+        self.assertFalse(InstanceVersion.objects.exists())
+
+    @override_settings(DICOM_DUPLICATE_POLICY="version")
+    def test_version(self):
+        first = self.receive(make_dataset(StudyDescription="first"))
+        second = self.receive(make_dataset(StudyDescription="second"))
+        self.assertNotEqual(first, second)
+        instance = Instance.objects.get()
+        self.assertEqual(instance.image.image.name, second)
+        version = InstanceVersion.objects.get()
+        self.assertEqual(version.instance, instance)
+        self.assertEqual(version.image.image.name, first)
+        self.assertEqual(self.read(first).StudyDescription, "first")
+        self.assertEqual(self.read(second).StudyDescription, "second")
+        self.assertEqual(instance.series.instance_count, 1)
+
+    @override_settings(DICOM_DUPLICATE_POLICY="version")
+    def test_index_unavailable(self):
+        dataset = make_dataset()
+        with mock.patch.object(
+            Instance.objects, "filter", side_effect=DatabaseError("down")
+        ):
+            name = dedup.storage_target(dataset, "ab" * 32)
+        self.assertTrue(name.endswith(f"{'ab' * 8}.dcm"), name)
+
+
+class AggregateStatsTests(TestCase):
+    def payload(self, **counters):
+        ingest_queue = ingest.IngestQueue(workers=2)
+        stats = dicom_receiver.receiver_stats(
+            ingest_queue, AdmissionControl(ingest_queue)
+        )
+        stats.update(counters)
+        return stats
+
+    def test_counters_are_summed(self):
+        totals = dicom_receiver.aggregate_stats(
+            {
+                101: self.payload(
+                    enqueued=10,
+                    persisted=8,
+                    queue_depth=2,
+                    inflight_bytes=100,
+                    associations_active=1,
+                    stores_refused_high_water=3,
+                    wait_max_ms=5.0,
+                    worker_utilisation=[0.5, 0.25],
+                ),
+                102: self.payload(
+                    enqueued=5,
+                    persisted=5,
+                    rejected=1,
+                    inflight_bytes=50,
+                    associations_active=2,
+                    wait_max_ms=12.5,
+                    worker_utilisation=[1.0, 0.0],
+                ),
+            }
+        )
+        self.assertEqual(totals["processes"], 2)
+        self.assertEqual(totals["enqueued"], 15)
+        self.assertEqual(totals["persisted"], 13)
+        self.assertEqual(totals["rejected"], 1)
+        self.assertEqual(totals["queue_depth"], 2)
+        self.assertEqual(totals["queue_size"], 2000)
+        self.assertEqual(totals["inflight_bytes"], 150)
+        self.assertEqual(totals["associations_active"], 3)
+        self.assertEqual(totals["stores_refused_high_water"], 3)
+        self.assertEqual(totals["wait_max_ms"], 12.5)
+        self.assertEqual(totals["worker_utilisation_avg"], 0.438)
+
+    def test_no_processes(self):
+        totals = dicom_receiver.aggregate_stats({})
+        self.assertEqual(totals["processes"], 0)
+        self.assertEqual(totals["enqueued"], 0)
+        self.assertEqual(totals["wait_max_ms"], 0.0)
+        self.assertEqual(totals["worker_utilisation_avg"], 0.0)
+
+
+class ReusePortTests(TestCase):
+    def test_sibling_servers_share_a_port(self):
+        ae = AE()
+        ae.add_supported_context(Verification)
+        first = ae.make_server(
+            ("127.0.0.1", 0),
+            server_class=dicom_receiver.ReusePortAssociationServer,
+        )
+        self.addCleanup(first.server_close)
+        port = first.server_address[1]
+        second = ae.make_server(
+            ("127.0.0.1", port),
+            server_class=dicom_receiver.ReusePortAssociationServer,
+        )
+        self.addCleanup(second.server_close)
+        self.assertEqual(second.server_address[1], port)
+
+
+class ReceiverTests(MediaMixin, TestCase):
+    def test_invalid_uids_are_refused(self):
+        ingest_queue = ingest.IngestQueue()
+        event = mock.Mock()
+        event.encoded_dataset.return_value = encode(make_dataset("../../1"))
+        with override_settings(DICOM_STORE_MODE="passthrough"):
+            status = dicom_receiver.handle_store(
+                event, ingest_queue, AdmissionControl(ingest_queue)
+            )
+        self.assertEqual(status, 0xA900)
+        self.assertEqual(ingest_queue.depth(), 0)
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, "dicom_images")))
+
+
+class AdmissionControlTests(TestCase):
+    def event(self, calling_ae):
+        event = mock.Mock()
+        event.assoc.requestor.primitive.calling_ae_title = f"{calling_ae:<16}"
+        return event
+
+    def request(self, admission, calling_ae):
+        """Request an association, returning its event and whether it was admitted."""
+        event = self.event(calling_ae)
+        admission.handle_requested(event)
+        rejected = event.assoc.acse.send_reject.called
+        if rejected:
+            event.assoc.acse.send_reject.assert_called_once_with(2, 3, 2)
+            event.assoc.kill.assert_called_once_with()
+        return event, not rejected
+
+    def test_association_limit(self):
+        admission = AdmissionControl(mock.Mock(), max_associations=2)
+        first, _ = self.request(admission, "A")
+        self.request(admission, "B")
+        rejected, admitted = self.request(admission, "C")
+        self.assertFalse(admitted)
+
+        admission.handle_closed(first)
+        _, admitted = self.request(admission, "C")
+        self.assertTrue(admitted)
+        stats = admission.stats()
+        self.assertEqual(stats["associations_accepted"], 3)
+        self.assertEqual(stats["associations_rejected"], 1)
+        self.assertEqual(stats["associations_active"], 2)
+
+    def test_association_limit_per_ae(self):
+        admission = AdmissionControl(mock.Mock(), max_associations_per_ae=1)
+        first, _ = self.request(admission, "A")
+        self.assertFalse(self.request(admission, "A")[1])
+        self.assertTrue(self.request(admission, "B")[1])
+
+        admission.handle_closed(first)
+        self.assertTrue(self.request(admission, "A")[1])
+        stats = admission.stats()
+        self.assertEqual(stats["associations_rejected_per_ae"], 1)
+        self.assertEqual(stats["associations_active"], 2)
+
+    def test_closing_a_rejected_association(self):
+        admission = AdmissionControl(mock.Mock(), max_associations=1)
+        self.request(admission, "A")
+        rejected, _ = self.request(admission, "B")
+        admission.handle_closed(rejected)
+        admission.handle_closed(rejected)
+        self.assertEqual(admission.stats()["associations_active"], 1)
+        # Still full
+        self.assertFalse(self.request(admission, "C")[1])
+
+    def test_store_refusals(self):
+        ingest_queue = mock.Mock()
+        ingest_queue.depth.return_value = 0
+        ingest_queue.inflight_bytes.return_value = 0
+        admission = AdmissionControl(
+            ingest_queue, max_inflight_bytes=100, high_water=0.8
+        )
+        self.assertIsNone(admission.store_status(500))
+
+        ingest_queue.inflight_bytes.return_value = 80
+        self.assertIsNone(admission.store_status(20))
+        self.assertEqual(admission.store_status(30), 0xA702)
+
+        ingest_queue.depth.return_value = 0.8
+        self.assertEqual(admission.store_status(1), 0xA701)
+        stats = admission.stats()
+        self.assertEqual(stats["stores_refused_high_water"], 1)
+        self.assertEqual(stats["stores_refused_inflight_bytes"], 1)
+
+    def test_refused_store_is_not_queued(self):
+        ingest_queue = ingest.IngestQueue(maxsize=2)
+        ingest_queue.put(ingest.IngestItem("a.dcm", {}))
+        event = mock.Mock()
+        event.encoded_dataset.return_value = encode(make_dataset())
+        with override_settings(DICOM_STORE_MODE="passthrough"):
+            status = dicom_receiver.handle_store(
+                event, ingest_queue, AdmissionControl(ingest_queue, high_water=0.5)
+            )
+        self.assertEqual(status, 0xA701)
+        self.assertEqual(ingest_queue.queue.qsize(), 1)
+
+
+class SegmentTests(APIMixin, MediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        override = override_settings(
+            DICOM_PACK_MAX_SIZE=1024**2, DICOM_SEGMENT_SIZE=1024**2
+        )
+        override.enable()
+        self.addCleanup(override.disable)
+        for name in ("_writer", "_extract_cache"):
+            patcher = mock.patch.object(segments, name, None)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(lambda: segments.writer().close())
+        self.datasets = [make_dataset(f"1.2.3.4.{i}") for i in range(3)]
+        self.names = self.persist(*self.datasets)
+
+    def read(self, name):
+        path, offset, length = storage.locate(name)
+        return segments.read(path, offset, length)
+
+    def test_small_instances_are_packed(self):
+        self.assertEqual(PackedInstance.objects.count(), 3)
+        self.assertEqual(
+            len(set(PackedInstance.objects.values_list("segment", flat=True))), 1
+        )
+        for name, dataset in zip(self.names, self.datasets):
+            self.assertFalse(os.path.exists(storage.backend().path(name)))
+            self.assertEqual(self.read(name), encode(dataset))
+            with open(storage.absolute_path(name), "rb") as f:
+                self.assertEqual(f.read(), encode(dataset))
+
+    def test_packed_instances_are_retrieved(self):
+        resp = self.client.get(
+            "/dicomweb/studies/1.2.3/series/1.2.3.4/instances/1.2.3.4.1",
+            HTTP_ACCEPT="application/dicom",
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(b"".join(resp.streaming_content), encode(self.datasets[1]))
+
+    def test_segments_are_rolled_over(self):
+        with override_settings(DICOM_SEGMENT_SIZE=1):
+            segments.writer().close()
+            segments._writer = None
+            self.persist(make_dataset("1.2.3.4.8"), make_dataset("1.2.3.4.9"))
+        self.assertEqual(
+            len(set(PackedInstance.objects.values_list("segment", flat=True))), 3
+        )
+
+    def test_compact_repoints_live_instances(self):
+        old_segment = PackedInstance.objects.values_list("segment", flat=True)[0]
+        Instance.objects.get(sop_instance_uid="1.2.3.4.1").image.delete()
+        segments.writer().close()
+
+        with mock.patch.object(compact_segments, "SETTLE_SECONDS", 0):
+            call_command("compact_segments", min_dead=0.3)
+
+        self.assertFalse(os.path.exists(segments.segment_path(old_segment)))
+        rows = PackedInstance.objects.values_list("segment", flat=True)
+        self.assertEqual(len(rows), 2)
+        self.assertNotIn(old_segment, rows)
+        self.assertEqual(len(set(rows)), 1)
+        for index in (0, 2):
+            self.assertEqual(self.read(self.names[index]), encode(self.datasets[index]))
+
+    def test_open_segments_are_left_alone(self):
+        old_segment = PackedInstance.objects.values_list("segment", flat=True)[0]
+        Instance.objects.get(sop_instance_uid="1.2.3.4.1").image.delete()
+
+        with mock.patch.object(compact_segments, "SETTLE_SECONDS", 0):
+            call_command("compact_segments", min_dead=0.3)
+        self.assertEqual(
+            set(PackedInstance.objects.values_list("segment", flat=True)),
+            {old_segment},
+        )
+
+        segments.writer().close()
+        call_command("compact_segments", min_dead=0.3)
+        self.assertTrue(os.path.exists(segments.segment_path(old_segment)))
+
+
+class JournalTests(MediaMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = os.path.join(self.media_root, "journal")
+
+    def journal(self):
+        journal = Journal(self.directory, 1024**2, 60)
+        return journal, journal.open()
+
+    def append(self, journal, dataset):
+        name = storage.storage_name(
+            dataset.PatientID,
+            dataset.StudyInstanceUID,
+            dataset.SeriesInstanceUID,
+            dataset.SOPInstanceUID,
+        )
+        return journal.append(
+            {"name": name, "attributes": indexing.index_attributes(dataset)},
+            encode(dataset),
+        )
+
+    def journal_file(self):
+        (name,) = [
+            name for name in os.listdir(self.directory) if name.endswith(".journal")
+        ]
+        return os.path.join(self.directory, name)
+
+    def test_torn_record_is_truncated_and_the_rest_replayed(self):
+        journal, records = self.journal()
+        self.assertEqual(records, [])
+        datasets = [make_dataset(f"1.2.3.4.{i}") for i in range(2)]
+        for dataset in datasets:
+            self.append(journal, dataset)
+        journal.close()
+
+        # A crash part way through the next record: its header promises
+        # more data than made it to disk
+        path = self.journal_file()
+        size = os.path.getsize(path)
+        with open(path, "ab") as f:
+            f.write(RECORD_HEADER.pack(RECORD_MAGIC, 0, 10, 1000) + b"partial")
+
+        journal, records = self.journal()
+        self.assertEqual(os.path.getsize(path), size)
+        self.assertEqual(
+            [record.meta["name"].rsplit("/", 1)[1] for record in records],
+            ["1.2.3.4.0.dcm", "1.2.3.4.1.dcm"],
+        )
+
+        ingest_queue = ingest.IngestQueue(journal=journal)
+        ingest_queue.start()
+        ingest.replay(ingest_queue, records)
+        ingest_queue.stop()
+        journal.close()
+
+        self.assertEqual(Instance.objects.count(), 2)
+        for record, dataset in zip(records, datasets):
+            with open(storage.absolute_path(record.meta["name"]), "rb") as f:
+                self.assertEqual(f.read(), encode(dataset))
+
+        # Completed records are behind the checkpoint now
+        journal, records = self.journal()
+        self.assertEqual(records, [])
+        journal.close()
+
+    def test_corrupt_record_is_not_replayed(self):
+        journal, _ = self.journal()
+        first = self.append(journal, make_dataset("1.2.3.4.0"))
+        self.append(journal, make_dataset("1.2.3.4.1"))
+        journal.close()
+
+        path = self.journal_file()
+        with open(path, "r+b") as f:
+            f.seek(os.path.getsize(path) - 1)
+            f.write(b"\xff")
+
+        journal, records = self.journal()
+        self.assertEqual([record.lsn for record in records], [first.lsn])
+        journal.close()
+
+    def test_checkpoint_syncs_the_materialized_files(self):
+        journal, _ = self.journal()
+        records = [self.append(journal, make_dataset(f"1.2.3.4.{i}")) for i in range(2)]
+        for record in records:
+            journal.materialize(record, record.meta["name"])
+        journal.complete(records[0])
+
+        synced = []
+        fsync = os.fsync
+
+        def record_fsync(fd):
+            synced.append(os.readlink(f"/proc/self/fd/{fd}"))
+            fsync(fd)
+
+        with (
+            mock.patch("dicom.journal.os.fsync", side_effect=record_fsync),
+            mock.patch("dicom.journal.os.sync") as sync,
+        ):
+            journal.checkpoint()
+        sync.assert_not_called()
+
+        path = storage.absolute_path(records[0].meta["name"])
+        self.assertEqual(
+            synced,
+            [
+                path,
+                os.path.dirname(path),
+                os.path.join(self.directory, "checkpoint.part"),
+                self.directory,
+            ],
+        )
+        # The pending record's file is synced by a later checkpoint
+        journal.complete(records[1])
+        synced.clear()
+        with mock.patch("dicom.journal.os.fsync", side_effect=record_fsync):
+            journal.checkpoint()
+        self.assertEqual(synced[0], storage.absolute_path(records[1].meta["name"]))
+        journal.close()
+
+    def test_journal_is_locked(self):
+        journal, _ = self.journal()
+        with self.assertRaises(RuntimeError):
+            self.journal()
+        journal.close()
+
+
+class DeadLetterTests(MediaMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.dead_letters = deadletter.DeadLetterQueue(
+            os.path.join(self.media_root, "dead_letters"), 3, 60, 600
+        )
+
+    def run_queue(self, items, fail=()):
+        """Persist items in one batch, failing those whose SOP UID is in `fail`."""
+        index_instances = indexing.index_instances
+
+        def failing(entries):
+            for attributes, _ in entries:
+                if attributes["instance"]["sop_instance_uid"] in fail:
+                    raise RuntimeError("broken")
+            index_instances(entries)
+
+        ingest_queue = ingest.IngestQueue(workers=1, dead_letters=self.dead_letters)
+        for item in items:
+            ingest_queue.put(item)
+        with mock.patch.object(indexing, "index_instances", side_effect=failing):
+            ingest_queue.start()
+            ingest_queue.stop()
+        return ingest_queue
+
+    def store(self, dataset):
+        return super().store(dataset, dedup.hash_bytes(encode(dataset)))
+
+    def redrive(self):
+        ingest_queue = ingest.IngestQueue(workers=1, dead_letters=self.dead_letters)
+        ingest_queue.start()
+        entry_ids = [entry_id for entry_id, _ in self.dead_letters.entries()]
+        items = self.dead_letters.redrive(ingest_queue, entry_ids)
+        ingest_queue.stop()
+        return items
+
+    def read(self, name):
+        with open(storage.absolute_path(name), "rb") as f:
+            return f.read()
+
+    def test_failed_items_are_kept_and_acknowledged(self):
+        _, item = self.store(make_dataset())
+        ingest_queue = self.run_queue([item], fail={"1.2.3.4.1"})
+        self.assertTrue(item.dead_lettered)
+        self.assertEqual(ingest.commit_status(item), 0x0000)
+        self.assertEqual(ingest_queue.stats()["dead_lettered"], 1)
+
+        ((entry_id, meta),) = self.dead_letters.entries()
+        self.assertEqual(meta["name"], item.image_path)
+        self.assertEqual(meta["attempts"], 1)
+        self.assertEqual(meta["reason"], "RuntimeError: broken")
+        self.assertEqual(self.dead_letters.due(), [])
+        self.assertEqual(self.dead_letters.due(meta["next_attempt_at"]), [entry_id])
+
+    def test_poison_instance_is_isolated(self):
+        items = [self.store(make_dataset(f"1.2.3.4.{i}"))[1] for i in range(5)]
+        self.run_queue(items, fail={"1.2.3.4.2"})
+        self.assertEqual(Instance.objects.count(), 4)
+        self.assertEqual(
+            [meta["name"] for _, meta in self.dead_letters.entries()],
+            [items[2].image_path],
+        )
+
+    def test_redrive_stores_the_entry(self):
+        dataset = make_dataset()
+        name, item = self.store(dataset)
+        self.run_queue([item], fail={"1.2.3.4.1"})
+        os.remove(storage.absolute_path(name))
+
+        (redriven,) = self.redrive()
+        self.assertTrue(redriven.committed.result(timeout=10))
+        self.assertEqual(self.dead_letters.entries(), [])
+        self.assertEqual(self.read(name), encode(dataset))
+        self.assertEqual(
+            Instance.objects.get().content_hash, dedup.hash_bytes(encode(dataset))
+        )
+
+    def test_failed_retries_back_off_until_parked(self):
+        _, item = self.store(make_dataset())
+        self.run_queue([item], fail={"1.2.3.4.1"})
+        for attempts in (2, 3):
+            entry_ids = [entry_id for entry_id, _ in self.dead_letters.entries()]
+            items = self.dead_letters.redrive(ingest.IngestQueue(), entry_ids)
+            self.run_queue(items, fail={"1.2.3.4.1"})
+            ((_, meta),) = self.dead_letters.entries()
+            self.assertEqual(meta["attempts"], attempts)
+        self.assertEqual(self.dead_letters.delay(3), 240)
+        self.assertEqual(self.dead_letters.due(meta["next_attempt_at"]), [])
+
+    def test_entry_superseded_by_a_later_copy_is_dropped(self):
+        first = make_dataset(StudyDescription="first")
+        name, item = self.store(first)
+        self.run_queue([item], fail={"1.2.3.4.1"})
+
+        # Re-sent with other content, and stored this time
+        second = make_dataset(StudyDescription="second")
+        _, item = self.store(second)
+        self.run_queue([item])
+
+        self.assertEqual(self.redrive(), [])
+        self.assertEqual(self.dead_letters.entries(), [])
+        self.assertEqual(self.read(name), encode(second))
+        self.assertEqual(
+            Instance.objects.get().content_hash, dedup.hash_bytes(encode(second))
+        )
+
+    def test_entry_newer_than_the_index_is_restored(self):
+        older = make_dataset(StudyDescription="older")
+        name, item = self.store(older)
+        self.run_queue([item])
+
+        newer = make_dataset(StudyDescription="newer")
+        _, item = self.store(newer)
+        self.run_queue([item], fail={"1.2.3.4.1"})
+        storage.write_encoded(name, encode(older))
+
+        (redriven,) = self.redrive()
+        self.assertTrue(redriven.committed.result(timeout=10))
+        self.assertEqual(self.read(name), encode(newer))
+        self.assertEqual(
+            Instance.objects.get().content_hash, dedup.hash_bytes(encode(newer))
+        )
+
+    def test_retry_survives_a_broken_connection(self):
+        name, item = self.store(make_dataset())
+        self.run_queue([item], fail={"1.2.3.4.1"})
+        os.remove(storage.absolute_path(name))
+        ((entry_id, meta),) = self.dead_letters.entries()
+        self.dead_letters._write_meta(entry_id, {**meta, "next_attempt_at": 0})
+
+        due = self.dead_letters.due
+        passes = []
+
+        def broken_once():
+            passes.append(time.monotonic())
+            if len(passes) == 1:
+                raise InterfaceError("connection already closed")
+            return due()
+
+        ingest_queue = ingest.IngestQueue(workers=1, dead_letters=self.dead_letters)
+        ingest_queue.start()
+        with (
+            mock.patch.object(self.dead_letters, "due", side_effect=broken_once),
+            mock.patch.object(
+                deadletter, "close_old_connections", wraps=close_old_connections
+            ) as close,
+        ):
+            self.dead_letters.start(ingest_queue, 0.01)
+            deadline = time.monotonic() + 10
+            while self.dead_letters.entries() and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.dead_letters.stop()
+        ingest_queue.stop()
+
+        self.assertEqual(self.dead_letters.entries(), [])
+        self.assertGreater(len(passes), 1)
+        self.assertGreaterEqual(close.call_count, 2 * len(passes) - 1)
+        self.assertTrue(os.path.exists(storage.absolute_path(name)))
+        self.assertEqual(Instance.objects.count(), 1)
+
+
+class FakeAssociation:
+    def __init__(self):
+        self.is_established = True
+        self.released = False
+
+    def release(self):
+        self.is_established = False
+        self.released = True
+
+
+class AssociationPoolTests(TestCase):
+    def test_released_associations_are_reused(self):
+        pool = retrieve.AssociationPool(idle_timeout=60)
+        associate = mock.Mock(side_effect=FakeAssociation)
+        first = pool.acquire("dest", associate)
+        first.release()
+        self.assertFalse(first.released)
+        second = pool.acquire("dest", associate)
+        self.assertIs(second._assoc, first._assoc)
+        self.assertEqual(associate.call_count, 1)
+
+        # In use, so another one is opened
+        third = pool.acquire("dest", associate)
+        self.assertIsNot(third._assoc, second._assoc)
+        self.assertEqual(associate.call_count, 2)
+
+        second.release()
+        third.release()
+        pool.close_all()
+        self.assertTrue(second._assoc.released)
+        self.assertTrue(third._assoc.released)
+
+    def test_idle_associations_expire(self):
+        pool = retrieve.AssociationPool(idle_timeout=0)
+        first = pool.acquire("dest", FakeAssociation)
+        first.release()
+        second = pool.acquire("dest", FakeAssociation)
+        self.assertIsNot(second._assoc, first._assoc)
+        self.assertTrue(first._assoc.released)
+
+    def test_failed_associations_are_not_pooled(self):
+        pool = retrieve.AssociationPool()
+        failed = FakeAssociation()
+        failed.is_established = False
+        self.assertIs(pool.acquire("dest", lambda: failed), failed)
+        pool.put_back("dest", failed)
+        self.assertEqual(pool._idle, {})
+
+
+@override_settings(DICOM_MOVE_DESTINATIONS="STORESCP=127.0.0.1:11113, PACS=pacs:104")
+class RetrieveTests(MediaMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.persist(
+            *[make_dataset(f"1.2.3.4.{i}") for i in range(3)],
+            make_dataset("1.2.3.5.1", series="1.2.3.5"),
+        )
+
+    def event(self, cancelled=False, destination="STORESCP", **identifier):
+        dataset = Dataset()
+        for keyword, value in identifier.items():
+            setattr(dataset, keyword, value)
+        return mock.Mock(
+            identifier=dataset, is_cancelled=cancelled, move_destination=destination
+        )
+
+    def test_move_destinations(self):
+        self.assertEqual(
+            retrieve.move_destinations(),
+            {"STORESCP": ("127.0.0.1", 11113), "PACS": ("pacs", 104)},
+        )
+
+    def test_get_series(self):
+        responses = list(
+            retrieve.handle_get(
+                self.event(QueryRetrieveLevel="SERIES", SeriesInstanceUID="1.2.3.4")
+            )
+        )
+        self.assertEqual(responses[0], 3)
+        self.assertEqual(
+            sorted(dataset.SOPInstanceUID for _, dataset in responses[1:]),
+            ["1.2.3.4.0", "1.2.3.4.1", "1.2.3.4.2"],
+        )
+        self.assertEqual({status for status, _ in responses[1:]}, {0xFF00})
+
+    def test_get_cancelled(self):
+        responses = list(
+            retrieve.handle_get(
+                self.event(
+                    cancelled=True, QueryRetrieveLevel="STUDY", StudyInstanceUID="1.2.3"
+                )
+            )
+        )
+        self.assertEqual(responses, [4, (0xFE00, None)])
+
+    def test_unique_key_is_required(self):
+        with self.assertRaises(ValueError):
+            list(retrieve.handle_get(self.event(QueryRetrieveLevel="SERIES")))
+
+    def test_move(self):
+        responses = list(
+            retrieve.handle_move(
+                self.event(QueryRetrieveLevel="IMAGE", SOPInstanceUID="1.2.3.5.1")
+            )
+        )
+        self.assertEqual(responses[:2], [("127.0.0.1", 11113), 1])
+        self.assertEqual(responses[2][1].SOPInstanceUID, "1.2.3.5.1")
+
+    def test_move_to_unknown_destination(self):
+        responses = list(
+            retrieve.handle_move(
+                self.event(
+                    destination="NOWHERE",
+                    QueryRetrieveLevel="STUDY",
+                    StudyInstanceUID="1.2.3",
+                )
+            )
+        )
+        self.assertEqual(responses, [(None, None)])
+
+    def test_move_to_unknown_destination_status(self):
+        scp = AE()
+        scp.add_supported_context(PatientRootQueryRetrieveInformationModelMove)
+        server = scp.start_server(
+            ("127.0.0.1", 0),
+            block=False,
+            evt_handlers=[(evt.EVT_C_MOVE, retrieve.handle_move)],
+        )
+        self.addCleanup(server.shutdown)
+
+        scu = AE()
+        scu.add_requested_context(PatientRootQueryRetrieveInformationModelMove)
+        assoc = scu.associate("127.0.0.1", server.server_address[1])
+        self.assertTrue(assoc.is_established)
+        identifier = Dataset()
+        identifier.QueryRetrieveLevel = "PATIENT"
+        identifier.PatientID = "1CT1"
+        statuses = [
+            status.Status
+            for status, _ in assoc.send_c_move(
+                identifier, "NOWHERE", PatientRootQueryRetrieveInformationModelMove
+            )
+        ]
+        assoc.release()
+        self.assertEqual(statuses, [0xA801])
+
+
+class QidoTests(APIMixin, MediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.persist(
+            *[make_dataset(f"1.2.3.4.{i}", InstanceNumber=i) for i in range(5)]
+        )
+
+    def search(self, url, **params):
+        return self.client.get(url, params, HTTP_ACCEPT="application/dicom+json")
+
+    def sop_uids(self, resp):
+        return [match["00080018"]["Value"][0] for match in resp.json()]
+
+    def test_limit_and_offset(self):
+        pages = [
+            self.search("/dicomweb/instances/", limit=2, offset=offset)
+            for offset in (0, 2, 4)
+        ]
+        self.assertEqual([len(resp.json()) for resp in pages], [2, 2, 1])
+        self.assertIn("offset=2", pages[0]["Link"])
+        self.assertNotIn("Link", pages[2])
+        uids = sum((self.sop_uids(resp) for resp in pages), [])
+        self.assertEqual(sorted(uids), [f"1.2.3.4.{i}" for i in range(5)])
+
+    def test_cursor_paging(self):
+        resp = self.search("/dicomweb/instances/", limit=2, cursor="")
+        uids = []
+        while True:
+            self.assertEqual(resp.status_code, 200)
+            uids += self.sop_uids(resp)
+            if "Link" not in resp:
+                break
+            url, rel = resp["Link"].split("; ")
+            self.assertEqual(rel, 'rel="next"')
+            resp = self.client.get(
+                url.strip("<>"), HTTP_ACCEPT="application/dicom+json"
+            )
+        self.assertEqual(sorted(uids), [f"1.2.3.4.{i}" for i in range(5)])
+        self.assertEqual(len(uids), 5)
+
+        # Same order on a second walk
+        first = self.search("/dicomweb/instances/", limit=5, cursor="")
+        self.assertEqual(self.sop_uids(first), uids)
+        # The page is full, so a next page is linked even though it's empty
+        url = first["Link"].split("; ")[0].strip("<>")
+        resp = self.client.get(url, HTTP_ACCEPT="application/dicom+json")
+        self.assertEqual(resp.status_code, 204)
+
+    def test_invalid_cursor(self):
+        for cursor in ("nope", "1234"):
+            resp = self.search("/dicomweb/instances/", cursor=cursor)
+            self.assertEqual(resp.status_code, 400)
+
+    def test_includefield(self):
+        resp = self.search(
+            "/dicomweb/studies/1.2.3/series/1.2.3.4/instances",
+            InstanceNumber="3",
+            includefield="00200013",
+        )
+        self.assertEqual(self.sop_uids(resp), ["1.2.3.4.3"])
+        match = resp.json()[0]
+        self.assertEqual(match["00200013"]["Value"], [3])
+        self.assertNotIn("00280010", match)
+
+        resp = self.search("/dicomweb/studies", includefield="all")
+        self.assertEqual(len(resp.json()), 1)
+        self.assertGreater(len(resp.json()[0]), len(qido_views.DEFAULT_FIELDS["STUDY"]))
+
+        resp = self.search("/dicomweb/studies", includefield="PixelData")
+        self.assertEqual(resp.status_code, 400)
+
+    def test_no_matches(self):
+        resp = self.search("/dicomweb/series/", SeriesInstanceUID="9.9.9")
+        self.assertEqual(resp.status_code, 204)
+        self.assertEqual(resp.content, b"")
+
+
+def volume_slices(positions, series="1.2.3.4", orientation=(1, 0, 0, 0, 1, 0)):
+    """Slices of a series at `positions` whose pixels hold their index."""
+    slices = []
+    for index, position in enumerate(positions):
+        dataset = make_dataset(
+            f"{series}.{index}",
+            series=series,
+            InstanceNumber=len(positions) - index,
+            ImageOrientationPatient=list(orientation),
+            ImagePositionPatient=list(position),
+        )
+        dataset.PixelData = np.full((128, 128), index, np.int16).tobytes()
+        slices.append(dataset)
+    return slices
+
+
+class VolumeTests(MediaMixin, TestCase):
+    def test_slices_are_sorted_along_the_normal(self):
+        headers = volume_slices(
+            [(0, 5, 0), (0, 0, 0), (0, 2.5, 0)], orientation=(1, 0, 0, 0, 0, -1)
+        )
+        ordered, spacing = volumes.sort_slices(headers)
+        self.assertEqual(
+            [h.SOPInstanceUID for h in ordered], ["1.2.3.4.1", "1.2.3.4.2", "1.2.3.4.0"]
+        )
+        self.assertEqual(spacing, 2.5)
+
+    def test_slices_without_positions_fall_back_to_instance_number(self):
+        headers = volume_slices([(0, 0, 0), (0, 0, 5), (0, 0, 2.5)])
+        del headers[1].ImagePositionPatient
+        ordered, spacing = volumes.sort_slices(headers)
+        self.assertEqual(
+            [h.SOPInstanceUID for h in ordered], ["1.2.3.4.2", "1.2.3.4.1", "1.2.3.4.0"]
+        )
+        self.assertIsNone(spacing)
+
+    def test_volume_is_built_and_reopened(self):
+        self.persist(*volume_slices([(0, 0, 10), (0, 0, 0), (0, 0, 5)]))
+        volume = volumes.volume_cache().get("1.2.3.4")
+        self.assertIsInstance(volume.array, np.memmap)
+        self.assertEqual(volume.array.shape, (3, 128, 128))
+        self.assertEqual(list(volume.array[:, 0, 0]), [1, 2, 0])
+        self.assertEqual(volume.spacing[0], 5)
+
+        cache = volumes.VolumeCache(settings.DICOM_VOLUME_CACHE_DIR, 2**30)
+        with mock.patch.object(cache, "build") as build:
+            reopened = cache.get("1.2.3.4")
+        build.assert_not_called()
+        self.assertEqual(reopened.header, volume.header)
+        self.assertTrue(np.array_equal(reopened.array, volume.array))
+
+    def test_volume_is_rebuilt_when_the_series_changes(self):
+        self.persist(*volume_slices([(0, 0, 0), (0, 0, 5)]))
+        cache = volumes.volume_cache()
+        signature = cache.get("1.2.3.4").header["signature"]
+
+        self.persist(volume_slices([(0, 0, 0), (0, 0, 5), (0, 0, 10)])[2])
+        volume = cache.get("1.2.3.4")
+        self.assertNotEqual(volume.header["signature"], signature)
+        self.assertEqual(list(volume.array[:, 0, 0]), [0, 1, 2])
+
+    def test_least_recently_used_volumes_are_evicted(self):
+        for series in ("1.2.3.4", "1.2.3.5", "1.2.3.6"):
+            self.persist(*volume_slices([(0, 0, 0), (0, 0, 5)], series=series))
+        size = 2 * 128 * 128 * 2
+        cache = volumes.VolumeCache(settings.DICOM_VOLUME_CACHE_DIR, int(size * 2.5))
+        cache.get("1.2.3.4")
+        cache.get("1.2.3.5")
+        # 1.2.3.4 was used after 1.2.3.5
+        now = time.time()
+        os.utime(cache.paths("1.2.3.5")[1], (now - 200, now - 200))
+        os.utime(cache.paths("1.2.3.4")[1], (now - 100, now - 100))
+
+        cache.get("1.2.3.6")
+        self.assertFalse(any(map(os.path.exists, cache.paths("1.2.3.5"))))
+        for series in ("1.2.3.4", "1.2.3.6"):
+            self.assertTrue(all(map(os.path.exists, cache.paths(series))))
+
+
+class RoiStatsTests(TestCase):
+    def setUp(self):
+        self.array = np.arange(4 * 5 * 6, dtype=np.int16).reshape(4, 5, 6)
+        self.volume = volumes.Volume(
+            {"rescale_slope": 1.0, "rescale_intercept": 0.0, "spacing": [2, 1, 1]},
+            self.array,
+        )
+
+    def assertStats(self, stats, voxels, slope=1.0, intercept=0.0):
+        self.assertEqual(stats["count"], voxels.size)
+        self.assertAlmostEqual(stats["mean"], voxels.mean() * slope + intercept)
+        self.assertAlmostEqual(stats["std"], voxels.std() * abs(slope))
+        modality = voxels * slope + intercept
+        self.assertAlmostEqual(stats["min"], modality.min())
+        self.assertAlmostEqual(stats["max"], modality.max())
+
+    def sphere(self, center, radius):
+        """The voxels of a sphere, one at a time."""
+        return np.array(
+            [
+                self.array[index]
+                for index in np.ndindex(self.array.shape)
+                if sum(
+                    ((i - c) * s) ** 2
+                    for i, c, s in zip(index, center, self.volume.spacing)
+                )
+                <= radius**2
+            ]
+        )
+
+    def test_box(self):
+        stats = roi.roi_stats(
+            self.volume,
+            {"type": "box", "name": "b", "start": [1, 1, 2], "end": [3, 4, 5]},
+        )
+        self.assertEqual(stats["name"], "b")
+        self.assertStats(stats, self.array[1:3, 1:4, 2:5])
+
+    def test_sphere(self):
+        stats = roi.roi_stats(
+            self.volume, {"type": "sphere", "center": [2, 2, 3], "radius": 2}
+        )
+        self.assertStats(stats, self.sphere([2, 2, 3], 2))
+        # 2mm reaches the next slices only in line with the center
+        self.assertEqual(stats["count"], 2 + 13)
+
+    def test_rescale_is_applied_to_the_results(self):
+        box = {"type": "box", "start": [0, 0, 0], "end": [2, 2, 2]}
+        for slope, intercept in ((2.0, -1024.0), (-0.5, 10.0)):
+            self.volume.header.update(rescale_slope=slope, rescale_intercept=intercept)
+            stats = roi.roi_stats(self.volume, box)
+            self.assertStats(stats, self.array[:2, :2, :2], slope, intercept)
+
+    def test_rois_are_clipped_at_the_edges(self):
+        stats = roi.roi_stats(
+            self.volume, {"type": "box", "start": [-5, 3, -5], "end": [2, 100, 100]}
+        )
+        self.assertStats(stats, self.array[:2, 3:])
+
+        stats = roi.roi_stats(
+            self.volume, {"type": "sphere", "center": [0, 0, 0], "radius": 1}
+        )
+        self.assertStats(stats, self.sphere([0, 0, 0], 1))
+        self.assertEqual(stats["count"], 3)
+
+        stats = roi.roi_stats(
+            self.volume, {"type": "box", "start": [10, 10, 10], "end": [12, 12, 12]}
+        )
+        self.assertEqual(stats["count"], 0)
+        self.assertIsNone(stats["mean"])
+
+    def test_batch_stats_keep_the_request_order(self):
+        box = {"type": "box", "start": [0, 0, 0], "end": [1, 1, 1]}
+        with (
+            mock.patch.object(
+                roi, "series_stats", side_effect=lambda uid, rois: uid
+            ) as series_stats,
+            mock.patch.object(roi, "stats_pool") as stats_pool,
+        ):
+            stats_pool.return_value = ThreadPoolExecutor(2)
+            self.assertEqual(roi.batch_stats([("1", [box])]), ["1"])
+            stats_pool.assert_not_called()
+            self.assertEqual(
+                roi.batch_stats([(str(i), [box]) for i in range(5)]),
+                ["0", "1", "2", "3", "4"],
+            )
+            stats_pool.return_value.shutdown()
+        self.assertEqual(series_stats.call_count, 6)
+
+    def test_stats_pool_is_shared(self):
+        self.addCleanup(setattr, roi, "_stats_pool", None)
+        pool = roi.stats_pool()
+        self.addCleanup(pool.shutdown)
+        self.assertIs(roi.stats_pool(), pool)
@@ -0,0 +1,105 @@
+import multiprocessing
+import os
+import signal
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+
+from dicom import rendering, storage
+from dicom.models import Instance
+
+
+def thumbnail_name(image_name):
+    """Thumbnail of an instance, stored next to its .dcm"""
+    return f"{os.path.splitext(image_name)[0]}.thumb.jpg"
+
+
+def preview_name(image_name, series_instance_uid):
+    """Preview of a series, stored next to its representative instance"""
+    return os.path.join(
+        os.path.dirname(image_name), f"{series_instance_uid}.preview.jpg"
+    )
+
+
+def representative_instance(series_instance_uid):
+    """Return the image name of the middle instance of a series, or None."""
+    queryset = Instance.objects.filter(
+        series__series_instance_uid=series_instance_uid, image__isnull=False
+    ).order_by("instance_number", "sop_instance_uid")
+    count = queryset.count()
+    if not count:
+        return None
+    return queryset.values_list("image__image", flat=True)[count // 2]
+
+
+class ThumbnailStage:
+    """
+    Post-persist ingest stage building a thumbnail per instance and a
+    preview of the middle instance per series.
+
+    Decoding and encoding run in a process pool: the ingest worker only
+    submits paths, so neither C-STORE handling nor persistence waits on
+    pixel work. A series preview is rebuilt only when its middle
+    instance changes.
+    """
+
+    # Series whose preview source is remembered, beyond that start over
+    MAX_TRACKED_SERIES = 10000
+
+    def __init__(self, workers):
+        # Spawned workers don't inherit the receiver's threads and sockets,
+        # and leave Ctrl+C to the receiver so the pool can drain on shutdown
+        self.pool = ProcessPoolExecutor(
+            workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=signal.signal,
+            initargs=(signal.SIGINT, signal.SIG_IGN),
+        )
+        self._previews = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, items):
+        for item in items:
+            self._submit(
+                item.image_path,
+                thumbnail_name(item.image_path),
+                settings.DICOM_THUMBNAIL_SIZE,
+            )
+
+        series_uids = {
+            item.attributes["series"]["series_instance_uid"] for item in items
+        }
+        for series_uid in series_uids:
+            name = representative_instance(series_uid)
+            with self._lock:
+                if name is None or self._previews.get(series_uid) == name:
+                    continue
+                if len(self._previews) >= self.MAX_TRACKED_SERIES:
+                    self._previews.clear()
+                self._previews[series_uid] = name
+            self._submit(
+                name, preview_name(name, series_uid), settings.DICOM_PREVIEW_SIZE
+            )
+
+    def _submit(self, src, dst, size):
+        future = self.pool.submit(
+            rendering.write_thumbnail,
+            storage.absolute_path(src),
+            storage.absolute_path(dst),
+            size,
+            settings.DICOMWEB_RENDER_JPEG_QUALITY,
+        )
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        try:
+            error = future.result()
+        except Exception as e:
+            error = str(e)
+        if error:
+            print(f" Unable to build thumbnail: {error}")
+
+    def shutdown(self):
+        """Finish the pending thumbnails, then stop the pool."""
+        self.pool.shutdown(wait=True)
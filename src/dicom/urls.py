@@ -0,0 +1,59 @@
+from django.urls import re_path
+
+from dicom import views
+
+urlpatterns = []
+
+# DICOMweb clients don't send trailing slashes, so they are optional
+qido_urlpatterns = [
+    re_path(r"^studies/?$", views.StudiesView.as_view()),
+    re_path(
+        r"^studies/(?P<study>[0-9.]+)/series/?$",
+        views.SeriesSearchView.as_view(),
+    ),
+    re_path(
+        r"^studies/(?P<study>[0-9.]+)/instances/?$",
+        views.InstanceSearchView.as_view(),
+    ),
+    re_path(
+        r"^studies/(?P<study>[0-9.]+)/series/(?P<series>[0-9.]+)/instances/?$",
+        views.InstanceSearchView.as_view(),
+    ),
+    re_path(r"^series/?$", views.SeriesSearchView.as_view()),
+    re_path(
+        r"^series/(?P<series>[0-9.]+)/instances/?$",
+        views.InstanceSearchView.as_view(),
+    ),
+    re_path(r"^instances/?$", views.InstanceSearchView.as_view()),
+]
+
+STUDY = r"^studies/(?P<study>[0-9.]+)"
+SERIES = STUDY + r"/series/(?P<series>[0-9.]+)"
+INSTANCE = SERIES + r"/instances/(?P<instance>[0-9.]+)"
+
+wado_urlpatterns = [
+    re_path(STUDY + r"/?$", views.StudyView.as_view()),
+    re_path(SERIES + r"/?$", views.RetrieveInstancesView.as_view()),
+    re_path(INSTANCE + r"/?$", views.RetrieveInstanceView.as_view()),
+    re_path(
+        INSTANCE + r"/frames/(?P<frames>[0-9]+(,[0-9]+)*)/?$",
+        views.RetrieveFramesView.as_view(),
+    ),
+    re_path(INSTANCE + r"/bulkdata/?$", views.RetrieveBulkdataView.as_view()),
+    re_path(INSTANCE + r"/rendered/?$", views.RenderedView.as_view()),
+    re_path(
+        INSTANCE + r"/frames/(?P<frame>[0-9]+)/rendered/?$",
+        views.RenderedView.as_view(),
+    ),
+    re_path(SERIES + r"/thumbnail/?$", views.ThumbnailView.as_view()),
+    re_path(SERIES + r"/reformat/?$", views.ReformatView.as_view()),
+    re_path(INSTANCE + r"/thumbnail/?$", views.ThumbnailView.as_view()),
+]
+
+analysis_urlpatterns = [
+    re_path(r"^roi-stats/?$", views.RoiStatsView.as_view()),
+]
+
+urlpatterns += qido_urlpatterns
+urlpatterns += wado_urlpatterns
+urlpatterns += analysis_urlpatterns
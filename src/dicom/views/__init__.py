@@ -0,0 +1,5 @@
+from .qido_views import *
+from .render_views import *
+from .roi_views import *
+from .stow_views import *
+from .wado_views import *
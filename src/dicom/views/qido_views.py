@@ -0,0 +1,191 @@
+import uuid
+
+from django.conf import settings
+from pydicom.datadict import keyword_for_tag
+from pydicom.dataset import Dataset
+from rest_framework import exceptions, permissions, response, status, views
+from rest_framework.renderers import JSONRenderer
+
+from dicom import query
+from dicom.renderers import DicomJSONRenderer
+
+# Attributes returned when no includefield is given (PS3.18 Table 6.7.1-2)
+DEFAULT_FIELDS = {
+    "STUDY": [
+        "StudyDate",
+        "StudyTime",
+        "AccessionNumber",
+        "ModalitiesInStudy",
+        "ReferringPhysicianName",
+        "PatientName",
+        "PatientID",
+        "PatientBirthDate",
+        "PatientSex",
+        "StudyInstanceUID",
+        "StudyID",
+        "NumberOfStudyRelatedSeries",
+        "NumberOfStudyRelatedInstances",
+    ],
+    "SERIES": [
+        "Modality",
+        "SeriesDescription",
+        "SeriesNumber",
+        "SeriesInstanceUID",
+        "NumberOfSeriesRelatedInstances",
+    ],
+    "IMAGE": [
+        "SOPClassUID",
+        "SOPInstanceUID",
+        "InstanceNumber",
+        "Rows",
+        "Columns",
+        "NumberOfFrames",
+    ],
+}
+
+# Query parameters that aren't matching attributes
+CONTROL_PARAMETERS = {"limit", "offset", "cursor", "includefield", "fuzzymatching"}
+
+
+def attribute_keyword(key):
+    """
+    Return the keyword of a QIDO attribute given as a keyword or as an
+    8 digit hex tag (e.g. "0020000D").
+    """
+    if len(key) == 8:
+        try:
+            return keyword_for_tag(int(key, 16)) or key
+        except ValueError:
+            pass
+    return key
+
+
+def _positive_int(request, name, default):
+    try:
+        value = int(request.query_params.get(name, default))
+    except ValueError:
+        raise exceptions.ValidationError({name: "Must be an integer"})
+    if value < 0:
+        raise exceptions.ValidationError({name: "Must not be negative"})
+    return value
+
+
+class QidoView(views.APIView):
+    """
+    Base QIDO-RS search view
+
+    Matches are read from the Patient/Study/Series/Instance index and
+    rendered as DICOM JSON without opening any stored file.
+
+    Paging is either `limit`/`offset`, or keyset paging when a `cursor`
+    parameter is given (empty for the first page): results are ordered by
+    primary key and each page continues after the last key of the previous
+    one, so deep pages cost the same as the first. When a page is full the
+    next page's URL is sent in a `Link: <...>; rel="next"` header.
+
+    `includefield` projects the response onto the listed attributes plus
+    the unique key of the level; `includefield=all` returns everything the
+    index holds.
+    """
+
+    permission_classes = (permissions.IsAuthenticated,)
+    renderer_classes = (DicomJSONRenderer, JSONRenderer)
+    level = None
+    # URL kwarg -> matching key
+    path_keys = {}
+
+    def get_identifier(self, request, kwargs):
+        attributes = query.level_attributes(self.level)
+        includefields = [
+            attribute_keyword(field.strip())
+            for value in request.query_params.getlist("includefield")
+            for field in value.split(",")
+        ]
+        if "all" in includefields:
+            fields = list(attributes)
+        else:
+            fields = includefields or DEFAULT_FIELDS[self.level]
+
+        identifier = Dataset()
+        for keyword in fields:
+            if keyword not in attributes:
+                raise exceptions.ValidationError(
+                    {"includefield": f"Unsupported attribute {keyword}"}
+                )
+            setattr(identifier, keyword, None)
+
+        for key, value in request.query_params.items():
+            if key in CONTROL_PARAMETERS:
+                continue
+            keyword = attribute_keyword(key)
+            if keyword not in attributes:
+                raise exceptions.ValidationError({key: "Unsupported attribute"})
+            # QIDO separates list matching values with commas
+            setattr(identifier, keyword, value.replace(",", "\\"))
+
+        # The same level can be searched below a study, a series or neither
+        for kwarg, keyword in self.path_keys.items():
+            if kwarg in kwargs:
+                setattr(identifier, keyword, kwargs[kwarg])
+        return identifier
+
+    def paginate(self, request, queryset):
+        limit = _positive_int(request, "limit", settings.DICOMWEB_QIDO_LIMIT)
+        limit = min(limit, settings.DICOMWEB_QIDO_MAX_LIMIT)
+        queryset = queryset.order_by("pk")
+
+        cursor = request.query_params.get("cursor")
+        if cursor is None:
+            offset = _positive_int(request, "offset", 0)
+            return queryset[offset : offset + limit], limit
+
+        if cursor:
+            try:
+                queryset = queryset.filter(pk__gt=uuid.UUID(cursor))
+            except ValueError:
+                raise exceptions.ValidationError({"cursor": "Invalid cursor"})
+        return queryset[:limit], limit
+
+    def next_link(self, request, limit, last_pk):
+        params = request.query_params.copy()
+        if "cursor" in params:
+            params["cursor"] = str(last_pk)
+        else:
+            params["offset"] = _positive_int(request, "offset", 0) + limit
+        url = request.build_absolute_uri(request.path)
+        return f'<{url}?{params.urlencode()}>; rel="next"'
+
+    def get(self, request, **kwargs):
+        identifier = self.get_identifier(request, kwargs)
+        try:
+            queryset, fields = query.build_queryset(self.level, identifier)
+        except ValueError as e:
+            raise exceptions.ValidationError(str(e))
+
+        page, limit = self.paginate(request, queryset)
+        results = []
+        last_pk = None
+        for last_pk, dataset in query.matches(self.level, page, fields):
+            results.append(dataset.to_json_dict())
+
+        if not results:
+            return response.Response(status=status.HTTP_204_NO_CONTENT)
+
+        resp = response.Response(results)
+        if len(results) == limit:
+            resp["Link"] = self.next_link(request, limit, last_pk)
+        return resp
+
+
+class StudySearchView(QidoView):
+    level = "STUDY"
+
+
+class SeriesSearchView(QidoView):
+    level = "SERIES"
+    path_keys = {"study": "StudyInstanceUID"}
+
+
+class InstanceSearchView(QidoView):
+    level = "IMAGE"
+    path_keys = {"study": "StudyInstanceUID", "series": "SeriesInstanceUID"}
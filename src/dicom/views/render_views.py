@@ -0,0 +1,189 @@
+import os
+
+from django.conf import settings
+from django.http import Http404, HttpResponse
+from rest_framework import exceptions, status
+
+from dicom import pixeldata, reformat, rendering, storage, thumbnails, volumes
+
+from .wado_views import WadoView, _accepts
+
+
+def _numbers(request, name, count, cast, positive=False):
+    """
+    Parse the first `count` comma separated numbers of a query parameter,
+    which must all be above 0 when `positive`.
+    """
+    value = request.query_params.get(name)
+    if not value:
+        return None
+    try:
+        numbers = tuple(cast(number) for number in value.split(",")[:count])
+    except ValueError:
+        raise exceptions.ValidationError({name: "Invalid value"})
+    if len(numbers) != count:
+        raise exceptions.ValidationError({name: f"Expected {count} values"})
+    if positive and min(numbers) <= 0:
+        raise exceptions.ValidationError({name: "Values must be positive"})
+    return numbers
+
+
+class VolumeCacheUnavailable(exceptions.APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = "Volume cache unavailable"
+
+
+class RenderedView(WadoView):
+    """
+    Render a frame as JPEG (default) or PNG
+
+    `window=center,width` overrides the stored VOI window and
+    `viewport=width,height` scales the image to fit. Renderings are kept
+    in the on-disk LRU render cache, keyed by instance, frame, window,
+    viewport and format, so scrolling back over a series is served from
+    disk instead of decoding again.
+    """
+
+    def get(self, request, frame=1, **kwargs):
+        image_name, _, _ = self.instance(**kwargs)
+        path = storage.absolute_path(image_name)
+        window = _numbers(request, "window", 2, float)
+        viewport = _numbers(request, "viewport", 2, int, positive=True)
+        image_format = "jpeg"
+        if _accepts(request, "image/png") and not _accepts(request, "image/jpeg"):
+            image_format = "png"
+
+        try:
+            # A re-sent instance replaces the file, and must not hit old entries
+            modified = os.stat(path).st_mtime_ns
+        except OSError:
+            raise Http404
+        key = (kwargs["instance"], int(frame), window, viewport, image_format, modified)
+
+        cache = rendering.render_cache()
+        data = cache.get(key)
+        if data is None:
+            try:
+                data = rendering.render_frame(
+                    path, int(frame), window, viewport, image_format
+                )
+            except (IndexError, pixeldata.NoPixelData):
+                raise Http404
+            except (ValueError, RuntimeError, NotImplementedError) as e:
+                print(f" Unable to render {kwargs['instance']}: {e}")
+                raise exceptions.NotAcceptable(f"Unable to render instance: {e}")
+            cache.put(key, data)
+
+        return HttpResponse(data, content_type=rendering.MEDIA_TYPES[image_format])
+
+
+class ThumbnailView(WadoView):
+    """
+    Thumbnail of an instance, or preview of a series, as built by the
+    receiver's thumbnail stage. Falls back to rendering when it hasn't
+    been built (yet).
+    """
+
+    def get(self, request, **kwargs):
+        if "instance" in kwargs:
+            image_name, _, _ = self.instance(**kwargs)
+            path = storage.absolute_path(image_name)
+            name = storage.absolute_path(thumbnails.thumbnail_name(image_name))
+            size = settings.DICOM_THUMBNAIL_SIZE
+        else:
+            image_name = thumbnails.representative_instance(kwargs["series"])
+            if image_name is None:
+                raise Http404
+            path = storage.absolute_path(image_name)
+            name = storage.absolute_path(
+                thumbnails.preview_name(image_name, kwargs["series"])
+            )
+            size = settings.DICOM_PREVIEW_SIZE
+
+        try:
+            with open(name, "rb") as f:
+                return HttpResponse(f.read(), content_type="image/jpeg")
+        except FileNotFoundError:
+            pass
+
+        error = rendering.write_thumbnail(
+            path, name, size, settings.DICOMWEB_RENDER_JPEG_QUALITY
+        )
+        if error:
+            print(f" Unable to build thumbnail: {error}")
+            raise Http404
+        with open(name, "rb") as f:
+            return HttpResponse(f.read(), content_type="image/jpeg")
+
+
+class ReformatView(WadoView):
+    """
+    Multiplanar reformat or projection of a series
+
+    `plane` is axial, coronal or sagittal, `index` the voxel position along
+    it (middle by default). `slab` (mm) projects that thickness with
+    `projection` mip, minip or mean. `window` and `viewport` are as for
+    rendered frames. The series is assembled into a cached volume on
+    first use.
+    """
+
+    def get(self, request, **kwargs):
+        plane = request.query_params.get("plane", "axial")
+        projection = request.query_params.get("projection", "mip")
+        if plane not in reformat.PLANES:
+            raise exceptions.ValidationError({"plane": "Unknown plane"})
+        if projection not in reformat.PROJECTIONS:
+            raise exceptions.ValidationError({"projection": "Unknown projection"})
+        index = _numbers(request, "index", 1, int)
+        slab = _numbers(request, "slab", 1, float, positive=True)
+        window = _numbers(request, "window", 2, float)
+        viewport = _numbers(request, "viewport", 2, int, positive=True)
+        image_format = "jpeg"
+        if _accepts(request, "image/png") and not _accepts(request, "image/jpeg"):
+            image_format = "png"
+
+        try:
+            volume = volumes.volume_cache().get(kwargs["series"])
+        except (LookupError, pixeldata.NoPixelData, FileNotFoundError):
+            raise Http404
+        except OSError as e:
+            print(f" Unable to cache volume of {kwargs['series']}: {e}")
+            raise VolumeCacheUnavailable
+        except ValueError as e:
+            raise exceptions.ValidationError(str(e))
+        except (RuntimeError, NotImplementedError) as e:
+            print(f" Unable to assemble {kwargs['series']}: {e}")
+            raise exceptions.NotAcceptable(f"Unable to assemble series: {e}")
+
+        axis = reformat.PLANES[plane]
+        voxels = reformat.slab_voxels(volume, axis, slab[0] if slab else None)
+        key = (
+            "reformat",
+            volume.header["signature"],
+            axis,
+            index,
+            voxels,
+            projection,
+            window,
+            viewport,
+            image_format,
+        )
+        cache = rendering.render_cache()
+        data = cache.get(key)
+        if data is None:
+            try:
+                data = reformat.render_reformat(
+                    volume,
+                    axis,
+                    index[0] if index else None,
+                    voxels,
+                    projection,
+                    window,
+                    viewport,
+                    image_format,
+                )
+            except IndexError:
+                raise Http404
+            cache.put(key, data)
+
+        return HttpResponse(data, content_type=rendering.MEDIA_TYPES[image_format])
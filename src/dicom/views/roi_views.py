@@ -0,0 +1,24 @@
+from rest_framework import permissions, response, views
+
+from dicom import roi, serializers
+
+
+class RoiStatsView(views.APIView):
+    """
+    ROI statistics (count, mean, std, min, max in modality units) for a
+    batch of series, each series computed in the ROI process pool
+    """
+
+    permission_classes = (permissions.IsAuthenticated,)
+    serializer_class = serializers.SeriesRoiSerializer
+
+    def post(self, request):
+        serializer = self.serializer_class(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        results = roi.batch_stats(
+            [
+                (item["series_instance_uid"], item["rois"])
+                for item in serializer.validated_data
+            ]
+        )
+        return response.Response(results)
@@ -0,0 +1,180 @@
+import contextlib
+import os
+import tempfile
+
+from django.conf import settings
+from django.utils.http import parse_header_parameters
+from pydicom.dataset import Dataset
+from pydicom.errors import InvalidDicomError
+from rest_framework import exceptions, permissions, response, status, views
+from rest_framework.renderers import JSONRenderer
+
+from dicom import dedup, ingest, storage
+from dicom.multipart import MultipartReader
+from dicom.renderers import DicomJSONRenderer
+
+from .qido_views import StudySearchView
+from .wado_views import RetrieveInstancesView
+
+# FailureReason values (PS3.18 Table I.2-1)
+PROCESSING_FAILURE = 0x0110
+CANNOT_UNDERSTAND = 0xC000
+INVALID_DATASET = 0xA900
+
+REQUIRED_UIDS = ("StudyInstanceUID", "SeriesInstanceUID", "SOPInstanceUID")
+
+
+class StoreInstancesView(views.APIView):
+    """
+    STOW-RS: store the application/dicom parts of a multipart/related body
+
+    The body is parsed as it arrives, each part is spooled to
+    DICOM_SPOOL_DIR and moved into storage before the next one is read,
+    then queued on the same ingest pipeline as C-STORE. The response
+    lists every instance as referenced (stored) or failed.
+    """
+
+    permission_classes = (permissions.IsAuthenticated,)
+    renderer_classes = (DicomJSONRenderer, JSONRenderer)
+
+    def boundary(self, request):
+        content_type, params = parse_header_parameters(
+            request.META.get("CONTENT_TYPE", "")
+        )
+        if content_type != "multipart/related":
+            raise exceptions.UnsupportedMediaType(content_type)
+        part_type = params.get("type", "application/dicom")
+        if part_type != "application/dicom":
+            raise exceptions.UnsupportedMediaType(part_type)
+        if not params.get("boundary"):
+            raise exceptions.ParseError("Missing multipart boundary")
+        return params["boundary"]
+
+    def spool(self, chunks):
+        """
+        Write a part's body to a spool file, hashing it on the way.
+
+        Returns the path and the content hash.
+        """
+        content_hash = dedup.new_hash()
+        with tempfile.NamedTemporaryFile(
+            dir=settings.DICOM_SPOOL_DIR, suffix=".part", delete=False
+        ) as f:
+            for chunk in chunks:
+                f.write(chunk)
+                content_hash.update(chunk)
+        return f.name, content_hash.hexdigest()
+
+    def store(self, spool_path, content_hash, study):
+        """
+        Move a spooled part into storage and queue it for indexing.
+
+        Returns (dataset, IngestItem or None, failure reason or None), the
+        item None without a failure when the instance is already stored.
+        """
+        try:
+            with open(spool_path, "rb") as f:
+                dataset = storage.read_index_tags(f)
+        except (InvalidDicomError, ValueError, EOFError) as e:
+            print(f" Unable to parse STOW-RS part: {e}")
+            return Dataset(), None, CANNOT_UNDERSTAND
+        # The UIDs name the stored file and its RetrieveURL
+        if not all(dataset.get(keyword) for keyword in REQUIRED_UIDS) or (
+            study and dataset.StudyInstanceUID != study
+        ):
+            return dataset, None, CANNOT_UNDERSTAND
+
+        patient_id = dataset.get("PatientID", "UnknownID")
+        print(f"Received DICOM for PatientID: {patient_id}")
+        try:
+            dicom_filepath = dedup.storage_target(dataset, content_hash)
+        except storage.InvalidUID as e:
+            print(f" Refusing STOW-RS part: {e}")
+            return dataset, None, INVALID_DATASET
+        if dicom_filepath is None:
+            return dataset, None, None
+        try:
+            storage.move_into_place(spool_path, dicom_filepath)
+        except OSError as e:
+            print(f" Error writing DICOM file: {e}")
+            return dataset, None, PROCESSING_FAILURE
+
+        item = ingest.enqueue(
+            ingest.shared_queue(), dicom_filepath, dataset, content_hash
+        )
+        if item is None:
+            return dataset, None, 0xA700
+        return dataset, item, None
+
+    def post(self, request, study=None):
+        boundary = self.boundary(request)
+        if request.stream is None:
+            raise exceptions.ParseError("Empty request body")
+        os.makedirs(settings.DICOM_SPOOL_DIR, exist_ok=True)
+
+        results = []
+        reader = MultipartReader(request.stream, boundary, settings.DICOMWEB_CHUNK_SIZE)
+        try:
+            for headers, chunks in reader:
+                spool_path, content_hash = self.spool(chunks)
+                try:
+                    part_type, _ = parse_header_parameters(
+                        headers.get("content-type", "application/dicom")
+                    )
+                    if part_type != "application/dicom":
+                        results.append((Dataset(), None, CANNOT_UNDERSTAND))
+                        continue
+                    results.append(self.store(spool_path, content_hash, study))
+                finally:
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(spool_path)
+        except ValueError as e:
+            # Whatever was stored before the body broke off is still reported
+            print(f" Malformed STOW-RS body: {e}")
+            if not results:
+                raise exceptions.ParseError(str(e))
+
+        # Wait for the commits only once everything is queued, so the
+        # instances of one request share ingest batches
+        referenced, failed = [], []
+        for dataset, item, reason in results:
+            if item is not None and ingest.commit_status(item) != 0x0000:
+                reason = PROCESSING_FAILURE
+            entry = Dataset()
+            entry.ReferencedSOPClassUID = dataset.get("SOPClassUID", "")
+            entry.ReferencedSOPInstanceUID = dataset.get("SOPInstanceUID", "")
+            if reason is None:
+                entry.RetrieveURL = request.build_absolute_uri(
+                    f"/dicomweb/studies/{dataset.StudyInstanceUID}"
+                    f"/series/{dataset.SeriesInstanceUID}"
+                    f"/instances/{dataset.SOPInstanceUID}"
+                )
+                referenced.append(entry)
+            else:
+                entry.FailureReason = reason
+                failed.append(entry)
+
+        result = Dataset()
+        if study:
+            result.RetrieveURL = request.build_absolute_uri(
+                f"/dicomweb/studies/{study}"
+            )
+        result.ReferencedSOPSequence = referenced
+        if failed:
+            result.FailedSOPSequence = failed
+
+        if not failed:
+            code = status.HTTP_200_OK
+        elif referenced:
+            code = status.HTTP_202_ACCEPTED
+        else:
+            code = status.HTTP_409_CONFLICT
+        return response.Response(result.to_json_dict(), status=code)
+
+
+class StudiesView(StudySearchView, StoreInstancesView):
+    """Search for studies (QIDO-RS) or store instances (STOW-RS)"""
+
+
+class StudyView(StoreInstancesView, RetrieveInstancesView):
+    """Retrieve a study (WADO-RS) or store instances into it (STOW-RS)"""
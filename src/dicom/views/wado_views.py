@@ -0,0 +1,320 @@
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from pydicom.errors import InvalidDicomError
+from pydicom.uid import DeflatedExplicitVRLittleEndian, ExplicitVRLittleEndian
+from rest_framework import exceptions, permissions, views
+from rest_framework.renderers import JSONRenderer
+
+from dicom import compression, pixeldata, storage, wado
+from dicom.models import Instance
+
+# Number of instance rows fetched from the database per round trip
+RETRIEVE_CHUNK_SIZE = 500
+
+
+def _accepts(request, media_type):
+    accept = request.META.get("HTTP_ACCEPT", "")
+    return media_type in accept
+
+
+def _dicom_type(transfer_syntax_uid):
+    if not transfer_syntax_uid:
+        return "application/dicom"
+    return f"application/dicom; transfer-syntax={transfer_syntax_uid}"
+
+
+def _instance_segment(name, transfer_syntax_uid, stored_transfer_syntax_uid):
+    """
+    Return the body segment of a stored instance, re-encoded in the
+    transfer syntax it was received in when it was compressed at rest.
+    """
+    if not stored_transfer_syntax_uid:
+        return storage.locate(name)
+    try:
+        path = storage.absolute_path(name)
+        return compression.encode(compression.restore(path, transfer_syntax_uid))
+    except (ValueError, RuntimeError, InvalidDicomError) as e:
+        raise OSError(f"Unable to decompress {name}: {e}")
+
+
+def _decoded_frame_table(path, transfer_syntax_uid, decompress=False):
+    """
+    Return (transfer syntax UID, Pixel Data, (offset, length, frames)) of an
+    instance whose frames can't be read at file offsets, the frames then
+    being ranges of the decoded Pixel Data bytes. With `decompress` the
+    frames are served uncompressed.
+    """
+    dataset = compression.restore(path, transfer_syntax_uid)
+    if "PixelData" not in dataset:
+        raise Http404
+    if decompress:
+        dataset.decompress(as_rgb=False, generate_instance_uid=False)
+        transfer_syntax_uid = dataset.file_meta.TransferSyntaxUID
+    data = dataset.PixelData
+    frames = int(dataset.get("NumberOfFrames") or 1)
+    frame_length = pixeldata.native_frame_length(dataset)
+    ranges = [[(index * frame_length, frame_length)] for index in range(frames)]
+    if transfer_syntax_uid == DeflatedExplicitVRLittleEndian:
+        # Deflate applies to the whole dataset, the pixels themselves are native
+        transfer_syntax_uid = ExplicitVRLittleEndian
+    return transfer_syntax_uid, data, (0, len(data), ranges)
+
+
+def _shifted(offsets, base):
+    """Move frame offsets within a file to where the file sits in a segment."""
+    if not base:
+        return offsets
+    offset, length, ranges = offsets
+    ranges = [[(start + base, size) for start, size in frame] for frame in ranges]
+    return offset + base, length, ranges
+
+
+def _segment(source, offset, length):
+    """Return a segment of a file path or of decoded bytes."""
+    if isinstance(source, bytes):
+        return source[offset : offset + length]
+    return (source, offset, length)
+
+
+def _ranged_response(request, segments, content_type):
+    """
+    Stream `segments` as a single body, honoring a Range header with a
+    206 Partial Content response.
+    """
+    size = sum(wado.segment_length(segment) for segment in segments)
+    try:
+        byte_range = wado.parse_range(request.META.get("HTTP_RANGE"), size)
+    except ValueError:
+        resp = HttpResponse(status=416)
+        resp["Content-Range"] = f"bytes */{size}"
+        return resp
+
+    status = 200
+    if byte_range is not None:
+        start, end = byte_range
+        segments = wado.slice_segments(segments, start, end)
+        status = 206
+
+    resp = StreamingHttpResponse(
+        wado.stream_segments(segments), content_type=content_type, status=status
+    )
+    resp["Accept-Ranges"] = "bytes"
+    if byte_range is not None:
+        resp["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+        resp["Content-Length"] = end - start
+    else:
+        resp["Content-Length"] = size
+    return resp
+
+
+class WadoView(views.APIView):
+    """
+    Base WADO-RS retrieve view
+
+    Stored files are streamed in DICOMWEB_CHUNK_SIZE chunks straight from
+    storage, so worker memory stays flat whatever the size of the study.
+    """
+
+    permission_classes = (permissions.IsAuthenticated,)
+    renderer_classes = (JSONRenderer,)
+
+    def perform_content_negotiation(self, request, force=False):
+        # Responses are built by hand; the renderer only formats errors
+        return super().perform_content_negotiation(request, force=True)
+
+    def instances(self, **kwargs):
+        queryset = Instance.objects.filter(image__isnull=False)
+        if "study" in kwargs:
+            queryset = queryset.filter(
+                series__study__study_instance_uid=kwargs["study"]
+            )
+        if "series" in kwargs:
+            queryset = queryset.filter(series__series_instance_uid=kwargs["series"])
+        if "instance" in kwargs:
+            queryset = queryset.filter(sop_instance_uid=kwargs["instance"])
+        return queryset.values_list(
+            "image__image", "transfer_syntax_uid", "stored_transfer_syntax_uid"
+        )
+
+    def instance(self, **kwargs):
+        """
+        Return (storage name, transfer syntax UID, stored transfer syntax
+        UID) of a single stored instance.
+        """
+        row = self.instances(**kwargs).first()
+        if row is None:
+            raise Http404
+        return row
+
+    def frame_table(self, **kwargs):
+        """
+        Return (source, transfer syntax UID, (pixel data offset, length,
+        frames)) of a single instance, from the FrameOffsetTable recorded
+        at ingest, or by scanning the file when there is none.
+
+        The source is the path of the file, or of the segment it was packed
+        into, or the decoded Pixel Data for instances compressed at rest and
+        deflated ones.
+        """
+        table = "image__frame_offset_table__"
+        row = (
+            self.instances(**kwargs)
+            .values_list(
+                "image__image",
+                "transfer_syntax_uid",
+                "stored_transfer_syntax_uid",
+                f"{table}pk",
+                f"{table}pixel_data_offset",
+                f"{table}pixel_data_length",
+                f"{table}frames",
+            )
+            .first()
+        )
+        if row is None:
+            raise Http404
+        name, transfer_syntax_uid, stored, table_pk, *offsets = row
+        try:
+            if compression.decoded_frames(transfer_syntax_uid, stored):
+                transfer_syntax_uid, data, offsets = _decoded_frame_table(
+                    storage.absolute_path(name), transfer_syntax_uid
+                )
+                return data, transfer_syntax_uid, offsets
+            if table_pk is None:
+                path = storage.absolute_path(name)
+                try:
+                    return path, transfer_syntax_uid, pixeldata.frame_table(path)
+                except pixeldata.UnknownFrameLayout:
+                    # Frames split over fragments with no offset table
+                    transfer_syntax_uid, data, offsets = _decoded_frame_table(
+                        path, transfer_syntax_uid, decompress=True
+                    )
+                    return data, transfer_syntax_uid, offsets
+            path, base, _ = storage.locate(name)
+        except OSError:
+            raise Http404
+        except (ValueError, RuntimeError, InvalidDicomError) as e:
+            raise exceptions.ValidationError(str(e))
+        return path, transfer_syntax_uid, _shifted(offsets, base)
+
+
+class RetrieveInstancesView(WadoView):
+    """
+    Retrieve every instance of a study or series as one multipart/related
+    response, reading files one at a time while the response is sent.
+    """
+
+    def get(self, request, **kwargs):
+        queryset = self.instances(**kwargs)
+        if not queryset.exists():
+            raise Http404
+
+        def parts():
+            rows = queryset.iterator(chunk_size=RETRIEVE_CHUNK_SIZE)
+            for name, transfer_syntax_uid, stored in rows:
+                try:
+                    segment = _instance_segment(name, transfer_syntax_uid, stored)
+                except OSError as e:
+                    print(f" Unable to read stored instance {name}: {e}")
+                    continue
+                yield _dicom_type(transfer_syntax_uid), [segment]
+
+        boundary = wado.new_boundary()
+        return StreamingHttpResponse(
+            wado.stream_segments(wado.multipart_segments(parts(), boundary)),
+            content_type=wado.multipart_content_type(boundary, "application/dicom"),
+        )
+
+
+class RetrieveInstanceView(WadoView):
+    """
+    Retrieve a single instance, as multipart/related or, when the client
+    only accepts application/dicom, as the bare file. Range is honored on
+    either body.
+    """
+
+    def get(self, request, **kwargs):
+        name, transfer_syntax_uid, stored = self.instance(**kwargs)
+        try:
+            segment = _instance_segment(name, transfer_syntax_uid, stored)
+        except OSError:
+            raise Http404
+
+        if _accepts(request, "application/dicom") and not _accepts(
+            request, "multipart/related"
+        ):
+            return _ranged_response(
+                request, [segment], _dicom_type(transfer_syntax_uid)
+            )
+
+        boundary = wado.new_boundary()
+        segments = list(
+            wado.multipart_segments(
+                [(_dicom_type(transfer_syntax_uid), [segment])], boundary
+            )
+        )
+        return _ranged_response(
+            request,
+            segments,
+            wado.multipart_content_type(boundary, "application/dicom"),
+        )
+
+
+class RetrieveFramesView(WadoView):
+    """
+    Retrieve frames (1-based, comma separated) of an instance as
+    multipart/related application/octet-stream parts, as stored.
+
+    Only the requested frames' bytes are read, at the offsets recorded in
+    the instance's FrameOffsetTable.
+    """
+
+    def get(self, request, frames, **kwargs):
+        source, transfer_syntax_uid, (_, _, ranges) = self.frame_table(**kwargs)
+        numbers = [int(number) for number in frames.split(",")]
+        if any(number < 1 or number > len(ranges) for number in numbers):
+            raise Http404
+
+        part_type = f"application/octet-stream; transfer-syntax={transfer_syntax_uid}"
+        parts = [
+            (
+                part_type,
+                [
+                    _segment(source, offset, length)
+                    for offset, length in ranges[number - 1]
+                ],
+            )
+            for number in numbers
+        ]
+        boundary = wado.new_boundary()
+        return _ranged_response(
+            request,
+            list(wado.multipart_segments(parts, boundary)),
+            wado.multipart_content_type(boundary, "application/octet-stream"),
+        )
+
+
+class RetrieveBulkdataView(WadoView):
+    """
+    Retrieve the Pixel Data value of an instance as a bare
+    application/octet-stream body, honoring Range so viewers can fetch
+    it in pieces.
+    """
+
+    def get(self, request, **kwargs):
+        source, transfer_syntax_uid, (offset, length, ranges) = self.frame_table(
+            **kwargs
+        )
+        if length is None:
+            # Encapsulated: the fragments, without their item headers
+            segments = [
+                _segment(source, fragment_offset, fragment_length)
+                for frame in ranges
+                for fragment_offset, fragment_length in frame
+            ]
+        else:
+            segments = [_segment(source, offset, length)]
+
+        return _ranged_response(
+            request,
+            segments,
+            f"application/octet-stream; transfer-syntax={transfer_syntax_uid}",
+        )
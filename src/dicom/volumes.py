@@ -0,0 +1,266 @@
+import contextlib
+import hashlib
+import json
+import os
+import threading
+import uuid
+
+import numpy as np
+from django.conf import settings
+from pydicom import dcmread
+
+from dicom import rendering, storage
+from dicom.models import Instance
+
+
+def _floats(value, default):
+    if value is None:
+        return default
+    return [float(v) for v in value]
+
+
+def series_images(series_instance_uid):
+    """Return the image names of a series' stored instances, ordered by pk."""
+    return list(
+        Instance.objects.filter(
+            series__series_instance_uid=series_instance_uid, image__isnull=False
+        )
+        .order_by("image_id")
+        .values_list("image_id", "image__image")
+    )
+
+
+def series_signature(images):
+    """Identify the set of stored files a volume was built from."""
+    digest = hashlib.sha1()
+    for image_id, _ in images:
+        digest.update(str(image_id).encode())
+    return digest.hexdigest()
+
+
+def sort_slices(headers):
+    """
+    Order slice headers along the slice normal, from ImagePositionPatient
+    projected onto the cross product of ImageOrientationPatient, falling
+    back to InstanceNumber when positions are missing.
+
+    Returns (sorted headers, slice spacing or None).
+    """
+    orientation = _floats(headers[0].get("ImageOrientationPatient"), None)
+    positions = [_floats(h.get("ImagePositionPatient"), None) for h in headers]
+    if orientation is None or None in positions:
+        ordered = sorted(headers, key=lambda h: int(h.get("InstanceNumber") or 0))
+        return ordered, None
+
+    normal = np.cross(orientation[:3], orientation[3:])
+    distances = np.asarray(positions) @ normal
+    order = np.argsort(distances, kind="stable")
+    gaps = np.diff(distances[order])
+    spacing = float(np.median(gaps)) if len(gaps) else None
+    return [headers[index] for index in order], spacing
+
+
+class Volume:
+    """
+    A series as a (slices, rows, columns) array of stored values
+
+    `array` is a read-only np.memmap; Rescale Slope/Intercept are kept in
+    the header and only applied by `modality()` to the voxels asked for.
+    """
+
+    def __init__(self, header, array):
+        self.header = header
+        self.array = array
+
+    @property
+    def slope(self):
+        return self.header["rescale_slope"]
+
+    @property
+    def intercept(self):
+        return self.header["rescale_intercept"]
+
+    @property
+    def spacing(self):
+        """(slice, row, column) spacing in mm"""
+        return tuple(self.header["spacing"])
+
+    def modality(self, voxels):
+        """Apply the Modality LUT to a selection of stored values."""
+        return voxels.astype(np.float32) * self.slope + self.intercept
+
+
+class VolumeCache:
+    """
+    Per-series volumes kept in `directory` as a raw file np.memmap can map
+    directly and a small JSON header
+
+    A volume is rebuilt when the series' stored files change. Opening a
+    volume bumps its header's mtime; once the raw files exceed
+    `max_bytes` the least recently used volumes are removed down to
+    `low_water` of the limit. Workers that already mapped an evicted
+    volume keep their mapping until they drop it.
+    """
+
+    def __init__(self, directory, max_bytes, low_water=0.9):
+        self.directory = str(directory)
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        self._lock = threading.Lock()
+
+    def paths(self, series_instance_uid):
+        base = os.path.join(self.directory, series_instance_uid)
+        return f"{base}.raw", f"{base}.json"
+
+    def get(self, series_instance_uid):
+        """Return the Volume of a series, building it if needed."""
+        images = series_images(series_instance_uid)
+        if not images:
+            raise LookupError(f"No stored instances in series {series_instance_uid}")
+        signature = series_signature(images)
+
+        volume = self.open(series_instance_uid)
+        if volume is not None and volume.header["signature"] == signature:
+            return volume
+        return self.build(series_instance_uid, images, signature)
+
+    def open(self, series_instance_uid):
+        raw_path, header_path = self.paths(series_instance_uid)
+        try:
+            with open(header_path) as f:
+                header = json.load(f)
+            array = np.memmap(
+                raw_path, dtype=header["dtype"], mode="r", shape=tuple(header["shape"])
+            )
+            os.utime(header_path)
+        except (OSError, ValueError):
+            return None
+        return Volume(header, array)
+
+    def build(self, series_instance_uid, images, signature):
+        """
+        Decode every slice of a series, in anatomical order, into a new
+        raw volume file and publish it with its header.
+        """
+        paths = [storage.absolute_path(name) for _, name in images]
+        headers = []
+        for path in paths:
+            header = dcmread(path, stop_before_pixels=True)
+            if int(header.get("NumberOfFrames") or 1) != 1:
+                raise ValueError("Multi-frame instances can't be assembled")
+            headers.append(header)
+        headers, slice_spacing = sort_slices(headers)
+
+        first = headers[0]
+        rows, columns = int(first.Rows), int(first.Columns)
+        if any((int(h.Rows), int(h.Columns)) != (rows, columns) for h in headers):
+            raise ValueError("Slices of different sizes can't be assembled")
+        rescale = {
+            (
+                float(h.get("RescaleSlope", 1) or 1),
+                float(h.get("RescaleIntercept", 0) or 0),
+            )
+            for h in headers
+        }
+        # Per-slice rescales can't be applied lazily, so store modality values
+        slope, intercept = rescale.pop() if len(rescale) == 1 else (1.0, 0.0)
+        uniform = not rescale
+
+        os.makedirs(self.directory, exist_ok=True)
+        raw_path, header_path = self.paths(series_instance_uid)
+        part = uuid.uuid4().hex
+        array = None
+        try:
+            for index, header in enumerate(headers):
+                pixels = rendering.decode_frame(header.filename, header, 0)
+                if not uniform:
+                    pixels = pixels.astype(np.float32) * float(
+                        header.get("RescaleSlope", 1) or 1
+                    ) + float(header.get("RescaleIntercept", 0) or 0)
+                if array is None:
+                    array = np.memmap(
+                        f"{raw_path}.{part}.part",
+                        dtype=pixels.dtype,
+                        mode="w+",
+                        shape=(len(headers), rows, columns),
+                    )
+                array[index] = pixels
+            array.flush()
+
+            pixel_spacing = _floats(first.get("PixelSpacing"), [1.0, 1.0])
+            thickness = float(first.get("SliceThickness") or 1.0)
+            header = {
+                "series_instance_uid": series_instance_uid,
+                "signature": signature,
+                "shape": list(array.shape),
+                "dtype": array.dtype.str,
+                "spacing": [abs(slice_spacing or thickness)] + pixel_spacing,
+                "origin": _floats(first.get("ImagePositionPatient"), None),
+                "orientation": _floats(first.get("ImageOrientationPatient"), None),
+                "rescale_slope": slope,
+                "rescale_intercept": intercept,
+                "window": rendering.voi_window(first),
+                "photometric_interpretation": first.get(
+                    "PhotometricInterpretation", "MONOCHROME2"
+                ),
+                "sop_instance_uids": [h.SOPInstanceUID for h in headers],
+            }
+            del array
+            # Readers must never pair the old header with the new raw file
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(header_path)
+            os.replace(f"{raw_path}.{part}.part", raw_path)
+            with open(f"{header_path}.{part}.part", "w") as f:
+                json.dump(header, f)
+            os.replace(f"{header_path}.{part}.part", header_path)
+        finally:
+            if os.path.exists(f"{raw_path}.{part}.part"):
+                os.remove(f"{raw_path}.{part}.part")
+
+        self.evict()
+        return self.open(series_instance_uid)
+
+    def evict(self):
+        """Remove least recently used volumes while over `max_bytes`."""
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.directory):
+                if not name.endswith(".json"):
+                    continue
+                header_path = os.path.join(self.directory, name)
+                raw_path = f"{header_path[:-5]}.raw"
+                try:
+                    entries.append(
+                        (
+                            os.stat(header_path).st_mtime,
+                            os.stat(raw_path).st_size,
+                            header_path,
+                            raw_path,
+                        )
+                    )
+                except FileNotFoundError:
+                    continue
+
+            size = sum(entry[1] for entry in entries)
+            target = self.max_bytes * self.low_water
+            if size <= self.max_bytes:
+                return
+            for _, raw_size, header_path, raw_path in sorted(entries):
+                if size <= target:
+                    break
+                for path in (header_path, raw_path):
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(path)
+                size -= raw_size
+
+
+_volume_cache = None
+
+
+def volume_cache():
+    global _volume_cache
+    if _volume_cache is None:
+        _volume_cache = VolumeCache(
+            settings.DICOM_VOLUME_CACHE_DIR, settings.DICOM_VOLUME_CACHE_SIZE
+        )
+    return _volume_cache
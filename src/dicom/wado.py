@@ -0,0 +1,108 @@
+import os
+import re
+import uuid
+
+from django.conf import settings
+
+# A response body is described as a list of segments, each either bytes or
+# a (path, offset, length) region of a stored file, so its length is known
+# and byte ranges can be served without reading whole files into memory.
+
+
+def segment_length(segment):
+    return len(segment) if isinstance(segment, bytes) else segment[2]
+
+
+def file_segment(path):
+    return (path, 0, os.path.getsize(path))
+
+
+def stream_segments(segments, chunk_size=None):
+    """
+    Yield the body described by `segments` in chunks of `chunk_size`,
+    reading file regions with os.pread so only their bytes are touched.
+    """
+    chunk_size = chunk_size or settings.DICOMWEB_CHUNK_SIZE
+    current, fd = None, None
+    try:
+        for segment in segments:
+            if isinstance(segment, bytes):
+                yield segment
+                continue
+            path, offset, length = segment
+            if path != current:
+                # Consecutive regions of one file (e.g. frames) share a descriptor
+                if fd is not None:
+                    os.close(fd)
+                    fd = None
+                fd = os.open(path, os.O_RDONLY)
+                current = path
+            while length > 0:
+                chunk = os.pread(fd, min(chunk_size, length), offset)
+                if not chunk:
+                    raise OSError(f"{path} is shorter than expected")
+                offset += len(chunk)
+                length -= len(chunk)
+                yield chunk
+    finally:
+        if fd is not None:
+            os.close(fd)
+
+
+def slice_segments(segments, start, end):
+    """Return the segments covering bytes [start, end) of the body."""
+    sliced = []
+    position = 0
+    for segment in segments:
+        length = segment_length(segment)
+        lower = max(start - position, 0)
+        upper = min(end - position, length)
+        if lower < upper:
+            if isinstance(segment, bytes):
+                sliced.append(segment[lower:upper])
+            else:
+                sliced.append((segment[0], segment[1] + lower, upper - lower))
+        position += length
+    return sliced
+
+
+def new_boundary():
+    return uuid.uuid4().hex
+
+
+def multipart_segments(parts, boundary):
+    """
+    Yield the segments of a multipart/related body from (content type,
+    segments) parts, consuming `parts` lazily.
+    """
+    for content_type, segments in parts:
+        yield f"--{boundary}\r\nContent-Type: {content_type}\r\n\r\n".encode()
+        yield from segments
+        yield b"\r\n"
+    yield f"--{boundary}--\r\n".encode()
+
+
+def multipart_content_type(boundary, part_type):
+    return f'multipart/related; type="{part_type}"; boundary={boundary}'
+
+
+def parse_range(header, size):
+    """
+    Parse a single "bytes=" Range header into (start, end) with `end`
+    exclusive. Returns None when the whole body should be sent (no header,
+    several ranges or an unparsable one) and raises ValueError when the
+    range can't be satisfied.
+    """
+    match = re.fullmatch(r"\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*", header or "")
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if not first:
+        # Suffix range: the last N bytes
+        start, end = max(size - int(last), 0), size
+    else:
+        start = int(first)
+        end = min(int(last) + 1, size) if last else size
+    if start >= size or start >= end:
+        raise ValueError(f"Range not satisfiable for {size} bytes")
+    return start, end